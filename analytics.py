@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Итоги A/B-теста: накопительные счетчики событий по (stage, variant) и проверка значимости
+"""
+
+import math
+import time
+from collections import namedtuple
+
+from config import STAGES, VARIANTS, AB_STATS_PATH, AB_STATS_FLUSH_INTERVAL
+from storage import connect
+
+# События воронки: доставлено, ошибка отправки, пользователь недоступен, нажатие на кнопку
+EVENTS = ('sent', 'failed', 'blocked', 'click')
+
+# Сравнение варианта с контрольным на одном этапе (z-тест для двух долей)
+Comparison = namedtuple('Comparison', 'stage control variant control_rate variant_rate lift z p_value')
+
+
+def two_proportion_test(successes_a: int, trials_a: int, successes_b: int, trials_b: int):
+    """
+    Двусторонний z-тест разницы долей successes/trials
+    Возвращает (z, p_value); при пустой выборке — (0.0, 1.0)
+    """
+    if trials_a <= 0 or trials_b <= 0:
+        return 0.0, 1.0
+    pooled = (successes_a + successes_b) / (trials_a + trials_b)
+    variance = pooled * (1 - pooled) * (1 / trials_a + 1 / trials_b)
+    if variance <= 0:
+        return 0.0, 1.0
+    z = (successes_b / trials_b - successes_a / trials_a) / math.sqrt(variance)
+    return z, math.erfc(abs(z) / math.sqrt(2))
+
+
+def compare_variants(snapshot: dict, success: str = 'click', trials: str = 'sent',
+                     control: str = VARIANTS[0]) -> list:
+    """
+    Сравнивает каждый вариант с контрольным на каждом этапе по снимку ABStats.snapshot():
+    конверсия success/trials, относительный прирост и p-value z-теста
+    """
+    comparisons = []
+    for stage in STAGES:
+        base = snapshot[(stage, control)]
+        control_rate = base[success] / base[trials] if base[trials] else 0.0
+        for variant in VARIANTS:
+            if variant == control:
+                continue
+            counts = snapshot[(stage, variant)]
+            rate = counts[success] / counts[trials] if counts[trials] else 0.0
+            z, p_value = two_proportion_test(base[success], base[trials], counts[success], counts[trials])
+            lift = (rate - control_rate) / control_rate if control_rate else 0.0
+            comparisons.append(Comparison(stage, control, variant, control_rate, rate, lift, z, p_value))
+    return comparisons
+
+
+class ABStats:
+    """
+    Счетчики событий в SQLite: таблица из STAGES × VARIANTS × EVENTS строк, а не журнал событий
+    record() — O(1) прибавка в памяти; приращения сбрасываются в базу раз в flush_interval секунд
+    как UPSERT count = count + delta, поэтому писать могут несколько процессов сразу
+    (рассылка и сервис кликов). snapshot() читает готовые суммы, без пересчета сырых логов
+    """
+
+    def __init__(self, path: str = AB_STATS_PATH, flush_interval: float = AB_STATS_FLUSH_INTERVAL):
+        self._db = connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS counters ('
+            'stage TEXT NOT NULL, variant TEXT NOT NULL, event TEXT NOT NULL, count INTEGER NOT NULL, '
+            'PRIMARY KEY (stage, variant, event))'
+        )
+        self._db.commit()
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._last_flush = time.monotonic()
+
+    def record(self, stage: str, variant: str, event: str, count: int = 1):
+        """Учитывает событие event на этапе stage для варианта variant"""
+        if event not in EVENTS:
+            raise ValueError(f"Неизвестное событие: {event}")
+        key = (stage, variant, event)
+        self._pending[key] = self._pending.get(key, 0) + count
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._db.executemany(
+                'INSERT INTO counters (stage, variant, event, count) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (stage, variant, event) DO UPDATE SET count = count + excluded.count',
+                [(*key, count) for key, count in self._pending.items()]
+            )
+            self._db.commit()
+            self._pending = {}
+        self._last_flush = time.monotonic()
+
+    def snapshot(self) -> dict:
+        """
+        Текущие суммы: {(stage, variant): {event: count}} для всех этапов и вариантов
+        Включает еще не сброшенные приращения этого процесса
+        """
+        totals = {
+            (stage, variant): {event: 0 for event in EVENTS}
+            for stage in STAGES for variant in VARIANTS
+        }
+        rows = list(self._db.execute('SELECT stage, variant, event, count FROM counters'))
+        rows += [(*key, count) for key, count in self._pending.items()]
+        for stage, variant, event, count in rows:
+            totals.setdefault((stage, variant), {e: 0 for e in EVENTS})[event] += count
+        return totals
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def print_report(snapshot: dict, alpha: float = 0.05):
+    """Таблица счетчиков из снимка ABStats.snapshot() и значимость отличий от контрольного варианта"""
+    print("📊 Счетчики по этапам и вариантам:")
+    print(f"   {'этап':<10} {'вариант':<8} " + ' '.join(f"{event:>8}" for event in EVENTS) + f" {'CTR':>7}")
+    for stage in STAGES:
+        for variant in VARIANTS:
+            counts = snapshot[(stage, variant)]
+            ctr = counts['click'] / counts['sent'] if counts['sent'] else 0.0
+            print(f"   {stage:<10} {variant.upper():<8} "
+                  + ' '.join(f"{counts[event]:>8}" for event in EVENTS) + f" {ctr:>7.2%}")
+
+    print(f"\n🧪 Значимость (клики/доставки, против варианта {VARIANTS[0].upper()}, alpha={alpha}):")
+    for c in compare_variants(snapshot):
+        verdict = '✅ значимо' if c.p_value < alpha else '— различие не значимо'
+        print(f"   {c.stage:<10} {c.variant.upper()}: {c.variant_rate:.2%} против {c.control_rate:.2%} "
+              f"(прирост {c.lift:+.1%}, p={c.p_value:.4f}) {verdict}")
+
+
+if __name__ == "__main__":
+    ab_stats = ABStats()
+    try:
+        print_report(ab_stats.snapshot())
+    finally:
+        ab_stats.close()
@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки конвейера воронки
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Добавляем текущую директорию в путь для импорта
+sys.path.append('.')
+
+# Бенчмарки не трогают состояние кампании: кэши, журналы, метрики и сгенерированные CSV/картинки —
+# во временном каталоге, который main() создает и удаляет. Здесь задается только путь:
+# config читает STATE_DIR при импорте
+BENCH_DIR = os.path.join(tempfile.gettempdir(), f"bench_{os.getpid()}")
+os.environ['STATE_DIR'] = os.path.join(BENCH_DIR, 'state')
+
+from config import STAGES, VARIANTS
+
+
+def synthetic_user(i: int) -> dict:
+    """Тестовый пользователь с предсказуемыми полями"""
+    return {
+        'name': f"Пользователь {i}",
+        'role': ['Менеджер', 'Девелопер', 'CEO', 'HR'][i % 4],
+        'company': f"Компания {i % 50}",
+    }
+
+
+def measure(fn, count: int) -> dict:
+    """Вызывает fn(i) count раз и возвращает общее время и время на один вызов"""
+    started = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    total = time.perf_counter() - started
+    return {'count': count, 'total_s': round(total, 4), 'per_item_ms': round(total / count * 1000, 3)}
+
+
+def print_result(name: str, result: dict):
+    print(f"   {name:<28} {result['per_item_ms']:>10.4f} мс/шт  ({result['count']} шт за {result['total_s']:.2f} с)")
+
+
+def bench_backends(count: int = 200) -> dict:
+    """Стоимость одного изображения для каждого бэкенда html_to_png"""
+    from utils import render_html, html_to_png
+
+    print(f"🖼️  Бэкенды рендеринга ({count} изображений):")
+    output_dir = tempfile.mkdtemp(prefix='bench_')
+    results = {}
+    for backend in ('pillow', 'weasyprint'):
+        def render_one(i, backend=backend):
+            stage = STAGES[i % len(STAGES)]
+            variant = VARIANTS[i % len(VARIANTS)]
+            user_data = synthetic_user(i)
+            html = render_html(stage, variant, user_data)
+            html_to_png(html, f"{stage}_{variant}", i, output_dir, user_data, backend=backend)
+
+        try:
+            render_one(0)
+        except Exception as e:
+            print(f"   {backend:<28} недоступен: {e}")
+            continue
+        results[backend] = measure(render_one, count)
+        print_result(backend, results[backend])
+    return results
+
+
+def bench_text(count: int = 3000) -> dict:
+    """Разбор шаблона на каждое сообщение против скомпилированной разметки и масок TextRunCache"""
+    from renderer import LayeredRenderer, FIELD_MARKERS
+
+    print(f"🔤 Разметка шаблонов ({count} изображений, 50 компаний):")
+    renderer = LayeredRenderer()
+    jobs = [(STAGES[i % len(STAGES)], VARIANTS[i % len(VARIANTS)], synthetic_user(i)) for i in range(count)]
+
+    def parse_each(i):
+        stage, variant, _ = jobs[i]
+        renderer.compile(renderer.registry.get(stage, variant).render(**FIELD_MARKERS))
+        renderer.render(*jobs[i])
+
+    def compiled(i):
+        renderer.render(*jobs[i])
+
+    def copy_only(i):
+        stage, variant, _ = jobs[i]
+        renderer.base_image(stage, variant).copy()
+
+    results = {}
+    for name, fn in (('разбор на сообщение', parse_each), ('LayoutSpec', compiled), ('только копия фона', copy_only)):
+        results[name] = measure(fn, count)
+        print_result(name, results[name])
+    cache = renderer.text_runs
+    print(f"   Слова значений полей: попаданий {cache.hits}, растрировано {cache.misses}")
+    return results
+
+
+# Варианты кодирования для сравнения: (название, формат, переопределения параметров)
+ENCODING_OPTIONS = [
+    ('png (по умолчанию Pillow)', 'png', {'compress_level': 6, 'optimize': False}),
+    ('png compress_level=1', 'png', {'compress_level': 1, 'optimize': False}),
+    ('png optimize', 'png', {'compress_level': 9, 'optimize': True}),
+    ('png-palette 64', 'png-palette', {'colors': 64}),
+    ('png-palette 16', 'png-palette', {'colors': 16}),
+    ('jpeg q85', 'jpeg', {'quality': 85}),
+    ('webp q85', 'webp', {'quality': 85}),
+]
+
+
+def bench_encoding(count: int = 100) -> dict:
+    """Время кодирования и размер файла для каждого формата и уровня сжатия"""
+    import io
+    from renderer import render_image, encode_image, encode_options
+
+    print(f"🗜️  Кодирование изображений ({count} шт):")
+    images = [
+        render_image(STAGES[i % len(STAGES)], VARIANTS[i % len(VARIANTS)], synthetic_user(i))
+        for i in range(min(count, 30))
+    ]
+    results = {}
+    for name, fmt, overrides in ENCODING_OPTIONS:
+        options = {**encode_options(fmt), **overrides}
+        sizes = []
+
+        def encode_one(i, options=options, sizes=sizes):
+            buffer = io.BytesIO()
+            encode_image(images[i % len(images)], buffer, options)
+            sizes.append(buffer.tell())
+
+        results[name] = measure(encode_one, count)
+        results[name]['bytes_per_image'] = sum(sizes) // len(sizes)
+        print(f"   {name:<28} {results[name]['per_item_ms']:>10.4f} мс/шт  "
+              f"{results[name]['bytes_per_image'] / 1024:>8.1f} КБ/шт")
+    return results
+
+
+def bench_clicks(count: int = 20000) -> dict:
+    """Сервис кликов: время обработчика редиректа и пропускная способность через HTTP"""
+    import asyncio
+    from aiohttp import ClientSession, TCPConnector
+    from aiohttp.test_utils import TestServer, make_mocked_request
+    from click_tracker import ClickTracker, click_signature
+
+    print(f"🖱️  Учет кликов ({count} запросов):")
+    state = tempfile.mkdtemp(prefix='bench_')
+    tracker = ClickTracker(os.path.join(state, 'clicks.sqlite'), os.path.join(state, 'ab_stats.sqlite'), secret='bench')
+    app = tracker.make_app()
+    results = {}
+
+    async def run():
+        # Только обработчик, без сети: столько стоит ответ сервиса на клик
+        requests = []
+        for i in range(count):
+            signature = click_signature('interest', 'a', i, 'bench')
+            requests.append(make_mocked_request('GET', f'/c/interest/a/{i}/{signature}', match_info={
+                'stage': 'interest', 'variant': 'a', 'user': str(i), 'signature': signature
+            }))
+        started = time.perf_counter()
+        for request in requests:
+            await tracker.handle(request)
+        total = time.perf_counter() - started
+        results['handler'] = {'count': count, 'total_s': round(total, 4), 'per_item_ms': round(total / count * 1000, 5)}
+        print_result('обработчик', results['handler'])
+
+        # Через HTTP: 100 параллельных клиентов
+        async with TestServer(app) as server:
+            async with ClientSession(connector=TCPConnector(limit=100)) as session:
+                url = server.make_url('/c/solution/b/')
+                semaphore = asyncio.Semaphore(100)
+
+                async def click(i):
+                    async with semaphore:
+                        signature = click_signature('solution', 'b', i, 'bench')
+                        async with session.get(f'{url}{i}/{signature}', allow_redirects=False) as response:
+                            assert response.status == 302
+
+                started = time.perf_counter()
+                await asyncio.gather(*(click(i) for i in range(count)))
+                total = time.perf_counter() - started
+        results['http'] = {'count': count, 'total_s': round(total, 4), 'per_item_ms': round(total / count * 1000, 5)}
+        print_result('HTTP (100 соединений)', results['http'])
+        print(f"   Пропускная способность: {count / total:.0f} запросов/с, записано уникальных кликов: {tracker.unique}")
+
+    asyncio.run(run())
+    return results
+
+
+def bench_keyboards(count: int = 200000) -> dict:
+    """Клавиатура сообщения: модели pydantic с валидацией против KeyboardFactory"""
+    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    from config import BASE_URL
+    from utils import get_keyboard
+
+    print(f"⌨️  Клавиатуры ({count} сообщений):")
+
+    def validated(i):
+        stage = STAGES[i % len(STAGES)]
+        InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(
+            text=f"{stage.capitalize()} — Узнай больше для Пользователь {i}",
+            url=f"{BASE_URL}/{stage}?user={i}"
+        )]])
+
+    def factory(i):
+        get_keyboard(STAGES[i % len(STAGES)], i, f"Пользователь {i}", VARIANTS[i % len(VARIANTS)])
+
+    results = {}
+    for name, fn in (('pydantic с валидацией', validated), ('KeyboardFactory', factory)):
+        results[name] = measure(fn, count)
+        print_result(name, results[name])
+    print(f"   Ускорение: x{results['pydantic с валидацией']['total_s'] / results['KeyboardFactory']['total_s']:.1f}")
+    return results
+
+
+def synthetic_users_frame(rows: int):
+    """DataFrame пользователей в том виде, в каком его отдает iter_users"""
+    import pandas as pd
+    from utils import _normalize_users
+
+    df = pd.DataFrame({
+        'name': [f"Пользователь {i}" for i in range(rows)],
+        'role': pd.Categorical([['Менеджер', 'Девелопер', 'CEO', 'HR'][i % 4] for i in range(rows)]),
+        'company': pd.Categorical([f"Компания {i % 50}" for i in range(rows)]),
+        'telegram_id': range(100000000, 100000000 + rows),
+        'variant': [VARIANTS[i % len(VARIANTS)] for i in range(rows)],
+    })
+    return _normalize_users(df)
+
+
+def bench_users(count: int = 1000000) -> dict:
+    """Обход таблицы пользователей: iterrows + dict против UserRecord"""
+    from utils import records_from_frame
+
+    print(f"👥 Обход {count} пользователей:")
+    df = synthetic_users_frame(count)
+    results = {}
+
+    def via_iterrows():
+        for _, row in df.iterrows():
+            user_data = {'name': row['name'], 'role': row['role'], 'company': row['company']}
+            chat_id = row['telegram_id']
+            variant = row.get('variant', 'a')
+
+    def via_records():
+        for record in records_from_frame(df):
+            user_data = record.as_dict()
+            chat_id = record.telegram_id
+            variant = record.variant
+
+    for name, fn in (('iterrows', via_iterrows), ('UserRecord', via_records)):
+        started = time.perf_counter()
+        fn()
+        total = time.perf_counter() - started
+        results[name] = {'count': count, 'total_s': round(total, 4), 'per_item_ms': round(total / count * 1000, 5)}
+        print_result(name, results[name])
+
+    print(f"   Ускорение: x{results['iterrows']['total_s'] / results['UserRecord']['total_s']:.1f}")
+    return results
+
+
+def bench_variants(count: int = 1000000) -> dict:
+    """Назначение вариантов: random.choice в цикле против хэша одним проходом NumPy"""
+    import random
+    import numpy as np
+    from utils import assign_variants
+
+    print(f"🎲 Назначение вариантов для {count} пользователей:")
+    telegram_ids = np.arange(100000000, 100000000 + count, dtype=np.int64)
+    results = {}
+
+    def via_random_choice():
+        return [random.choice(VARIANTS) for _ in telegram_ids]
+
+    def via_hash():
+        return assign_variants(telegram_ids)
+
+    for name, fn in (('random.choice', via_random_choice), ('assign_variants', via_hash)):
+        started = time.perf_counter()
+        fn()
+        total = time.perf_counter() - started
+        results[name] = {'count': count, 'total_s': round(total, 4), 'per_item_ms': round(total / count * 1000, 6)}
+        print_result(name, results[name])
+
+    codes = assign_variants(telegram_ids)
+    shares = np.bincount(codes, minlength=len(VARIANTS)) / count
+    print(f"   Доли вариантов: {dict(zip(VARIANTS, shares.round(4).tolist()))}")
+    print(f"   Ускорение: x{results['random.choice']['total_s'] / results['assign_variants']['total_s']:.1f}")
+    return results
+
+
+# Размеры синтетических CSV для bench_load (берутся размеры не больше --count)
+CSV_SIZES = (1000, 10000, 100000, 1000000)
+
+
+def write_users_csv(path: str, rows: int) -> str:
+    """Синтетический users.csv на rows строк; одинаковый при каждом запуске"""
+    synthetic_users_frame(rows)[['name', 'role', 'company', 'telegram_id', 'variant']].to_csv(path, index=False)
+    return path
+
+
+def bench_load(count: int = 1000000) -> dict:
+    """Загрузка пользователей из CSV: load_users целиком и потоковый iter_users"""
+    from utils import load_users, iter_users
+
+    sizes = [rows for rows in CSV_SIZES if rows <= count] or [count]
+    print(f"📂 Загрузка CSV ({', '.join(str(rows) for rows in sizes)} строк):")
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    results = {}
+    for rows in sizes:
+        path = write_users_csv(os.path.join(work_dir, f'users_{rows}.csv'), rows)
+        for name, fn in (('load_users', lambda: len(load_users(path))),
+                         ('iter_users', lambda: sum(len(chunk) for chunk in iter_users(path)))):
+            started = time.perf_counter()
+            loaded = fn()
+            total = time.perf_counter() - started
+            assert loaded == rows, (name, loaded, rows)
+            key = f'{name} {rows}'
+            results[key] = {'count': rows, 'total_s': round(total, 4), 'per_item_ms': round(total / rows * 1000, 6),
+                            'rows_per_s': round(rows / total)}
+            print_result(key, results[key])
+    return results
+
+
+def bench_render(count: int = 200) -> dict:
+    """Рендеринг по шагам: шаблон (render_html) и картинка (html_to_png, текущий RENDER_BACKEND)"""
+    from utils import render_html, html_to_png
+
+    print(f"🎨 Рендеринг по шагам ({count} изображений):")
+    output_dir = tempfile.mkdtemp(prefix='bench_')
+    jobs = [(STAGES[i % len(STAGES)], VARIANTS[i % len(VARIANTS)], synthetic_user(i)) for i in range(count)]
+    htmls = []
+
+    def template(i):
+        stage, variant, user_data = jobs[i]
+        htmls.append(render_html(stage, variant, user_data))
+
+    def image(i):
+        stage, variant, user_data = jobs[i]
+        html_to_png(htmls[i], f"{stage}_{variant}", i, output_dir, user_data)
+
+    results = {}
+    for name, fn in (('render_html', template), ('html_to_png', image)):
+        results[name] = measure(fn, count)
+        print_result(name, results[name])
+    return results
+
+
+def bench_send(count: int = 100) -> dict:
+    """
+    Полный send_funnel (рендеринг в пуле, лимитер, повторы, кэш file_id) против локального
+    fake_telegram.py: ответ за 50 ± 20 мс, 1% ответов — 429 с retry_after
+    """
+    import asyncio
+    import contextlib
+    import io
+    from aiohttp.test_utils import TestServer
+    from bot_funnel import send_funnel, make_bot
+    from fake_telegram import FakeTelegramAPI, FAKE_TOKEN
+    from metrics import get_metrics
+    from render_pool import RenderPool
+    from utils import iter_users
+
+    print(f"📨 Полная рассылка ({count} пользователей, {count * len(STAGES)} сообщений, fake Telegram API):")
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    path = write_users_csv(os.path.join(work_dir, 'users.csv'), count)
+    output_dir = os.path.join(work_dir, 'output')
+    os.makedirs(output_dir)
+    api = FakeTelegramAPI(latency=0.05, jitter=0.02, flood_rate=0.01)
+
+    async def run():
+        async with TestServer(api.make_app()) as server:
+            bot = make_bot(FAKE_TOKEN, str(server.make_url('')).rstrip('/'))
+            try:
+                with RenderPool() as render_pool:
+                    # Построчный вывод рассылки не нужен: итог печатается ниже
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        return await send_funnel(bot, iter_users(path), output_dir, send_real=True,
+                                                 render_pool=render_pool)
+            finally:
+                await bot.session.close()
+
+    stats = asyncio.run(run())
+    send = get_metrics().merged('send_photo')
+    result = {
+        'count': stats['sent'],
+        'total_s': round(stats['elapsed'], 4),
+        'per_item_ms': round(stats['elapsed'] / max(stats['sent'], 1) * 1000, 3),
+        'messages_per_s': round(stats['rate'], 2),
+        'failed': stats['failed'],
+        'send_p50_ms': round(send.quantile(0.5) * 1000, 2),
+        'send_p95_ms': round(send.quantile(0.95) * 1000, 2),
+        'send_p99_ms': round(send.quantile(0.99) * 1000, 2),
+        'server': dict(api.stats),
+    }
+    print_result('send_funnel', result)
+    print(f"   Скорость: {result['messages_per_s']} сообщений/с, send_photo p50/p95/p99: "
+          f"{result['send_p50_ms']}/{result['send_p95_ms']}/{result['send_p99_ms']} мс")
+    print(f"   Сервер: {api.stats}")
+    return {'send_funnel': result}
+
+
+BENCHMARKS = {
+    'backends': bench_backends,
+    'encoding': bench_encoding,
+    'text': bench_text,
+    'clicks': bench_clicks,
+    'keyboards': bench_keyboards,
+    'users': bench_users,
+    'variants': bench_variants,
+    'load': bench_load,
+    'render': bench_render,
+    'send': bench_send,
+}
+
+
+def environment() -> dict:
+    """Где и на каком коммите получены результаты (для сравнения между коммитами)"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(previous: dict, current: dict, threshold: float = 0.1):
+    """Сравнивает время на элемент с прошлым JSON; медленнее больше чем на threshold — регрессия"""
+    print(f"🔍 Сравнение с коммитом {previous.get('environment', {}).get('commit') or '?'}:")
+    for bench, results in current.items():
+        for name, result in results.items():
+            old = previous.get('results', {}).get(bench, {}).get(name)
+            if not old or not old.get('per_item_ms') or 'per_item_ms' not in result:
+                continue
+            change = result['per_item_ms'] / old['per_item_ms'] - 1
+            mark = '⚠️  регрессия' if change > threshold else ('✅ быстрее' if change < -threshold else '')
+            print(f"   {bench + ' / ' + name:<40} {old['per_item_ms']:>10.4f} → {result['per_item_ms']:>10.4f} мс/шт "
+                  f"({change:+.1%}) {mark}")
+
+
+def main():
+    """Основная функция"""
+    parser = argparse.ArgumentParser(description='Бенчмарки воронки анонсов')
+    parser.add_argument('names', nargs='*', metavar='name',
+                       help=f"Какие бенчмарки запустить: {', '.join(BENCHMARKS)} (по умолчанию все)")
+    parser.add_argument('--count', type=int, default=None,
+                       help='Размер выборки (по умолчанию у каждого бенчмарка свой)')
+    parser.add_argument('--json', metavar='PATH', help='Сохранить результаты в JSON')
+    parser.add_argument('--compare', metavar='PATH', help='Сравнить с результатами из прошлого JSON')
+    args = parser.parse_args()
+    
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Неизвестные бенчмарки: {unknown}")
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+    
+    # Все tempfile.mkdtemp() бенчмарков тоже попадают в BENCH_DIR и удаляются вместе с ним
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    tempfile.tempdir = BENCH_DIR
+    results = {}
+    try:
+        for name in args.names or list(BENCHMARKS):
+            if args.count:
+                results[name] = BENCHMARKS[name](args.count)
+            else:
+                results[name] = BENCHMARKS[name]()
+            print()
+    finally:
+        tempfile.tempdir = None
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+    
+    if previous is not None:
+        compare(previous, results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'environment': environment(), 'args': vars(args), 'results': results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
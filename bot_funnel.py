@@ -5,91 +5,671 @@ Telegram Bot для автоматической персонализирова
 
 import asyncio
 import argparse
+import itertools
 import os
 import sys
+import time
+from collections import deque
+from dataclasses import dataclass, field
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
 from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import FSInputFile
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.exceptions import TelegramBadRequest
 
-from utils import load_users, render_html, html_to_png, get_keyboard, get_random_variant
-from config import BOT_TOKEN, STAGES, SEND_DELAY, VARIANTS
+from utils import (
+    iter_users, records_from_frame, with_hashed_variants, assign_shards, get_keyboard, get_template_registry
+)
+from config import (
+    BOT_TOKENS, TELEGRAM_API_URL, RENDER_WORKERS, STAGES, VARIANTS,
+    MESSAGES_PER_SECOND, MESSAGES_PER_CHAT_PER_SECOND, MAX_CONCURRENT_SENDS, RENDER_QUEUE_SIZE,
+    FILE_ID_CACHE_ENABLED, ARCHIVE_PATH, WORK_QUEUE_PATH, LEASE_HEARTBEAT_INTERVAL, LEASE_CHUNK_SIZE,
+    METRICS_PATH, LOG_EACH_MESSAGE, SCHEDULE_PATH, SCHEDULE_TEST_PATH
+)
+from rate_limiter import RateLimiter
+from render_pool import RenderPool, RenderResult
+from file_id_cache import FileIdCache
+from journal import SendJournal, ALL_STAGES_MASK, stage_bit
+from retry import RetryScheduler, DeadLetters, is_permanent
+from analytics import ABStats, print_report
+from image_archive import ImageArchive, ImageArchiveWriter, ArchiveInputFile, sniff_extension
+from scheduler import FunnelScheduler, DELIVERED, RETRY, DROP
+from work_queue import WorkQueue, Lease, LeaseLost, worker_name
+from metrics import Metrics, ProgressReporter, get_metrics
 
 
-async def send_funnel(bot: Bot, users_df, output_dir: str, send_real: bool = False, variant_mode: str = 'fixed'):
+@dataclass
+class DeliveryContext:
     """
-    Отправляет персонализированную воронку пользователям с поддержкой A/B-тестирования
+    Все, что нужно воркерам отправки: бот, лимитер, кэши, журнал и общая статистика
     """
-    print(f"Начинаем обработку {len(users_df)} пользователей...")
-    print(f"Режим: {'Отправка' if send_real else 'Тестирование (генерация PNG)'}")
-    print(f"Варианты: {variant_mode}")
+    bot: Bot
+    limiter: RateLimiter
+    send_real: bool
+    stats: dict
+    retry: RetryScheduler = None
+    file_ids: FileIdCache = None
+    journal: SendJournal = None
+    dead_letters: DeadLetters = None
+    completed: dict = field(default_factory=dict)
+    archive: ImageArchiveWriter = None
+    ab_stats: ABStats = None
+    ab_snapshot: dict = None
+    metrics: Metrics = None
+    progress: ProgressReporter = None
+    owned: list = field(default_factory=list)
+    started: float = 0.0
+    # Воркер: событие потери аренды — после него не уходит ни одно новое сообщение
+    lost: asyncio.Event = None
+
+
+def make_bot(token: str, api_url: str = TELEGRAM_API_URL) -> Bot:
+    """Бот для token; api_url — другой сервер Bot API (например, локальный fake_telegram.py)"""
+    if api_url:
+        return Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)))
+    return Bot(token=token)
+
+
+async def deliver_user(ctx: DeliveryContext, user_data: dict, chat_id: int, variant: str, rendered: list):
+    """
+    Проводит одного пользователя по всем этапам воронки
+    rendered — результат render_pool.render_user: RenderResult по каждому этапу
+    Этапы одного пользователя идут строго по порядку, параллельность — между пользователями
+    Этапы, уже записанные в журнал (ctx.completed при --resume), пропускаются;
+    после постоянной ошибки (бот заблокирован) оставшиеся этапы не отправляются,
+    после потери аренды (ctx.lost) — тоже: пользователей аренды уже отправляет новый владелец
+    Возвращает число этапов, которые завершены (отправлены, сгенерированы или уже были в журнале)
+    """
+    stats = ctx.stats
+    done = 0
+    if LOG_EACH_MESSAGE:
+        print(f"\nОбрабатываем пользователя: {user_data['name']} (ID: {chat_id}, вариант: {variant.upper()})")
     
-    total_messages = len(users_df) * len(STAGES)
-    processed = 0
-    variant_stats = {'a': 0, 'b': 0, 'c': 0}
-    
-    for _, row in users_df.iterrows():
-        user_data = {
-            'name': row['name'],
-            'role': row['role'],
-            'company': row['company']
-        }
-        chat_id = row['telegram_id']
+    done_mask = ctx.completed.get(chat_id, 0)
+    
+    for stage, png_path, error, cached, digest, photo, timings in rendered:
+        if ctx.lost is not None and ctx.lost.is_set():
+            break
         
-        # Определяем вариант для пользователя
-        if variant_mode == 'random':
-            variant = get_random_variant()
-        else:
-            variant = row.get('variant', 'a')
+        # Замеры рендеринга пришли из процесса пула; при ошибке последней замерена упавшая операция
+        if timings:
+            failed = next(reversed(timings)) if error else None
+            for operation, seconds in timings.items():
+                ctx.metrics.observe(operation, seconds, stage, variant, error=operation == failed)
         
-        print(f"\nОбрабатываем пользователя: {user_data['name']} (ID: {chat_id}, вариант: {variant.upper()})")
+        if done_mask & stage_bit(stage):
+            stats['skipped'] += 1
+            done += 1
+            continue
         
-        for stage in STAGES:
-            try:
-                # Рендерим HTML с учетом варианта
-                html_content = render_html(stage, variant, user_data)
-                
-                # Конвертируем в PNG с уникальным именем
-                png_path = html_to_png(html_content, f"{stage}_{variant}", chat_id, output_dir, user_data)
+        if error:
+            print(f"❌ Ошибка при обработке {stage}_{variant} для {user_data['name']}: {error}")
+            continue
+        
+        if cached:
+            stats['cached'] += 1
+        
+        unreachable = False
+        try:
+            if ctx.send_real:
+                # Отправляем через бота
+                with ctx.metrics.timer('get_keyboard', stage, variant):
+                    keyboard = get_keyboard(stage, chat_id, user_data['name'], variant)
+                caption = f"Этап {stage.capitalize()} (вариант {variant.upper()}) для {user_data['name']}"
                 
-                if send_real:
-                    # Отправляем через бота
-                    keyboard = get_keyboard(stage, chat_id, user_data['name'])
-                    caption = f"Этап {stage.capitalize()} (вариант {variant.upper()}) для {user_data['name']}"
-                    
-                    try:
-                        await bot.send_photo(
+                async def send():
+                    # Проверка перед каждой попыткой: повтор после паузы flood control тоже не должен уйти
+                    if ctx.lost is not None and ctx.lost.is_set():
+                        raise LeaseLost(f"аренда отдана другому воркеру, {stage} для {chat_id} не отправлен")
+                    # Замеряется каждая попытка отдельно: ожидание лимитера и пауз сюда не входит
+                    with ctx.metrics.timer('send_photo', stage, variant):
+                        if ctx.file_ids is not None:
+                            return await ctx.file_ids.send_photo(
+                                ctx.bot, chat_id, photo if photo is not None else png_path, digest,
+                                caption=caption,
+                                reply_markup=keyboard
+                            )
+                        return await ctx.bot.send_photo(
                             chat_id=chat_id,
-                            photo=FSInputFile(png_path),
+                            photo=photo if photo is not None else FSInputFile(png_path),
                             caption=caption,
                             reply_markup=keyboard
                         )
+                
+                try:
+                    # Лимитер и повторы: retry_after ставит на паузу только этот чат
+                    await ctx.retry.send(chat_id, send)
+                    stats['sent'] += 1
+                    done += 1
+                    if ctx.journal is not None:
+                        ctx.journal.record(chat_id, stage, variant)
+                    if ctx.ab_stats is not None:
+                        ctx.ab_stats.record(stage, variant, 'sent')
+                    if LOG_EACH_MESSAGE:
                         print(f"✅ Отправлено: {stage}_{variant} для {user_data['name']}")
-                        
-                    except TelegramBadRequest as e:
-                        print(f"❌ Ошибка отправки {stage}_{variant} для {user_data['name']}: {e}")
-                    except TelegramForbiddenError as e:
-                        print(f"❌ Пользователь {user_data['name']} заблокировал бота: {e}")
-                    except Exception as e:
-                        print(f"❌ Неожиданная ошибка при отправке {stage}_{variant} для {user_data['name']}: {e}")
                     
-                    # Задержка между отправками
-                    await asyncio.sleep(SEND_DELAY)
-                else:
-                    print(f"📸 Сгенерирован: {png_path}")
+                except LeaseLost:
+                    break
+                except Exception as e:
+                    if is_permanent(e):
+                        # Дальше этому пользователю писать бессмысленно — в dead letter и к следующему
+                        stats['blocked'] += 1
+                        if ctx.ab_stats is not None:
+                            ctx.ab_stats.record(stage, variant, 'blocked')
+                        if ctx.dead_letters is not None:
+                            ctx.dead_letters.add(chat_id, stage, variant, e)
+                        print(f"❌ Пользователь {user_data['name']} недоступен: {e}")
+                        unreachable = True
+                    else:
+                        stats['failed'] += 1
+                        if ctx.ab_stats is not None:
+                            ctx.ab_stats.record(stage, variant, 'failed')
+                        if isinstance(e, TelegramBadRequest):
+                            print(f"❌ Ошибка отправки {stage}_{variant} для {user_data['name']}: {e}")
+                        else:
+                            print(f"❌ Неожиданная ошибка при отправке {stage}_{variant} для {user_data['name']}: {e}")
+            elif ctx.archive is not None:
+                ctx.archive.append(chat_id, stage, variant, photo, digest)
+                done += 1
+                if LOG_EACH_MESSAGE:
+                    print(f"{'♻️  Из кэша' if cached else '📸 Сгенерирован'}: {stage}_{variant} → {ctx.archive.path}")
+            else:
+                done += 1
+                if LOG_EACH_MESSAGE:
+                    print(f"{'♻️  Из кэша' if cached else '📸 Сгенерирован'}: {png_path}")
+            
+            # Статистика вариантов
+            stats['variants'][variant] += 1
+            stats['processed'] += 1
+            ctx.progress.update(stats['processed'], stats['total'])
+            
+            if unreachable:
+                break
+            
+        except Exception as e:
+            print(f"❌ Ошибка при обработке {stage}_{variant} для {user_data['name']}: {e}")
+            continue
+    
+    return done
+
+
+def open_delivery(bot: Bot, send_real: bool, total: int = None, limiter: RateLimiter = None,
+                  file_ids: FileIdCache = None, journal: SendJournal = None, resume: bool = False,
+                  metrics_path: str = METRICS_PATH, ab_stats: ABStats = None,
+                  dead_letters: DeadLetters = None) -> DeliveryContext:
+    """
+    Готовит контекст отправки; ресурсы, созданные здесь, закрывает close_delivery
+    Переданные file_ids, journal, ab_stats и dead_letters остаются открытыми — их закрывает владелец
+    """
+    if limiter is None:
+        limiter = RateLimiter(MESSAGES_PER_SECOND, MESSAGES_PER_CHAT_PER_SECOND)
+    
+    owned = []
+    if file_ids is None and send_real and FILE_ID_CACHE_ENABLED:
+        file_ids = FileIdCache()
+        owned.append(file_ids)
+    
+    if journal is None and send_real:
+        journal = SendJournal()
+        owned.append(journal)
+    
+    completed = {}
+    if resume and journal is not None:
+        completed = journal.completed()
+        print(f"⏯️  Продолжаем рассылку: в журнале {len(completed)} пользователей")
+    
+    if ab_stats is None and send_real:
+        ab_stats = ABStats()
+        owned.append(ab_stats)
+    
+    if dead_letters is None and send_real:
+        dead_letters = DeadLetters()
+        owned.append(dead_letters)
+        if dead_letters.blocked:
+            print(f"🚫 Недоступных пользователей из прошлых запусков: {len(dead_letters.blocked)}")
+    
+    stats = {
+        'total': total,
+        'processed': 0,
+        'sent': 0,
+        'cached': 0,
+        'archived': 0,
+        'skipped': 0,
+        'failed': 0,
+        'blocked': 0,
+        'variants': {variant: 0 for variant in VARIANTS},
+    }
+    ctx = DeliveryContext(bot, limiter, send_real, stats, RetryScheduler(limiter),
+                          file_ids, journal, dead_letters, completed)
+    ctx.ab_stats = ab_stats
+    ctx.metrics = get_metrics()
+    ctx.progress = ProgressReporter(ctx.metrics, metrics_path)
+    owned.append(ctx.progress)
+    ctx.owned = owned
+    ctx.started = time.monotonic()
+    return ctx
+
+
+def close_delivery(ctx: DeliveryContext):
+    """Закрывает ресурсы контекста; даже при прерывании все доставленное попадает в журнал"""
+    if ctx.journal is not None:
+        ctx.journal.flush()
+    if ctx.ab_stats is not None:
+        ctx.ab_snapshot = ctx.ab_stats.snapshot()
+    for resource in ctx.owned:
+        resource.close()
+
+
+def print_summary(ctx: DeliveryContext) -> dict:
+    """Итоговая статистика прогона"""
+    stats = ctx.stats
+    elapsed = time.monotonic() - ctx.started
+    stats['elapsed'] = elapsed
+    stats['rate'] = (stats['sent'] if ctx.send_real else stats['processed']) / elapsed if elapsed > 0 else 0.0
+    
+    print(f"\n🎉 Обработка завершена! Обработано {stats['processed']} сообщений.")
+    if ctx.send_real:
+        print(f"📨 Отправлено {stats['sent']} сообщений за {elapsed:.1f} с")
+        print(f"⚡ Фактическая скорость: {stats['rate']:.2f} сообщений/с (лимит {ctx.limiter.global_bucket.rate:g}/с)")
+        print(f"🔁 Повторов: {ctx.retry.retries} (flood control: {ctx.retry.floods}), "
+              f"ошибок: {stats['failed']}, недоступных пользователей: {stats['blocked']}")
+        if ctx.file_ids is not None:
+            print(f"📤 Загружено картинок: {ctx.file_ids.uploads}, отправлено по file_id: {ctx.file_ids.reused}")
+    else:
+        print(f"⚡ Скорость генерации: {stats['rate']:.2f} изображений/с")
+    if stats['skipped']:
+        print(f"⏭️  Пропущено уже доставленных сообщений: {stats['skipped']}")
+    print(f"♻️  Взято из кэша рендеринга: {stats['cached']} изображений")
+    if stats['archived']:
+        print(f"📦 Взято из архива кампании: {stats['archived']} изображений")
+    if ctx.archive is not None:
+        print(f"📦 Архив {ctx.archive.path}: записано {ctx.archive.written} изображений, "
+              f"совпавших с уже записанными: {ctx.archive.deduplicated}")
+    print(f"📊 Статистика вариантов: {stats['variants']}")
+    if ctx.metrics is not None and ctx.metrics.series:
+        ctx.metrics.print_summary()
+        if ctx.progress is not None and ctx.progress.path:
+            print(f"📈 Метрики в формате Prometheus: {ctx.progress.path}")
+    if ctx.ab_snapshot is not None:
+        # Накопленные итоги всех рассылок кампании (счетчики живут в AB_STATS_PATH)
+        print()
+        print_report(ctx.ab_snapshot)
+    
+    return stats
+
+
+def iter_chunks(users):
+    """DataFrame или итератор кусков -> (куски, общее число сообщений или None)"""
+    if isinstance(users, pd.DataFrame):
+        print(f"Начинаем обработку {len(users)} пользователей...")
+        return [users], len(users) * len(STAGES)
+    print("Начинаем потоковую обработку пользователей...")
+    return users, None
+
+
+async def run_pipeline(ctx: DeliveryContext, chunks, output_dir: str, variant_mode: str, render_pool: RenderPool,
+                       reader: ImageArchive = None, concurrency: int = MAX_CONCURRENT_SENDS):
+    """
+    Рендеринг и отправка потока кусков пользователей в уже открытом контексте доставки
+    Возвращается, когда все пользователи из chunks доставлены (или не доставлены окончательно)
+    reader — архив кампании, из которого берутся готовые картинки
+    """
+    stats = ctx.stats
+    
+    # Ограниченная очередь (producer/consumer): в ней лежат уже запущенные рендеры,
+    # поэтому ее размер ограничивает и память, и то, насколько рендеринг опережает отправку
+    queue = asyncio.Queue(maxsize=RENDER_QUEUE_SIZE)
+    
+    async def worker():
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                user_data, chat_id, variant, future = item
+                try:
+                    rendered = await future
+                except Exception as e:
+                    rendered = [RenderResult(stage, None, str(e), False, None) for stage in STAGES]
+                await deliver_user(ctx, user_data, chat_id, variant, rendered)
+            finally:
+                queue.task_done()
+    
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    
+    try:
+        for chunk in ctx.metrics.timed_iter(chunks, 'load_users'):
+            if variant_mode == 'random':
+                # Вариант — хэш telegram_id и соли кампании: весь кусок одним проходом NumPy,
+                # при перезапуске и --resume пользователь попадает в тот же вариант
+                chunk = with_hashed_variants(chunk)
+            if ctx.lost is not None and ctx.lost.is_set():
+                break
+            for record in records_from_frame(chunk):
+                # Аренда потеряна: остальных пользователей куска не ставим в очередь
+                if ctx.lost is not None and ctx.lost.is_set():
+                    break
+                chat_id = record.telegram_id
+                
+                # Пользователь уже получил все этапы — не рендерим и не ставим в очередь
+                if ctx.completed.get(chat_id) == ALL_STAGES_MASK:
+                    stats['skipped'] += len(STAGES)
+                    continue
                 
-                # Статистика вариантов
-                variant_stats[variant] += 1
-                processed += 1
-                print(f"Прогресс: {processed}/{total_messages}")
+                # Пользователь заблокировал бота в прошлых запусках
+                if ctx.dead_letters is not None and chat_id in ctx.dead_letters:
+                    stats['skipped'] += len(STAGES)
+                    continue
                 
-            except Exception as e:
-                print(f"❌ Ошибка при обработке {stage}_{variant} для {user_data['name']}: {e}")
+                user_data = record.as_dict()
+                
+                # Картинки уже есть в архиве — отправляем их (и их вариант) без рендеринга
+                if reader is not None:
+                    found = reader.lookup(chat_id)
+                    if all(stage in found for stage in STAGES):
+                        variant = found[STAGES[0]][0]
+                        rendered = []
+                        for stage in STAGES:
+                            _, digest, view = found[stage]
+                            filename = f"{stage}_{variant}_{chat_id}{sniff_extension(view)}"
+                            rendered.append(RenderResult(stage, None, None, False, digest,
+                                                         ArchiveInputFile(view, filename)))
+                        future = asyncio.get_running_loop().create_future()
+                        future.set_result(rendered)
+                        stats['archived'] += len(STAGES)
+                        await queue.put((user_data, chat_id, variant, future))
+                        continue
+                
+                variant = record.variant
+                future = render_pool.submit(user_data, chat_id, variant, output_dir)
+                await queue.put((user_data, chat_id, variant, future))
+        
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+async def send_funnel(bot: Bot, users, output_dir: str, send_real: bool = False, variant_mode: str = 'fixed',
+                      limiter: RateLimiter = None, concurrency: int = MAX_CONCURRENT_SENDS,
+                      render_pool: RenderPool = None, file_ids: FileIdCache = None,
+                      journal: SendJournal = None, resume: bool = False, archive: str = None) -> dict:
+    """
+    Отправляет персонализированную воронку пользователям с поддержкой A/B-тестирования
+    users — DataFrame из load_users или итератор кусков из iter_users (потоковый режим)
+    Рендеринг идет в пуле процессов и опережает отправку не более чем на RENDER_QUEUE_SIZE
+    пользователей; пользователи отправляются параллельно (до concurrency одновременно),
+    скорость ограничивается глобальным и поканальным лимитом
+    Каждая доставка пишется в журнал; resume=True пропускает уже доставленное
+    archive — архив кампании (один файл вместо PNG на каждого пользователя): в тестовом режиме
+    картинки записываются в него, при отправке берутся из него через mmap без рендеринга
+    """
+    chunks, total = iter_chunks(users)
+    print(f"Режим: {'Отправка' if send_real else 'Тестирование (генерация PNG)'}")
+    print(f"Варианты: {variant_mode}")
+    
+    ctx = open_delivery(bot, send_real, total, limiter, file_ids, journal, resume)
+    
+    reader = None
+    if archive is not None:
+        if send_real:
+            reader = ImageArchive(archive)
+            ctx.owned.append(reader)
+            print(f"📦 Архив кампании: {archive} ({len(reader)} изображений)")
+        else:
+            ctx.archive = ImageArchiveWriter(archive)
+            ctx.owned.append(ctx.archive)
+            output_dir = None
+    
+    own_pool = render_pool is None
+    if own_pool:
+        render_pool = RenderPool()
+    print(f"Процессов рендеринга: {render_pool.workers}")
+    
+    try:
+        await run_pipeline(ctx, chunks, output_dir, variant_mode, render_pool, reader, concurrency)
+    finally:
+        if own_pool:
+            render_pool.close()
+        close_delivery(ctx)
+    
+    return print_summary(ctx)
+
+
+class ShardRouter:
+    """
+    Один проход по потоку кусков на все шарды процесса: кусок делится по assign_shards,
+    части ждут в очереди своего шарда. Шарды идут в одном event loop, поэтому генераторы
+    chunks() по очереди тянут из общего источника без блокировок; в очередях лежат только части,
+    прочитанные быстрым шардом раньше медленного
+    """
+
+    def __init__(self, chunks, shards: int, wanted: list):
+        self.shards = shards
+        self._source = iter(chunks)
+        self._queues = {shard: deque() for shard in wanted}
+
+    def _pull(self) -> bool:
+        chunk = next(self._source, None)
+        if chunk is None:
+            return False
+        codes = assign_shards(chunk['telegram_id'].to_numpy(dtype=np.int64), self.shards)
+        for shard, queue in self._queues.items():
+            mask = codes == shard
+            if mask.any():
+                queue.append(chunk[mask])
+        return True
+
+    def chunks(self, shard: int):
+        """Куски пользователей бота shard"""
+        queue = self._queues[shard]
+        while queue or self._pull():
+            if queue:
+                yield queue.popleft()
+
+
+async def send_sharded(bots: list, chunks, output_dir: str, send_real: bool = True, variant_mode: str = 'fixed',
+                       render_pool: RenderPool = None, resume: bool = False, archive: str = None,
+                       shards: list = None) -> list:
+    """
+    Рассылка через пул ботов: пользователь всегда получает сообщения от бота assign_shards(telegram_id)
+    У каждого бота (шарда) свой лимитер и своя сессия, шарды идут параллельно в одном event loop
+    chunks — поток кусков пользователей (iter_users): читается один раз и раздается шардам через ShardRouter
+    shards — какие шарды запускать в этом процессе (по умолчанию все; для нескольких процессов — --shard)
+    """
+    shards = list(range(len(bots))) if shards is None else shards
+    # Журнал, кэш file_id (по id бота и хэшу картинки), счетчики A/B, недоступные пользователи,
+    # снимок доставленного и архив — общие на все шарды
+    journal = SendJournal() if send_real else None
+    file_ids = FileIdCache() if send_real and FILE_ID_CACHE_ENABLED else None
+    ab_stats = ABStats() if send_real else None
+    dead_letters = DeadLetters() if send_real else None
+    if dead_letters is not None and dead_letters.blocked:
+        print(f"🚫 Недоступных пользователей из прошлых запусков: {len(dead_letters.blocked)}")
+    completed = {}
+    if resume and journal is not None:
+        completed = journal.completed()
+        print(f"⏯️  Продолжаем рассылку: в журнале {len(completed)} пользователей")
+    reader = None
+    if archive is not None and send_real:
+        reader = ImageArchive(archive)
+        print(f"📦 Архив кампании: {archive} ({len(reader)} изображений)")
+    own_pool = render_pool is None
+    if own_pool:
+        render_pool = RenderPool()
+    router = ShardRouter(chunks, len(bots), shards)
+    
+    async def run_shard(shard: int) -> dict:
+        print(f"🤖 Бот {shard + 1}/{len(bots)} (id {bots[shard].id}) начинает рассылку")
+        ctx = open_delivery(bots[shard], send_real, file_ids=file_ids, journal=journal,
+                            ab_stats=ab_stats, dead_letters=dead_letters)
+        ctx.completed = completed
+        try:
+            await run_pipeline(ctx, router.chunks(shard), output_dir, variant_mode, render_pool, reader)
+        finally:
+            close_delivery(ctx)
+        return print_summary(ctx)
+    
+    try:
+        results = await asyncio.gather(*(run_shard(shard) for shard in shards))
+    finally:
+        if own_pool:
+            render_pool.close()
+        for resource in (journal, file_ids, ab_stats, dead_letters, reader):
+            if resource is not None:
+                resource.close()
+    
+    sent = sum(result['sent'] for result in results)
+    elapsed = max(result['elapsed'] for result in results)
+    print(f"\n🤖 Ботов: {len(shards)}, отправлено всего {sent} сообщений за {elapsed:.1f} с "
+          f"({sent / elapsed if elapsed > 0 else 0.0:.2f} сообщений/с)")
+    return results
+
+
+def lease_chunks(ctx: DeliveryContext, csv_path: str, lease: Lease, lost: asyncio.Event):
+    """
+    Куски пользователей аренды; перед каждым куском из журнала подгружается, что им уже доставлено
+    (аренду мог начать другой воркер). Если аренда отдана другому, новые куски не выдаются
+    """
+    for chunk in iter_users(csv_path, chunksize=LEASE_CHUNK_SIZE, start=lease.start, stop=lease.stop):
+        if lost.is_set():
+            return
+        if ctx.journal is not None:
+            ctx.completed.update(ctx.journal.completed(chunk['telegram_id']))
+        yield chunk
+
+
+async def run_worker(bot: Bot, work_queue: WorkQueue, output_dir: str, send_real: bool = True,
+                     variant_mode: str = 'fixed', render_pool: RenderPool = None, archive: str = None,
+                     worker: str = None, heartbeat_interval: float = LEASE_HEARTBEAT_INTERVAL) -> dict:
+    """
+    Воркер распределенной рассылки: забирает аренды из очереди координатора (work_queue.py),
+    рендерит и отправляет их пользователей, продлевая аренду каждые heartbeat_interval секунд.
+    Аренда отмечается выполненной, когда все ее пользователи обработаны; журнал общий,
+    поэтому аренда умершего воркера, отданная другому, не отправляет повторно уже доставленное
+    Воркер завершается, когда в очереди не остается ни свободных, ни занятых аренд
+    """
+    worker = worker or worker_name()
+    csv_path = work_queue.csv_path
+    if csv_path is None:
+        raise ValueError(f"Очередь {work_queue.path} пуста: сначала запустите координатор (python3 work_queue.py)")
+    print(f"👷 Воркер {worker}: кампания {csv_path}")
+    
+    own_pool = render_pool is None
+    if own_pool:
+        render_pool = RenderPool()
+    
+    # У каждого воркера свой файл метрик: сборщик Prometheus читает все *.prom в каталоге
+    ctx = open_delivery(bot, send_real, metrics_path=f"{os.path.splitext(METRICS_PATH)[0]}.{worker}.prom")
+    reader = None
+    if archive is not None and send_real:
+        reader = ImageArchive(archive)
+        ctx.owned.append(reader)
+    leases = 0
+    
+    try:
+        while True:
+            lease = work_queue.claim(worker)
+            if lease is None:
+                if work_queue.finished():
+                    break
+                # Свободных аренд нет, но чужие еще в работе: их могут вернуть в очередь
+                await asyncio.sleep(heartbeat_interval)
                 continue
+            
+            print(f"📋 Аренда {lease.lease_id}: строки {lease.start}–{lease.stop - 1}"
+                  + (f" (попытка {lease.attempts})" if lease.attempts > 1 else ""))
+            lost = asyncio.Event()
+            
+            async def heartbeat():
+                while True:
+                    await asyncio.sleep(heartbeat_interval)
+                    # Сначала журнал: все, что доставлено до продления, видно следующему владельцу
+                    if ctx.journal is not None:
+                        ctx.journal.flush()
+                    if not work_queue.heartbeat(lease.lease_id, worker):
+                        print(f"⚠️  Аренда {lease.lease_id} отдана другому воркеру — прекращаем ее")
+                        lost.set()
+                        return
+            
+            beat = asyncio.create_task(heartbeat())
+            ctx.completed = {}
+            ctx.lost = lost
+            try:
+                await run_pipeline(ctx, lease_chunks(ctx, csv_path, lease, lost), output_dir, variant_mode,
+                                   render_pool, reader)
+            finally:
+                beat.cancel()
+            
+            if ctx.journal is not None:
+                ctx.journal.flush()
+            if not lost.is_set() and work_queue.complete(lease.lease_id, worker):
+                leases += 1
+    finally:
+        if own_pool:
+            render_pool.close()
+        close_delivery(ctx)
     
-    print(f"\n🎉 Обработка завершена! Обработано {processed} сообщений.")
-    print(f"📊 Статистика вариантов: {variant_stats}")
+    print(f"\n👷 Воркер {worker}: выполнено аренд {leases}")
+    return print_summary(ctx)
+
+
+async def run_scheduled(bot: Bot, users, output_dir: str, send_real: bool = False, variant_mode: str = 'fixed',
+                        render_pool: RenderPool = None, scheduler: FunnelScheduler = None,
+                        stop_when_empty: bool = True) -> dict:
+    """
+    Воронка по расписанию: пользователи из users добавляются в персистентную очередь,
+    каждый этап уходит через STAGE_DELAYS после предыдущего. Между сроками процесс спит.
+    Повторный запуск продолжает с того же места — состояние хранится в SCHEDULE_PATH.
+    Тестовый режим ничего не отправляет и ведёт отдельную очередь SCHEDULE_TEST_PATH
+    """
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = FunnelScheduler(SCHEDULE_PATH if send_real else SCHEDULE_TEST_PATH)
+        if not send_real:
+            print(f"🧪 Тестовый режим: расписание ведётся в {SCHEDULE_TEST_PATH}")
+    own_pool = render_pool is None
+    if own_pool:
+        render_pool = RenderPool()
+    
+    # Журнал защищает от повторной отправки этапа, если процесс упал между отправкой и записью расписания
+    ctx = open_delivery(bot, send_real, resume=True)
+    
+    try:
+        chunks, _ = iter_chunks(users)
+        enrolled = 0
+        for chunk in chunks:
+            if variant_mode == 'random':
+                chunk = with_hashed_variants(chunk)
+            for record in records_from_frame(chunk):
+                enrolled += scheduler.enroll(record.telegram_id, record.as_dict(), record.variant)
+        scheduler.flush()
+        print(f"🗓️  Новых пользователей в воронке: {enrolled}, всего ожидают этапа: {len(scheduler)}")
+        
+        async def handle(chat_id, user_data, variant, stage):
+            if ctx.dead_letters is not None and chat_id in ctx.dead_letters:
+                return DROP
+            rendered = await render_pool.submit(user_data, chat_id, variant, output_dir, stages=[stage])
+            done = await deliver_user(ctx, user_data, chat_id, variant, rendered)
+            if ctx.dead_letters is not None and chat_id in ctx.dead_letters:
+                return DROP
+            return DELIVERED if done else RETRY
+        
+        await scheduler.run(handle, stop_when_empty=stop_when_empty)
+    finally:
+        if own_pool:
+            render_pool.close()
+        if own_scheduler:
+            scheduler.close()
+        close_delivery(ctx)
+    
+    return print_summary(ctx)
 
 
 async def main():
@@ -98,9 +678,31 @@ async def main():
     parser.add_argument('--test', action='store_true', help='Тестовый режим (только генерация PNG)')
     parser.add_argument('--send', action='store_true', help='Режим отправки сообщений')
     parser.add_argument('--variant', choices=['fixed', 'random'], default='fixed', 
-                       help='Режим выбора вариантов: fixed (по CSV) или random (случайно)')
+                       help='Режим выбора вариантов: fixed (по CSV) или random '
+                            '(по хэшу telegram_id и CAMPAIGN_SALT с долями VARIANT_WEIGHTS)')
+    parser.add_argument('--resume', action='store_true',
+                       help='Продолжить прерванную рассылку: пропустить уже доставленное по журналу')
+    parser.add_argument('--schedule', action='store_true',
+                       help='Воронка по расписанию: этапы уходят с паузами STAGE_DELAYS (долгоживущий процесс)')
+    parser.add_argument('--archive', nargs='?', const=ARCHIVE_PATH, default=None,
+                       help=f'Архив кампании в одном файле: с --test записать картинки в него, '
+                            f'с --send отправлять из него (по умолчанию {ARCHIVE_PATH})')
+    parser.add_argument('--shard', type=int, default=None,
+                       help='Номер бота из BOT_TOKENS (с 0): разослать только его пользователям '
+                            '(чтобы разнести ботов по нескольким процессам)')
+    parser.add_argument('--worker', nargs='?', const='', default=None, metavar='ИМЯ',
+                       help='Воркер распределенной рассылки: брать аренды из очереди координатора '
+                            f'(python3 work_queue.py, очередь {WORK_QUEUE_PATH})')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Число процессов рендеринга (по умолчанию RENDER_WORKERS или число ядер)')
     
     args = parser.parse_args()
+    if args.archive and args.schedule:
+        parser.error('--archive нельзя сочетать с --schedule')
+    if args.worker is not None and (args.schedule or args.resume or args.shard is not None):
+        parser.error('--worker нельзя сочетать с --schedule, --resume и --shard')
+    if args.worker is not None and args.archive and not args.send:
+        parser.error('--worker --archive работает только с --send: архив пишет один процесс')
     
     # Определяем режим работы
     if args.send:
@@ -114,28 +716,62 @@ async def main():
     print(f"🎯 Варианты: {args.variant}")
     
     # Проверяем токен бота
-    if not BOT_TOKEN:
+    if not BOT_TOKENS:
         print("❌ Ошибка: BOT_TOKEN не найден в переменных окружения")
-        print("Создайте файл .env и добавьте BOT_TOKEN=your_bot_token")
+        print("Создайте файл .env и добавьте BOT_TOKEN=your_bot_token (или BOT_TOKENS=token1,token2)")
         sys.exit(1)
+    if args.shard is not None and not 0 <= args.shard < len(BOT_TOKENS):
+        parser.error(f"--shard должен быть от 0 до {len(BOT_TOKENS) - 1}")
+    # Пул ботов нужен только для отправки; расписание хранит одну очередь на всех
+    sharded = send_real and len(BOT_TOKENS) > 1 and not args.schedule and args.worker is None
+    if (args.schedule or args.worker is not None) and len(BOT_TOKENS) > 1:
+        print("⚠️  --schedule и --worker используют только первый бот из BOT_TOKENS")
     
     # Создаем директорию для вывода
     output_dir = "output"
     os.makedirs(output_dir, exist_ok=True)
     
     try:
-        # Загружаем пользователей
-        users_df = load_users('users.csv')
+        # Компилируем все шаблоны заранее: отсутствующий шаблон — ошибка до начала рассылки
+        get_template_registry()
+        
+        if args.worker is not None:
+            # Пользователей и их диапазоны выдает координатор
+            bots = [make_bot(BOT_TOKENS[0])]
+            work_queue = WorkQueue()
+            try:
+                with RenderPool(args.workers or RENDER_WORKERS) as render_pool:
+                    await run_worker(bots[0], work_queue, output_dir, send_real, args.variant,
+                                     render_pool=render_pool, archive=args.archive, worker=args.worker or None)
+            finally:
+                work_queue.close()
+            return
+        
+        # Загружаем пользователей потоково: память не зависит от размера CSV
+        chunks = iter_users('users.csv')
+        first_chunk = next(chunks, None)
         
-        if users_df.empty:
+        if first_chunk is None or first_chunk.empty:
             print("❌ Ошибка: CSV файл пуст или не содержит данных")
             sys.exit(1)
+        users = itertools.chain([first_chunk], chunks)
         
-        # Создаем бота
-        bot = Bot(token=BOT_TOKEN)
+        # Создаем ботов: у каждого своя сессия
+        bots = [make_bot(token) for token in (BOT_TOKENS if sharded else BOT_TOKENS[:1])]
+        bot = bots[0]
         
-        # Запускаем воронку с поддержкой вариантов
-        await send_funnel(bot, users_df, output_dir, send_real, args.variant)
+        # Запускаем воронку с поддержкой вариантов, рендеринг — в пуле процессов
+        with RenderPool(args.workers or RENDER_WORKERS) as render_pool:
+            if sharded:
+                shards = [args.shard] if args.shard is not None else None
+                await send_sharded(bots, users, output_dir, send_real, args.variant,
+                                   render_pool=render_pool, resume=args.resume, archive=args.archive,
+                                   shards=shards)
+            elif args.schedule:
+                await run_scheduled(bot, users, output_dir, send_real, args.variant, render_pool=render_pool)
+            else:
+                await send_funnel(bot, users, output_dir, send_real, args.variant,
+                                  render_pool=render_pool, resume=args.resume, archive=args.archive)
         
     except FileNotFoundError as e:
         print(f"❌ Ошибка: {e}")
@@ -144,8 +780,8 @@ async def main():
         print(f"❌ Неожиданная ошибка: {e}")
         sys.exit(1)
     finally:
-        # Закрываем сессию бота
-        if 'bot' in locals():
+        # Закрываем сессии ботов
+        for bot in locals().get('bots', []):
             await bot.session.close()
 
 
@@ -154,6 +790,7 @@ if __name__ == "__main__":
         asyncio.run(main())
     except KeyboardInterrupt:
         print("\n⏹️  Программа остановлена пользователем")
+        print("Доставленные сообщения сохранены в журнале, продолжить: python3 bot_funnel.py --send --resume")
     except Exception as e:
         print(f"❌ Критическая ошибка: {e}")
         sys.exit(1)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Сервис учета кликов: кнопки сообщений ведут сюда, клик записывается, пользователь уходит на BASE_URL
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+# Добавляем текущую директорию в путь для импорта
+sys.path.append('.')
+
+from config import (
+    STAGES, VARIANTS, BASE_URL, CLICKS_PATH, AB_STATS_PATH, TRACKING_HOST, TRACKING_PORT, TRACKING_SECRET,
+    CLICK_FLUSH_INTERVAL, CLICK_BUFFER_SIZE
+)
+from analytics import ABStats
+from storage import connect
+
+
+# Длина подписи в hex-символах (64 бита): ссылка остается короткой, подобрать подпись перебором нельзя
+SIGNATURE_LENGTH = 16
+
+
+def click_signature(stage: str, variant: str, telegram_id: int, secret: str = TRACKING_SECRET) -> str:
+    """Подпись ссылки на клик: без секрета нельзя засчитать клик за другого пользователя или вариант"""
+    message = f"{stage}/{variant}/{telegram_id}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()[:SIGNATURE_LENGTH]
+
+
+def landing_url(stage: str, telegram_id: int, base_url: str = BASE_URL) -> str:
+    """Куда ведет кнопка этапа без сервиса кликов (та же ссылка, что строит utils.get_keyboard)"""
+    return f"{base_url}/{stage}?user={telegram_id}"
+
+
+class ClickTracker:
+    """
+    Обработчик редиректов отвечает сразу: клик только добавляется в список в памяти.
+    Раз в flush_interval секунд (или при buffer_size кликах) накопленная пачка пишется
+    в SQLite в отдельном потоке — event loop не ждет диска.
+    В clicks хранится первый клик пользователя по кнопке этапа и общее число кликов;
+    в счетчики A/B (ABStats) идут только уникальные клики — так CTR не растет от повторных нажатий.
+    Засчитываются только ссылки с верной подписью click_signature: этап, вариант и пользователь
+    в ссылке те, что выдал бот, а не подобранные вручную
+    """
+
+    def __init__(self, path: str = CLICKS_PATH, ab_stats_path: str = AB_STATS_PATH, base_url: str = BASE_URL,
+                 flush_interval: float = CLICK_FLUSH_INTERVAL, buffer_size: int = CLICK_BUFFER_SIZE,
+                 secret: str = TRACKING_SECRET):
+        if not secret:
+            raise ValueError("Не задан TRACKING_SECRET: без подписи ссылок клики можно подделать")
+        self.secret = secret
+        self.path = path
+        self.ab_stats_path = ab_stats_path
+        self.base_url = base_url
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.clicks = 0
+        self.unique = 0
+        self._buffer = []
+        # Один поток-писатель: соединения с базами создаются в нем и используются только им
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='clicks')
+        self._db = None
+        self._ab_stats = None
+        self._flushing = None
+        self._flusher = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        match = request.match_info
+        stage, variant = match['stage'], match['variant']
+        try:
+            telegram_id = int(match['user'])
+        except ValueError:
+            raise web.HTTPNotFound()
+        if stage not in STAGES or variant not in VARIANTS:
+            raise web.HTTPNotFound()
+        if not hmac.compare_digest(match['signature'], click_signature(stage, variant, telegram_id, self.secret)):
+            raise web.HTTPNotFound()
+
+        self._buffer.append((telegram_id, stage, variant, time.time()))
+        self.clicks += 1
+        if len(self._buffer) >= self.buffer_size:
+            self._start_flush()
+        return web.Response(status=302, headers={'Location': landing_url(stage, telegram_id, self.base_url)})
+
+    def _open(self):
+        self._db = connect(self.path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS clicks ('
+            'telegram_id INTEGER NOT NULL, stage TEXT NOT NULL, variant TEXT NOT NULL, '
+            'first_clicked_at REAL NOT NULL, count INTEGER NOT NULL, '
+            'PRIMARY KEY (telegram_id, stage))'
+        )
+        self._db.commit()
+        self._ab_stats = ABStats(self.ab_stats_path, flush_interval=float('inf'))
+
+    def _write(self, batch: list) -> int:
+        """Пишет пачку кликов (в потоке-писателе), возвращает число уникальных"""
+        if self._db is None:
+            self._open()
+        unique = 0
+        for telegram_id, stage, variant, clicked_at in batch:
+            cursor = self._db.execute(
+                'INSERT OR IGNORE INTO clicks (telegram_id, stage, variant, first_clicked_at, count) '
+                'VALUES (?, ?, ?, ?, 1)',
+                (telegram_id, stage, variant, clicked_at)
+            )
+            if cursor.rowcount:
+                unique += 1
+                self._ab_stats.record(stage, variant, 'click')
+            else:
+                self._db.execute('UPDATE clicks SET count = count + 1 WHERE telegram_id = ? AND stage = ?',
+                                 (telegram_id, stage))
+        self._db.commit()
+        self._ab_stats.flush()
+        return unique
+
+    def _start_flush(self):
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Сбрасывает накопленные клики; пачки пишутся строго по очереди"""
+        while self._buffer:
+            batch, self._buffer = self._buffer, []
+            loop = asyncio.get_running_loop()
+            self.unique += await loop.run_in_executor(self._writer, self._write, batch)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._start_flush()
+
+    async def _on_startup(self, app: web.Application):
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def _on_cleanup(self, app: web.Application):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        if self._flushing is not None:
+            await self._flushing
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._close_storage)
+        self._writer.shutdown(wait=True)
+
+    def _close_storage(self):
+        if self._db is not None:
+            self._db.close()
+            self._ab_stats.close()
+            self._db = self._ab_stats = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/c/{stage}/{variant}/{user}/{signature}', self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+
+def main():
+    """Основная функция"""
+    parser = argparse.ArgumentParser(description='Сервис учета кликов по кнопкам воронки')
+    parser.add_argument('--host', default=TRACKING_HOST, help=f'Адрес (по умолчанию {TRACKING_HOST})')
+    parser.add_argument('--port', type=int, default=TRACKING_PORT, help=f'Порт (по умолчанию {TRACKING_PORT})')
+    args = parser.parse_args()
+
+    if not TRACKING_SECRET:
+        print("❌ Задайте TRACKING_SECRET (тот же, что у бота): без него клики можно подделать")
+        sys.exit(1)
+    print(f"🖱️  Учет кликов: http://{args.host}:{args.port}/c/<stage>/<variant>/<telegram_id>/<подпись> → {BASE_URL}")
+    web.run_app(ClickTracker().make_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,26 @@ load_dotenv()
 # Токен бота из переменных окружения
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
+# Пул ботов (BOT_TOKENS через запятую): у каждого бота свой лимит Telegram, пользователи
+# делятся между ботами по хэшу telegram_id. Без BOT_TOKENS используется один BOT_TOKEN
+BOT_TOKENS = [token.strip() for token in os.getenv('BOT_TOKENS', '').split(',') if token.strip()] \
+    or ([BOT_TOKEN] if BOT_TOKEN else [])
+# Соль распределения пользователей по ботам: при ее смене пользователям напишут другие боты
+SHARD_SALT = 'bot-shard'
+# Адрес Bot API (по умолчанию api.telegram.org); для нагрузочных прогонов — fake_telegram.py
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
 # Этапы воронки
 STAGES = ['interest', 'solution', 'deadline']
 
 # Варианты для A/B-тестирования
 VARIANTS = ['a', 'b', 'c']
 
+# Режим --variant random: вариант = хэш (telegram_id + соль кампании), доли трафика по весам
+# Один и тот же пользователь всегда попадает в тот же вариант; новая соль — новое разбиение
+VARIANT_WEIGHTS = {'a': 1, 'b': 1, 'c': 1}
+CAMPAIGN_SALT = os.getenv('CAMPAIGN_SALT', 'poznay-sebya')
+
 # Брендинг Poznay Sebya
 BRAND = {
     'logo': 'POZNAY SEBYA / KNOW YOURSELF',
@@ -31,6 +45,9 @@ FONTS = {
     'body': 'Inter, sans-serif'
 }
 
+# Каталог с файлами шрифтов (.ttf/.otf); если семейства там нет, ищем в системных каталогах
+FONT_DIR = os.getenv('FONT_DIR', 'fonts')
+
 # Базовый URL для кнопок
 BASE_URL = 'https://poznaysebya.com'
 
@@ -38,5 +55,118 @@ BASE_URL = 'https://poznaysebya.com'
 IMAGE_WIDTH = 800
 IMAGE_HEIGHT = 600
 
-# Задержка между отправкой сообщений (секунды)
-SEND_DELAY = 1
+# Как часто (в секундах) проверять mtime шаблонов для перезагрузки; None — никогда
+TEMPLATE_CHECK_INTERVAL = 2.0
+
+# Рендеринг изображений
+# Бэкенд: 'pillow' — быстрый рендер по разметке этапа, 'weasyprint' — настоящая верстка HTML
+# (для 'weasyprint' нужны weasyprint с системными библиотеками и pypdfium2)
+RENDER_BACKEND = os.getenv('RENDER_BACKEND', 'pillow')
+# Сколько растрированных значений полей (имя, компания, роль) держать в LRU-кэше рендерера
+TEXT_RUN_CACHE_SIZE = 4096
+# Кодирование картинок: 'png', 'png-palette' (палитра из PALETTE_COLORS цветов), 'jpeg', 'webp'
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'png')
+# Сжатие PNG 0-9: меньше — быстрее кодирование, больше — меньше файл; optimize — еще меньше, но дольше
+PNG_COMPRESS_LEVEL = 6
+PNG_OPTIMIZE = False
+PALETTE_COLORS = 64
+JPEG_QUALITY = 85
+WEBP_QUALITY = 85
+# Число процессов для рендеринга PNG (None — по числу ядер)
+RENDER_WORKERS = None
+# Сколько пользователей может быть отрендерено заранее, впереди отправки
+RENDER_QUEUE_SIZE = 64
+
+# Сколько строк CSV читать за раз при потоковой загрузке пользователей
+USERS_CHUNK_SIZE = 50000
+
+# Каталог для локального состояния (кэши, журналы)
+STATE_DIR = os.getenv('STATE_DIR', 'state')
+# Режим журнала SQLite: WAL работает только в пределах одной машины; если STATE_DIR
+# на общем сетевом диске (воркеры на нескольких машинах), укажите DELETE
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+
+# Архив кампании (--archive): все картинки в одном файле с индексом смещений рядом (<путь>.idx)
+ARCHIVE_PATH = os.path.join('output', 'campaign.bin')
+
+# Кэш отрендеренных PNG: повторный запуск рендерит только измененные строки
+RENDER_CACHE_ENABLED = True
+RENDER_CACHE_DIR = os.path.join(STATE_DIR, 'render_cache')
+RENDER_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Кэш Telegram file_id: одинаковая картинка загружается один раз, дальше отправляется по file_id
+FILE_ID_CACHE_ENABLED = True
+FILE_ID_CACHE_PATH = os.path.join(STATE_DIR, 'file_ids.sqlite')
+# Сколько последних file_id держать (персональные картинки почти не повторяются, старые вытесняются)
+FILE_ID_CACHE_MAX_ENTRIES = 100000
+# Новые file_id фиксируются пачкой каждые N записей или каждые N секунд
+FILE_ID_COMMIT_EVERY = 200
+FILE_ID_COMMIT_INTERVAL = 0.5
+
+# Журнал отправок для --resume: пачка фиксируется каждые N записей или каждые N секунд
+JOURNAL_PATH = os.path.join(STATE_DIR, 'send_journal.sqlite')
+JOURNAL_COMMIT_EVERY = 200
+JOURNAL_COMMIT_INTERVAL = 0.5
+
+# Итоги A/B-теста: счетчики событий по (stage, variant), сброс в базу раз в N секунд
+AB_STATS_PATH = os.path.join(STATE_DIR, 'ab_stats.sqlite')
+AB_STATS_FLUSH_INTERVAL = 1.0
+
+# Учет кликов (click_tracker.py): если TRACKING_URL задан, кнопки ведут через сервис кликов
+TRACKING_URL = os.getenv('TRACKING_URL')
+# Секрет подписи ссылок (HMAC): сервис кликов засчитывает только ссылки, выданные ботом
+TRACKING_SECRET = os.getenv('TRACKING_SECRET', '')
+TRACKING_HOST = os.getenv('TRACKING_HOST', '127.0.0.1')
+TRACKING_PORT = int(os.getenv('TRACKING_PORT', '8080'))
+CLICKS_PATH = os.path.join(STATE_DIR, 'clicks.sqlite')
+# Клики копятся в памяти и пишутся пачкой раз в N секунд или при N кликах
+CLICK_FLUSH_INTERVAL = 1.0
+CLICK_BUFFER_SIZE = 5000
+
+# Воронка по расписанию (--schedule): пауза перед этапом, считая от предыдущего этапа (секунды)
+STAGE_DELAYS = {
+    'interest': 0,
+    'solution': 24 * 3600,
+    'deadline': 48 * 3600,
+}
+SCHEDULE_PATH = os.path.join(STATE_DIR, 'schedule.sqlite')
+# Тестовый прогон (--test --schedule) ничего не отправляет и ведёт свою очередь,
+# чтобы не сдвигать сроки боевой воронки
+SCHEDULE_TEST_PATH = os.path.join(STATE_DIR, 'schedule_test.sqlite')
+# Через сколько секунд повторить этап, который не удалось доставить
+SCHEDULE_RETRY_DELAY = 15 * 60
+
+# Метрики конвейера: прогресс печатается не чаще раза в PROGRESS_INTERVAL секунд,
+# гистограммы задержек пишутся в METRICS_PATH (формат Prometheus) раз в METRICS_INTERVAL секунд
+METRICS_PATH = os.getenv('METRICS_PATH', os.path.join(STATE_DIR, 'metrics.prom'))
+METRICS_INTERVAL = 10.0
+PROGRESS_INTERVAL = 2.0
+# Печатать строку на каждого пользователя и сообщение (медленно при больших рассылках)
+LOG_EACH_MESSAGE = os.getenv('LOG_EACH_MESSAGE', '0') == '1'
+
+# Распределенная рассылка: координатор (work_queue.py) делит CSV на аренды по LEASE_SIZE строк,
+# воркеры (bot_funnel.py --worker) забирают их и продлевают каждые LEASE_HEARTBEAT_INTERVAL секунд;
+# аренда без продления дольше LEASE_TIMEOUT секунд возвращается в очередь
+WORK_QUEUE_PATH = os.path.join(STATE_DIR, 'work_queue.sqlite')
+LEASE_SIZE = 5000
+# Воркер читает аренду кусками по N строк: потерянная аренда прекращается на границе куска
+LEASE_CHUNK_SIZE = 1000
+LEASE_HEARTBEAT_INTERVAL = 10.0
+LEASE_TIMEOUT = 60.0
+
+# Пропускная способность отправки
+# Глобальный лимит бота (Telegram допускает около 30 сообщений в секунду)
+MESSAGES_PER_SECOND = 25
+# Лимит на один чат (не больше одного сообщения в секунду)
+MESSAGES_PER_CHAT_PER_SECOND = 1
+# Сколько пользователей обрабатывается одновременно
+MAX_CONCURRENT_SENDS = 50
+
+# Повторы отправки: попытки при сетевых ошибках и 5xx (экспоненциальная задержка с джиттером)
+SEND_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# Сколько раз подряд ждать retry_after от Telegram, прежде чем сдаться
+FLOOD_MAX_RETRIES = 10
+# Пользователи, доставка которым невозможна (заблокировали бота и т.п.)
+DEAD_LETTER_PATH = os.path.join(STATE_DIR, 'dead_letters.jsonl')
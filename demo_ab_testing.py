@@ -46,27 +46,22 @@ def demo_csv_variants():
     print("\n📊 Анализ вариантов в CSV файле:")
     
     try:
-        with open('users.csv', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        from utils import iter_users
         
-        if len(lines) < 2:
+        # CSV читается pandas по кускам (кавычки и запятые в полях разбираются корректно)
+        variant_counts = {}
+        for chunk in iter_users('users.csv'):
+            for variant, count in chunk['variant'].value_counts(sort=False).items():
+                variant_counts[variant] = variant_counts.get(variant, 0) + int(count)
+        
+        total = sum(variant_counts.values())
+        if total == 0:
             print("❌ CSV файл пуст")
             return False
         
-        # Анализируем варианты
-        variants = []
-        for line in lines[1:]:
-            parts = line.strip().split(',')
-            if len(parts) >= 5:
-                variants.append(parts[4])
-        
-        variant_counts = {}
-        for variant in variants:
-            variant_counts[variant] = variant_counts.get(variant, 0) + 1
-        
         print("   Распределение вариантов:")
         for variant, count in variant_counts.items():
-            percentage = (count / len(variants)) * 100
+            percentage = (count / total) * 100
             print(f"   - Вариант {variant.upper()}: {count} пользователей ({percentage:.1f}%)")
         
         return True
@@ -76,6 +71,23 @@ def demo_csv_variants():
         return False
 
 
+def demo_ab_results():
+    """Показывает накопленные итоги рассылок: счетчики и значимость отличий вариантов"""
+    print("\n🧪 Итоги A/B-теста:")
+    
+    from config import AB_STATS_PATH
+    if not os.path.exists(AB_STATS_PATH):
+        print(f"   Пока нет данных ({AB_STATS_PATH} появится после первой рассылки с --send)")
+        return
+    
+    from analytics import ABStats, print_report
+    ab_stats = ABStats()
+    try:
+        print_report(ab_stats.snapshot())
+    finally:
+        ab_stats.close()
+
+
 def demo_branding():
     """Демонстрирует брендинг Poznay Sebya"""
     print("\n🎨 Брендинг Poznay Sebya:")
@@ -133,7 +145,8 @@ def demo_expected_output():
     print("   - Файлы: interest_a_123456789.png, solution_b_987654321.png, etc.")
     
     print("\n   При запуске --variant random:")
-    print("   - Каждый пользователь получит случайный вариант для каждого этапа")
+    print("   - Вариант пользователя выбирается по хэшу telegram_id и CAMPAIGN_SALT (доли — VARIANT_WEIGHTS)")
+    print("   - Повторный запуск назначит те же варианты")
     print("   - Статистика покажет распределение: {'a': 5, 'b': 6, 'c': 4}")
     
     print("\n   Структура PNG файлов:")
@@ -160,6 +173,7 @@ def main():
         # Показываем примеры использования
         demo_usage_examples()
         demo_expected_output()
+        demo_ab_results()
         
         print("\n" + "="*60)
         print("🎉 Система готова к A/B-тестированию!")
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Локальная замена Telegram Bot API для бенчмарков: задержка ответа, flood control (429 с retry_after)
+и заблокировавшие бота пользователи — без сети и без настоящего бота
+"""
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import random
+import sys
+import time
+from collections import deque
+
+from aiohttp import web
+
+# Добавляем текущую директорию в путь для импорта
+sys.path.append('.')
+
+from config import IMAGE_WIDTH, IMAGE_HEIGHT
+
+# Токен в формате Telegram (aiogram проверяет формат); id бота — число до двоеточия
+FAKE_TOKEN = '123456789:AAFakeTokenForLocalBenchmarksOnly0000'
+
+
+class FakeTelegramAPI:
+    """
+    Отвечает на sendPhoto как Telegram: загруженная картинка получает file_id, повторная отправка
+    по file_id не загружает файл. latency ± jitter — время ответа; больше rate_limit сообщений
+    за секунду или случайно с вероятностью flood_rate — 429 с retry_after;
+    blocked_rate — доля пользователей, заблокировавших бота (403)
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, rate_limit: int = 30,
+                 flood_rate: float = 0.0, retry_after: int = 1, blocked_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.blocked_rate = blocked_rate
+        self.random = random.Random(seed)
+        self.stats = {'requests': 0, 'sent': 0, 'uploads': 0, 'by_file_id': 0, 'flood': 0, 'blocked': 0}
+        self._recent = deque()
+        self._message_ids = itertools.count(1)
+
+    def _is_blocked(self, chat_id: int) -> bool:
+        # Один и тот же пользователь всегда либо заблокировал бота, либо нет
+        digest = hashlib.blake2b(str(chat_id).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') / 2 ** 64 < self.blocked_rate
+
+    def _over_limit(self) -> bool:
+        """Скользящее окно в одну секунду: лимит бота на число сообщений"""
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] >= 1.0:
+            self._recent.popleft()
+        if len(self._recent) >= self.rate_limit:
+            return True
+        self._recent.append(now)
+        return False
+
+    @staticmethod
+    def _error(code: int, description: str, **parameters) -> web.Response:
+        payload = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            payload['parameters'] = parameters
+        return web.json_response(payload, status=code)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.stats['requests'] += 1
+        method = request.match_info['method']
+        form = await request.post()
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+        if method.lower() != 'sendphoto':
+            return self._error(404, f"Not Found: method {method} is not supported by the fake API")
+
+        chat_id = int(form['chat_id'])
+        if self._over_limit() or self.random.random() < self.flood_rate:
+            self.stats['flood'] += 1
+            return self._error(429, f"Too Many Requests: retry after {self.retry_after}",
+                               retry_after=self.retry_after)
+        if self._is_blocked(chat_id):
+            self.stats['blocked'] += 1
+            return self._error(403, 'Forbidden: bot was blocked by the user')
+
+        photo = form['photo']
+        # Загружаемый файл приходит отдельной частью, а в photo — ссылка attach://<имя части>
+        if isinstance(photo, str) and photo.startswith('attach://'):
+            photo = form[photo[len('attach://'):]]
+        if isinstance(photo, str):
+            file_id = photo
+            self.stats['by_file_id'] += 1
+        else:
+            data = photo.file.read()
+            file_id = f"fake-{hashlib.sha256(data).hexdigest()[:32]}"
+            self.stats['uploads'] += 1
+        self.stats['sent'] += 1
+
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'photo': [{'file_id': file_id, 'file_unique_id': file_id[-16:],
+                       'width': IMAGE_WIDTH, 'height': IMAGE_HEIGHT}],
+        }
+        if 'caption' in form:
+            message['caption'] = form['caption']
+        return web.json_response({'ok': True, 'result': message})
+
+    def make_app(self) -> web.Application:
+        # Большие картинки приходят одним multipart-запросом
+        app = web.Application(client_max_size=50 * 1024 ** 2)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+
+def main():
+    """Основная функция"""
+    parser = argparse.ArgumentParser(description='Локальная замена Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05, help='Время ответа, с (по умолчанию 0.05)')
+    parser.add_argument('--rate-limit', type=int, default=30, help='Сообщений в секунду до 429 (по умолчанию 30)')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='Доля случайных 429 (по умолчанию 0)')
+    parser.add_argument('--blocked-rate', type=float, default=0.0, help='Доля заблокировавших бота (по умолчанию 0)')
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI(latency=args.latency, rate_limit=args.rate_limit, flood_rate=args.flood_rate,
+                          blocked_rate=args.blocked_rate)
+    print(f"🧪 Fake Telegram API: http://{args.host}:{args.port} "
+          f"(TELEGRAM_API_URL=http://{args.host}:{args.port}, BOT_TOKEN={FAKE_TOKEN})")
+    web.run_app(api.make_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Повторное использование Telegram file_id для одинаковых картинок
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+
+from aiogram import Bot
+from aiogram.types import FSInputFile
+from aiogram.types.input_file import InputFile
+from aiogram.exceptions import TelegramBadRequest
+
+from config import FILE_ID_CACHE_PATH, FILE_ID_CACHE_MAX_ENTRIES, FILE_ID_COMMIT_EVERY, FILE_ID_COMMIT_INTERVAL
+from storage import connect
+
+# Ошибки Telegram, означающие, что сам file_id больше не годится (в отличие от ошибок чата или подписи)
+FILE_ID_ERRORS = ('wrong file identifier', 'file reference', 'wrong remote file', 'file_id')
+
+
+def is_stale_file_id(error: TelegramBadRequest) -> bool:
+    """400 из-за file_id (устарел, чужой бот), а не из-за чата или параметров сообщения"""
+    description = (error.message or '').lower()
+    return any(marker in description for marker in FILE_ID_ERRORS)
+
+
+class FileIdCache:
+    """
+    Хранит file_id, который Telegram вернул при первой загрузке картинки с данным хэшем.
+    Следующие отправки той же картинки идут по file_id без multipart-загрузки.
+    file_id действителен только для бота, который его получил, поэтому ключ — (bot_id, digest).
+    При открытии в память загружаются max_entries самых свежих записей, остальные удаляются,
+    так что get не ходит в базу. Дальше это LRU в памяти: новые и вытесненные записи копятся
+    и фиксируются пачкой каждые commit_every изменений или commit_interval секунд
+    """
+
+    def __init__(self, path: str = FILE_ID_CACHE_PATH, max_entries: int = FILE_ID_CACHE_MAX_ENTRIES,
+                 commit_every: int = FILE_ID_COMMIT_EVERY, commit_interval: float = FILE_ID_COMMIT_INTERVAL):
+        self._db = connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS file_ids ('
+            'bot_id INTEGER NOT NULL, digest TEXT NOT NULL, file_id TEXT NOT NULL, created_at REAL NOT NULL, '
+            'PRIMARY KEY (bot_id, digest))'
+        )
+        self._db.execute(
+            'DELETE FROM file_ids WHERE rowid NOT IN '
+            '(SELECT rowid FROM file_ids ORDER BY created_at DESC, rowid DESC LIMIT ?)', (max_entries,)
+        )
+        self._db.commit()
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._memory = OrderedDict(
+            ((bot_id, digest), file_id) for bot_id, digest, file_id in
+            self._db.execute('SELECT bot_id, digest, file_id FROM file_ids ORDER BY created_at, rowid')
+        )
+        # Несохраненные изменения: (bot_id, digest) -> (file_id, время) или None для удаления
+        self._changes = {}
+        self._last_commit = time.monotonic()
+        # Загрузки, которые уже идут: остальные отправки той же картинки ждут их file_id
+        self._pending = {}
+        self.uploads = 0
+        self.reused = 0
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    def get(self, bot_id: int, digest: str):
+        key = (bot_id, digest)
+        file_id = self._memory.get(key)
+        if file_id is not None:
+            self._memory.move_to_end(key)
+        return file_id
+
+    def put(self, bot_id: int, digest: str, file_id: str):
+        key = (bot_id, digest)
+        self._memory[key] = file_id
+        self._memory.move_to_end(key)
+        self._change(key, (file_id, time.time()))
+        while len(self._memory) > self.max_entries:
+            self._change(self._memory.popitem(last=False)[0], None)
+
+    def forget(self, bot_id: int, digest: str):
+        key = (bot_id, digest)
+        self._memory.pop(key, None)
+        self._change(key, None)
+
+    def _change(self, key: tuple, value):
+        self._changes[key] = value
+        if (len(self._changes) >= self.commit_every
+                or time.monotonic() - self._last_commit >= self.commit_interval):
+            self.flush()
+
+    def flush(self):
+        if self._changes:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO file_ids (bot_id, digest, file_id, created_at) VALUES (?, ?, ?, ?)',
+                [(*key, *value) for key, value in self._changes.items() if value is not None]
+            )
+            self._db.executemany(
+                'DELETE FROM file_ids WHERE bot_id = ? AND digest = ?',
+                [key for key, value in self._changes.items() if value is None]
+            )
+            self._db.commit()
+            self._changes = {}
+        self._last_commit = time.monotonic()
+
+    async def send_photo(self, bot: Bot, chat_id: int, photo, digest: str, **kwargs):
+        """
+        bot.send_photo, который загружает картинку только если ее file_id еще неизвестен
+        photo — путь к PNG или уже готовый InputFile (например, картинка из архива кампании)
+        """
+        key = (bot.id, digest)
+
+        file_id = self.get(*key)
+        if file_id is None and key in self._pending:
+            file_id = await asyncio.shield(self._pending[key])
+
+        if file_id is not None:
+            try:
+                message = await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+                self.reused += 1
+                return message
+            except TelegramBadRequest as e:
+                # Остальные 400 (чат не найден и т.п.) к картинке не относятся: file_id остается в кэше
+                if not is_stale_file_id(e):
+                    raise
+                # file_id устарел или принадлежит другому боту — загружаем заново
+                self.forget(*key)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._pending[key] = waiter
+        file_id = None
+        try:
+            message = await bot.send_photo(chat_id=chat_id, photo=photo if isinstance(photo, InputFile) else FSInputFile(photo), **kwargs)
+            self.uploads += 1
+            if message is not None and message.photo:
+                file_id = message.photo[-1].file_id
+                self.put(bot.id, digest, file_id)
+            return message
+        finally:
+            # Ожидающие получают file_id или None (и тогда загружают сами)
+            waiter.set_result(file_id)
+            if self._pending.get(key) is waiter:
+                del self._pending[key]
+
+    def close(self):
+        self.flush()
+        self._db.close()
@@ -0,0 +1,128 @@
+"""
+Поиск и кэширование шрифтов для PNG рендерера
+"""
+
+import os
+import re
+import sys
+from pathlib import Path
+
+from PIL import ImageFont
+
+from config import FONTS, FONT_DIR
+
+
+# Системные каталоги со шрифтами (используются после FONT_DIR)
+SYSTEM_FONT_DIRS = [
+    '/usr/share/fonts',
+    '/usr/local/share/fonts',
+    str(Path.home() / '.fonts'),
+    str(Path.home() / '.local/share/fonts'),
+    '/Library/Fonts',
+    '/System/Library/Fonts',
+    str(Path.home() / 'Library/Fonts'),
+    'C:\\Windows\\Fonts',
+]
+
+# Чем заменить семейство, если его нет ни в FONT_DIR, ни в системе
+GENERIC_FALLBACKS = {
+    'serif': ['DejaVu Serif', 'Liberation Serif', 'Noto Serif', 'Times New Roman', 'Georgia'],
+    'sans-serif': ['DejaVu Sans', 'Liberation Sans', 'Noto Sans', 'Arial', 'Helvetica'],
+}
+
+FONT_EXTENSIONS = ('.ttf', '.otf', '.ttc')
+
+
+def _normalize(name: str) -> str:
+    return re.sub(r'[\s_\-]+', '', name).lower()
+
+
+def _file_score(stem: str, family: str) -> int:
+    """Чем меньше, тем лучше: предпочитаем обычное начертание жирному и курсиву"""
+    rest = _normalize(stem)[len(family):]
+    if rest in ('', 'regular') or rest.startswith('['):
+        return 0
+    if 'italic' in rest or 'oblique' in rest:
+        return 3
+    if any(weight in rest for weight in ('bold', 'black', 'heavy', 'light', 'thin')):
+        return 2
+    return 1
+
+
+class FontManager:
+    """
+    Находит файлы шрифтов по имени семейства один раз и кэширует FreeTypeFont по (семейство, размер)
+    Семейства задаются как в CSS: 'Inter, sans-serif' — берется первое найденное
+    """
+
+    def __init__(self, font_dirs: list = None):
+        self.font_dirs = [d for d in (font_dirs or [FONT_DIR] + SYSTEM_FONT_DIRS) if d and os.path.isdir(d)]
+        self._index = None
+        self._paths = {}
+        self._fonts = {}
+
+    def _scan(self) -> dict:
+        """Индекс нормализованное_имя_файла -> путь по всем каталогам (первый каталог важнее)"""
+        if self._index is None:
+            self._index = {}
+            for font_dir in self.font_dirs:
+                for root, _, files in os.walk(font_dir):
+                    for file_name in sorted(files):
+                        if file_name.lower().endswith(FONT_EXTENSIONS):
+                            self._index.setdefault(_normalize(Path(file_name).stem), os.path.join(root, file_name))
+        return self._index
+
+    def _find_family(self, family: str):
+        key = _normalize(family)
+        candidates = [(stem, path) for stem, path in self._scan().items() if stem.startswith(key)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda item: (_file_score(item[0], key), item[0]))[1]
+
+    def resolve(self, families: str):
+        """Путь к файлу шрифта для CSS-списка семейств или None, если ничего не нашлось"""
+        if families in self._paths:
+            return self._paths[families]
+
+        path = None
+        for family in (f.strip().strip('"\'') for f in families.split(',')):
+            for name in GENERIC_FALLBACKS.get(family.lower(), [family]):
+                path = self._find_family(name)
+                if path:
+                    break
+            if path:
+                break
+
+        if path is None:
+            print(f"⚠️  Шрифт '{families}' не найден, используется встроенный шрифт Pillow", file=sys.stderr)
+        self._paths[families] = path
+        return path
+
+    def get(self, families: str, size: int) -> ImageFont.FreeTypeFont:
+        """Шрифт нужного размера; повторные вызовы возвращают тот же объект"""
+        key = (families, size)
+        font = self._fonts.get(key)
+        if font is None:
+            path = self.resolve(families)
+            if path:
+                font = ImageFont.truetype(path, size)
+            else:
+                font = ImageFont.load_default(size=size)
+            self._fonts[key] = font
+        return font
+
+
+_font_manager = None
+
+
+def get_font_manager() -> FontManager:
+    """Общий для процесса менеджер шрифтов"""
+    global _font_manager
+    if _font_manager is None:
+        _font_manager = FontManager()
+    return _font_manager
+
+
+def get_font(role: str, size: int) -> ImageFont.FreeTypeFont:
+    """Шрифт по роли из config.FONTS ('heading', 'body') или по CSS-списку семейств"""
+    return get_font_manager().get(FONTS.get(role, role), size)
@@ -0,0 +1,169 @@
+"""
+Архив изображений кампании: один файл с PNG подряд и индекс смещений вместо миллионов отдельных файлов
+"""
+
+import hashlib
+import mmap
+import os
+
+from aiogram.types.input_file import InputFile
+
+from config import ARCHIVE_PATH
+from storage import connect
+
+
+def index_path(path: str) -> str:
+    return f"{path}.idx"
+
+
+def sniff_extension(data) -> str:
+    """Расширение файла по сигнатуре: архив мог быть собран с другим IMAGE_FORMAT, чем текущий"""
+    head = bytes(data[:12])
+    if head.startswith(b'\xff\xd8'):
+        return '.jpg'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return '.webp'
+    return '.png'
+
+
+def _open_index(path: str):
+    db = connect(index_path(path))
+    # blobs — где лежит картинка с данным хэшем, images — какая картинка у пользователя на этапе
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS blobs ('
+        'digest TEXT PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL)'
+    )
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS images ('
+        'telegram_id INTEGER NOT NULL, stage TEXT NOT NULL, variant TEXT NOT NULL, digest TEXT NOT NULL, '
+        'PRIMARY KEY (telegram_id, stage))'
+    )
+    db.commit()
+    return db
+
+
+class ImageArchiveWriter:
+    """
+    Дописывает картинки в конец файла архива (пишет только один процесс — основной)
+    Одинаковые картинки хранятся один раз. Индекс фиксируется пачками и только после того,
+    как данные пачки дошли до диска; хвост без индекса (после сбоя) обрезается при открытии
+    """
+
+    COMMIT_EVERY = 500
+
+    def __init__(self, path: str = ARCHIVE_PATH):
+        self.path = path
+        self._db = _open_index(path)
+        self._blobs = {
+            digest: (offset, length)
+            for digest, offset, length in self._db.execute('SELECT digest, offset, length FROM blobs')
+        }
+        self._end = max((offset + length for offset, length in self._blobs.values()), default=0)
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self._file.truncate(self._end)
+        self._file.seek(self._end)
+        self._pending_blobs = []
+        self._pending_images = []
+        self.written = 0
+        self.deduplicated = 0
+
+    def append(self, telegram_id: int, stage: str, variant: str, data: bytes, digest: str = None) -> str:
+        """Добавляет картинку пользователя для этапа, возвращает sha256 ее содержимого"""
+        digest = digest or hashlib.sha256(data).hexdigest()
+        if digest in self._blobs:
+            self.deduplicated += 1
+        else:
+            self._file.write(data)
+            self._blobs[digest] = (self._end, len(data))
+            self._pending_blobs.append((digest, self._end, len(data)))
+            self._end += len(data)
+            self.written += 1
+        self._pending_images.append((telegram_id, stage, variant, digest))
+        if len(self._pending_images) >= self.COMMIT_EVERY:
+            self.flush()
+        return digest
+
+    def flush(self):
+        if not self._pending_images:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._db.executemany('INSERT OR REPLACE INTO blobs (digest, offset, length) VALUES (?, ?, ?)',
+                             self._pending_blobs)
+        self._db.executemany('INSERT OR REPLACE INTO images (telegram_id, stage, variant, digest) VALUES (?, ?, ?, ?)',
+                             self._pending_images)
+        self._db.commit()
+        self._pending_blobs = []
+        self._pending_images = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        self._db.close()
+
+
+class ArchiveInputFile(InputFile):
+    """Картинка из архива для bot.send_photo: отдается срезами mmap без копирования в память"""
+
+    def __init__(self, view: memoryview, filename: str):
+        super().__init__(filename=filename)
+        self.view = view
+
+    async def read(self, bot):
+        for start in range(0, len(self.view), self.chunk_size):
+            yield self.view[start:start + self.chunk_size]
+
+
+class ImageArchive:
+    """
+    Чтение архива: файл отображается в память (mmap), картинка — срез по смещению из индекса.
+    Не нужно открывать файлы и обходить каталоги: одна файловая запись на всю кампанию
+    """
+
+    def __init__(self, path: str = ARCHIVE_PATH):
+        if not os.path.exists(path) or not os.path.exists(index_path(path)):
+            raise FileNotFoundError(f"Архив изображений не найден: {path}")
+        self.path = path
+        self._db = _open_index(path)
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        # mmap не умеет отображать пустой файл
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._view = memoryview(self._map) if self._map is not None else memoryview(b'')
+
+    def __len__(self) -> int:
+        return self._db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def lookup(self, telegram_id: int) -> dict:
+        """Картинки пользователя: {stage: (variant, digest, memoryview)}"""
+        rows = self._db.execute(
+            'SELECT images.stage, images.variant, images.digest, blobs.offset, blobs.length '
+            'FROM images JOIN blobs ON blobs.digest = images.digest WHERE images.telegram_id = ?',
+            (telegram_id,)
+        )
+        return {
+            stage: (variant, digest, self._view[offset:offset + length])
+            for stage, variant, digest, offset, length in rows
+        }
+
+    def read(self, telegram_id: int, stage: str):
+        """Содержимое PNG (memoryview) или None, если картинки нет в архиве"""
+        found = self.lookup(telegram_id).get(stage)
+        return found[2] if found else None
+
+    def close(self):
+        self._db.close()
+        self._view.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # На срезы еще ссылаются неотправленные сообщения — mmap закроется вместе с ними
+                pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
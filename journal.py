@@ -0,0 +1,86 @@
+"""
+Журнал отправок: позволяет продолжить прерванную рассылку без повторных сообщений
+"""
+
+import time
+
+from config import STAGES, JOURNAL_PATH, JOURNAL_COMMIT_EVERY, JOURNAL_COMMIT_INTERVAL
+from storage import connect
+
+# Маска пользователя, который прошел все этапы
+ALL_STAGES_MASK = (1 << len(STAGES)) - 1
+
+
+def stage_bit(stage: str) -> int:
+    return 1 << STAGES.index(stage)
+
+
+class SendJournal:
+    """
+    Журнал доставленных сообщений (telegram_id, stage, variant) в SQLite (WAL)
+    Записи копятся в памяти и фиксируются пачкой — каждые commit_every записей
+    или commit_interval секунд; при сбое теряется не больше одной пачки
+    """
+
+    # Сколько telegram_id проверять одним запросом (лимит параметров SQLite)
+    LOOKUP_BATCH = 900
+
+    def __init__(self, path: str = JOURNAL_PATH, commit_every: int = JOURNAL_COMMIT_EVERY,
+                 commit_interval: float = JOURNAL_COMMIT_INTERVAL):
+        self._db = connect(path)
+        # Журнал важнее скорости: коммит пачки доходит до диска
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sends ('
+            'telegram_id INTEGER NOT NULL, stage TEXT NOT NULL, variant TEXT NOT NULL, sent_at REAL NOT NULL, '
+            'PRIMARY KEY (telegram_id, stage))'
+        )
+        self._db.commit()
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._pending = []
+        self._last_commit = time.monotonic()
+
+    def completed(self, telegram_ids=None) -> dict:
+        """
+        Уже доставленные этапы: {telegram_id: битовая маска этапов из STAGES}
+        Загружается один раз, дальше проверка строки — O(1) поиск в словаре
+        telegram_ids — загрузить только этих пользователей (кусок аренды воркера)
+        """
+        if telegram_ids is None:
+            rows = self._db.execute('SELECT telegram_id, stage FROM sends')
+        else:
+            telegram_ids = [int(telegram_id) for telegram_id in telegram_ids]
+            rows = []
+            for start in range(0, len(telegram_ids), self.LOOKUP_BATCH):
+                batch = telegram_ids[start:start + self.LOOKUP_BATCH]
+                rows += self._db.execute(
+                    f"SELECT telegram_id, stage FROM sends WHERE telegram_id IN ({', '.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+        done = {}
+        for telegram_id, stage in rows:
+            if stage in STAGES:
+                done[telegram_id] = done.get(telegram_id, 0) | stage_bit(stage)
+        return done
+
+    def record(self, telegram_id: int, stage: str, variant: str):
+        """Отмечает сообщение доставленным"""
+        self._pending.append((telegram_id, stage, variant, time.time()))
+        if (len(self._pending) >= self.commit_every
+                or time.monotonic() - self._last_commit >= self.commit_interval):
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO sends (telegram_id, stage, variant, sent_at) VALUES (?, ?, ?, ?)',
+                self._pending
+            )
+            self._db.commit()
+            self._pending = []
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._db.close()
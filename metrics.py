@@ -0,0 +1,198 @@
+"""
+Метрики конвейера: гистограммы задержек по операциям, этапам и вариантам,
+периодический прогресс и экспорт в текстовом формате Prometheus
+"""
+
+import bisect
+import os
+import time
+from contextlib import contextmanager
+
+from config import METRICS_PATH, METRICS_INTERVAL, PROGRESS_INTERVAL
+
+# Операции конвейера в порядке прохождения сообщения
+OPERATIONS = ('load_users', 'render_html', 'html_to_png', 'get_keyboard', 'send_photo')
+
+# Верхние границы корзин гистограммы (секунды): от 0.1 мс до ~100 с с шагом ×2
+BUCKETS = tuple(0.0001 * 2 ** i for i in range(21))
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами: O(1) памяти на серию при любом числе наблюдений,
+    квантили — интерполяцией внутри корзины (точность — в пределах шага корзины)
+    """
+    __slots__ = ('counts', 'count', 'sum', 'errors')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds: float, error: bool = False):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if index == len(BUCKETS):
+                    return BUCKETS[-1]
+                lower = BUCKETS[index - 1] if index else 0.0
+                return lower + (BUCKETS[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return BUCKETS[-1]
+
+
+class Metrics:
+    """
+    Серии (операция, этап, вариант) -> Histogram
+    Рендеринг идет в процессах пула, поэтому его задержки приходят в RenderResult.timings
+    и добавляются сюда в основном процессе через observe
+    """
+
+    def __init__(self):
+        self.series = {}
+        self.started = time.monotonic()
+
+    def observe(self, operation: str, seconds: float, stage: str = '', variant: str = '', error: bool = False):
+        key = (operation, stage, variant)
+        histogram = self.series.get(key)
+        if histogram is None:
+            histogram = self.series[key] = Histogram()
+        histogram.observe(seconds, error)
+
+    @contextmanager
+    def timer(self, operation: str, stage: str = '', variant: str = ''):
+        """Замеряет блок кода; исключение учитывается как ошибка операции и пробрасывается дальше"""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(operation, time.perf_counter() - start, stage, variant, error=True)
+            raise
+        self.observe(operation, time.perf_counter() - start, stage, variant)
+
+    def timed_iter(self, iterable, operation: str):
+        """Итератор, который замеряет получение каждого элемента (чтение кусков CSV)"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(operation, time.perf_counter() - start)
+            yield item
+
+    def merged(self, operation: str) -> Histogram:
+        """Гистограмма операции по всем этапам и вариантам"""
+        total = Histogram()
+        for (name, _, _), histogram in self.series.items():
+            if name == operation:
+                total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+                total.count += histogram.count
+                total.sum += histogram.sum
+                total.errors += histogram.errors
+        return total
+
+    def _sorted(self):
+        order = {operation: index for index, operation in enumerate(OPERATIONS)}
+        return sorted(self.series.items(), key=lambda item: (order.get(item[0][0], len(order)), item[0]))
+
+    def print_summary(self):
+        """Таблица по сериям: число, пропускная способность, p50/p95/p99 и ошибки"""
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        print("⏱️  Задержки по операциям (мс):")
+        print(f"   {'операция':<13} {'этап':<9} {'вар.':<4} {'число':>8} {'в сек':>8} "
+              f"{'p50':>8} {'p95':>8} {'p99':>8} {'ошибки':>7}")
+        for (operation, stage, variant), histogram in self._sorted():
+            print(f"   {operation:<13} {stage or '-':<9} {variant.upper() or '-':<4} {histogram.count:>8} "
+                  f"{histogram.count / elapsed:>8.1f} "
+                  + ' '.join(f"{histogram.quantile(q) * 1000:>8.1f}" for q in (0.5, 0.95, 0.99))
+                  + f" {histogram.errors:>7}")
+
+    def to_prometheus(self) -> str:
+        """Текстовый формат Prometheus (для node_exporter textfile collector)"""
+        lines = [
+            '# HELP funnel_operation_seconds Latency of funnel pipeline operations',
+            '# TYPE funnel_operation_seconds histogram',
+        ]
+        series = self._sorted()
+        for (operation, stage, variant), histogram in series:
+            labels = f'operation="{operation}",stage="{stage}",variant="{variant}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'funnel_operation_seconds_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+            lines.append(f'funnel_operation_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'funnel_operation_seconds_sum{{{labels}}} {histogram.sum:.6f}')
+            lines.append(f'funnel_operation_seconds_count{{{labels}}} {histogram.count}')
+        lines.append('# HELP funnel_operation_errors_total Failed funnel pipeline operations')
+        lines.append('# TYPE funnel_operation_errors_total counter')
+        for (operation, stage, variant), histogram in series:
+            labels = f'operation="{operation}",stage="{stage}",variant="{variant}"'
+            lines.append(f'funnel_operation_errors_total{{{labels}}} {histogram.errors}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str = METRICS_PATH):
+        """Записывает файл целиком и подменяет старый: сборщик не увидит недописанный файл"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+_metrics = None
+
+
+def get_metrics() -> Metrics:
+    """
+    Возвращает общие для процесса метрики: шарды одного процесса пишут в одни серии
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+class ProgressReporter:
+    """
+    Прогресс не чаще раза в interval секунд вместо строки на каждое сообщение;
+    файл метрик переписывается не чаще раза в export_interval секунд
+    """
+
+    def __init__(self, metrics: Metrics, path: str = METRICS_PATH, interval: float = PROGRESS_INTERVAL,
+                 export_interval: float = METRICS_INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.export_interval = export_interval
+        self.started = time.monotonic()
+        self._last_print = self.started
+        self._last_export = self.started
+
+    def update(self, processed: int, total: int = None):
+        now = time.monotonic()
+        if now - self._last_print >= self.interval:
+            self._last_print = now
+            rate = processed / (now - self.started)
+            print(f"Прогресс: {processed}/{total or '?'} ({rate:.1f} сообщений/с)")
+        if self.path and now - self._last_export >= self.export_interval:
+            self._last_export = now
+            self.metrics.write_prometheus(self.path)
+
+    def close(self):
+        if self.path:
+            self.metrics.write_prometheus(self.path)
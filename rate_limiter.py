@@ -0,0 +1,94 @@
+"""
+Ограничение скорости отправки сообщений (token bucket)
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Классический token bucket: пополняется со скоростью rate токенов в секунду,
+    вмещает не более capacity токенов
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError(f"Скорость должна быть положительной: {rate}")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def is_idle(self) -> bool:
+        """Ведро полное, не на паузе и никто его не ждёт — его можно безопасно выбросить"""
+        self._refill()
+        return (self._tokens >= self.capacity and not self._lock.locked()
+                and self._paused_until <= time.monotonic())
+
+    def pause(self, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд (например, по retry_after от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Ждёт, пока в ведре появится токен, и забирает его"""
+        # Лок сохраняет порядок ожидающих (FIFO) и не даёт им просыпаться толпой
+        async with self._lock:
+            while True:
+                paused = self._paused_until - time.monotonic()
+                if paused > 0:
+                    await asyncio.sleep(paused)
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RateLimiter:
+    """
+    Глобальный лимит сообщений в секунду плюс отдельный лимит на каждый чат
+    """
+
+    # Сколько чатов держим в памяти, прежде чем вычищать простаивающие вёдра
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate: float, per_chat_rate: float):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self._chat_buckets = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self._prune()
+            bucket = TokenBucket(self.per_chat_rate, capacity=1)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune(self):
+        idle = [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.is_idle()]
+        for chat_id in idle:
+            del self._chat_buckets[chat_id]
+
+    def pause(self, seconds: float, chat_id: int = None):
+        """Приостанавливает отправку в один чат или, если chat_id не задан, всю отправку"""
+        if chat_id is None:
+            self.global_bucket.pause(seconds)
+        else:
+            self._chat_bucket(chat_id).pause(seconds)
+
+    async def acquire(self, chat_id: int):
+        """Ждёт разрешения на отправку одного сообщения в чат chat_id"""
+        # Сначала лимит чата, чтобы не занимать глобальный токен впустую
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
@@ -0,0 +1,209 @@
+"""
+Контентно-адресуемый кэш PNG: повторный запуск не рендерит неизмененные изображения
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from config import BRAND, FONTS, IMAGE_WIDTH, IMAGE_HEIGHT, RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES
+from renderer import image_extension
+from storage import connect
+
+# Меняется, когда меняется сам способ рендеринга, — старые записи перестают совпадать
+CACHE_FORMAT_VERSION = 1
+
+# Поля пользователя, от которых зависит картинка
+USER_FIELDS = ('name', 'role', 'company')
+
+
+def make_key(stage: str, variant: str, user_data: dict, template_source: str, backend: str,
+             layout=None, encoding: dict = None) -> str:
+    """
+    Ключ кэша — хэш всего, от чего зависит картинка:
+    исходник шаблона (и разметка для pillow), брендинг, шрифты, размер, формат и сжатие, поля пользователя
+    """
+    payload = json.dumps(
+        [
+            CACHE_FORMAT_VERSION, stage, variant, backend, template_source, layout, encoding,
+            BRAND, FONTS, [IMAGE_WIDTH, IMAGE_HEIGHT],
+            [str(user_data.get(field, '')) for field in USER_FIELDS],
+        ],
+        ensure_ascii=False, sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _place(src: str, dest: str):
+    """Кладет файл src по пути dest жесткой ссылкой (или копией, если ссылки недоступны)"""
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+class RenderCache:
+    """
+    Файлы лежат в cache_dir/<первые 2 символа ключа>/<ключ><расширение формата>,
+    индекс (размер и время последнего использования) — в SQLite рядом.
+    При превышении max_bytes вытесняются давно не использовавшиеся записи (LRU).
+    Попадания не пишут в базу: время использования копится в памяти и сбрасывается
+    вместе с записью новой картинки, перед вытеснением, раз в TOUCH_FLUSH_EVERY попаданий
+    или TOUCH_FLUSH_INTERVAL секунд — процессы пула не ждут друг друга на каждом попадании
+    """
+
+    # Как часто (в записях) сверять фактический размер кэша с лимитом
+    EVICT_CHECK_EVERY = 100
+    # Как часто сбрасывать накопленное время использования
+    TOUCH_FLUSH_EVERY = 500
+    TOUCH_FLUSH_INTERVAL = 5.0
+
+    def __init__(self, cache_dir: str = RENDER_CACHE_DIR, max_bytes: int = RENDER_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._stores = 0
+        self._db = connect(os.path.join(cache_dir, 'index.sqlite'))
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        self._db.commit()
+        self._extension = image_extension()
+        self._touched = {}
+        self._last_flush = time.monotonic()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}{self._extension}")
+
+    def _touch(self, key: str):
+        self._touched[key] = time.time()
+        if (len(self._touched) >= self.TOUCH_FLUSH_EVERY
+                or time.monotonic() - self._last_flush >= self.TOUCH_FLUSH_INTERVAL):
+            self.flush()
+
+    def _write_touched(self):
+        if self._touched:
+            self._db.executemany('UPDATE entries SET last_used = ? WHERE key = ?',
+                                 [(last_used, key) for key, last_used in self._touched.items()])
+            self._touched = {}
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        """Записывает накопленное время использования одной транзакцией"""
+        if self._touched:
+            self._write_touched()
+            self._db.commit()
+
+    def fetch(self, key: str, dest_path: str) -> bool:
+        """Если картинка есть в кэше — кладет ее в dest_path и возвращает True"""
+        path = self._path(key)
+        row = self._db.execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None or not os.path.exists(path):
+            self.misses += 1
+            return False
+
+        _place(path, dest_path)
+        self._touch(key)
+        self.hits += 1
+        return True
+
+    def read(self, key: str):
+        """Содержимое картинки из кэша или None"""
+        path = self._path(key)
+        row = self._db.execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone()
+        try:
+            if row is None:
+                raise FileNotFoundError(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self._touch(key)
+        self.hits += 1
+        return data
+
+    def store(self, key: str, src_path: str):
+        """Сохраняет только что отрендеренный файл под ключом key"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _place(src_path, path)
+        self._index(key, path)
+
+    def store_data(self, key: str, data: bytes):
+        """Сохраняет отрендеренную в памяти картинку под ключом key"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self._index(key, path)
+
+    def _index(self, key: str, path: str):
+        self._touched.pop(key, None)
+        self._write_touched()
+        self._db.execute(
+            'INSERT OR REPLACE INTO entries (key, size, last_used) VALUES (?, ?, ?)',
+            (key, os.path.getsize(path), time.time())
+        )
+        self._db.commit()
+
+        self._stores += 1
+        if self._stores % self.EVICT_CHECK_EVERY == 0:
+            self.evict()
+
+    def size(self) -> int:
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self):
+        """Удаляет самые старые записи, пока кэш не уложится в 90% лимита"""
+        self.flush()
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+
+        target = self.max_bytes * 0.9
+        rows = self._db.execute('SELECT key, size FROM entries ORDER BY last_used')
+        evicted = []
+        for key, size in rows:
+            if total <= target:
+                break
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+            evicted.append((key,))
+            total -= size
+
+        self._db.executemany('DELETE FROM entries WHERE key = ?', evicted)
+        self._db.commit()
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+_render_cache = None
+_render_cache_pid = None
+
+
+def get_render_cache() -> RenderCache:
+    """
+    Кэш текущего процесса; после fork процесс пула открывает собственное соединение с индексом
+    """
+    global _render_cache, _render_cache_pid
+    if _render_cache is None or _render_cache_pid != os.getpid():
+        _render_cache = RenderCache()
+        _render_cache_pid = os.getpid()
+    return _render_cache
@@ -0,0 +1,117 @@
+"""
+Пул процессов для рендеринга PNG отдельно от отправки
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import render_html, html_to_png, html_to_png_bytes, get_template_registry
+from renderer import get_renderer, encode_options, image_extension, LAYOUT_STYLES
+from render_cache import get_render_cache, make_key
+from config import STAGES, RENDER_WORKERS, RENDER_BACKEND, RENDER_CACHE_ENABLED
+
+
+def init_worker():
+    """Прогревает кэши процесса пула один раз при его старте (шаблоны, шрифты)"""
+    get_template_registry()
+    get_renderer()
+
+
+# Результат рендеринга одного этапа; cached — картинка взята из кэша без рендеринга,
+# digest — sha256 содержимого PNG (одинаковые картинки отправляются по одному file_id),
+# photo — содержимое картинки, если ее нет на диске (bytes из пула или срез архива кампании),
+# timings — {операция: секунды} для render_html и html_to_png (замеры из процесса пула)
+RenderResult = namedtuple('RenderResult', 'stage png_path error cached digest photo timings', defaults=(None, None))
+
+
+def timed(timings: dict, operation: str, func, *args):
+    """Вызывает func(*args) и записывает время вызова в timings[operation] (и при исключении)"""
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings[operation] = time.perf_counter() - start
+
+
+def file_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def render_user(user_data: dict, chat_id: int, variant: str, output_dir: str,
+                use_cache: bool = RENDER_CACHE_ENABLED, stages: list = None) -> list:
+    """
+    Рендерит этапы воронки (по умолчанию все) для одного пользователя (выполняется в процессе пула)
+    output_dir=None — PNG не пишутся на диск, а возвращаются в RenderResult.photo (для архива кампании)
+    Возвращает список RenderResult в порядке этапов
+    """
+    registry = get_template_registry()
+    cache = get_render_cache() if use_cache else None
+    
+    results = []
+    for stage in stages or STAGES:
+        timings = {}
+        try:
+            key = None
+            if cache is not None:
+                layout = LAYOUT_STYLES if RENDER_BACKEND == 'pillow' else None
+                key = make_key(stage, variant, user_data, registry.source(stage, variant), RENDER_BACKEND,
+                               layout, encode_options())
+            
+            if output_dir is None:
+                data = cache.read(key) if key is not None else None
+                cached = data is not None
+                if not cached:
+                    html_content = timed(timings, 'render_html', render_html, stage, variant, user_data)
+                    data = timed(timings, 'html_to_png', html_to_png_bytes, html_content, f"{stage}_{variant}", user_data)
+                    if key is not None:
+                        cache.store_data(key, data)
+                results.append(RenderResult(stage, None, None, cached, hashlib.sha256(data).hexdigest(), data, timings))
+                continue
+            
+            png_path = os.path.join(output_dir, f"{stage}_{variant}_{chat_id}{image_extension()}")
+            if key is not None and cache.fetch(key, png_path):
+                results.append(RenderResult(stage, png_path, None, True, file_digest(png_path), None, timings))
+                continue
+            
+            html_content = timed(timings, 'render_html', render_html, stage, variant, user_data)
+            png_path = timed(timings, 'html_to_png', html_to_png, html_content, f"{stage}_{variant}", chat_id,
+                             output_dir, user_data)
+            if key is not None:
+                cache.store(key, png_path)
+            results.append(RenderResult(stage, png_path, None, False, file_digest(png_path), None, timings))
+        except Exception as e:
+            results.append(RenderResult(stage, None, str(e), False, None, None, timings))
+    return results
+
+
+class RenderPool:
+    """
+    Обертка над ProcessPoolExecutor: рендеринг идет на всех ядрах,
+    а event loop остается свободным для сетевого I/O
+    """
+
+    def __init__(self, workers: int = RENDER_WORKERS):
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
+
+    def submit(self, user_data: dict, chat_id: int, variant: str, output_dir: str,
+               stages: list = None) -> asyncio.Future:
+        """Ставит пользователя в очередь рендеринга, возвращает asyncio-future с результатом render_user"""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self._executor, render_user, user_data, chat_id, variant, output_dir, RENDER_CACHE_ENABLED, stages
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
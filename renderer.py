@@ -0,0 +1,594 @@
+"""
+Послойный рендерер PNG по шаблонам templates/{stage}_{variant}.html
+Шаблон один раз компилируется в декларативную разметку (LayoutSpec): блоки текста с кусками,
+шрифтами, цветами из BRAND и отступами по LAYOUT_STYLES. Фон карточки рисуется один раз
+на (stage, variant), статические блоки растрируются при компиляции, а для каждого пользователя
+переносятся и вставляются только блоки с полями — из готовых масок TextRunCache
+"""
+
+import math
+import re
+from collections import OrderedDict, namedtuple
+from html.parser import HTMLParser
+from pathlib import Path
+from urllib.parse import unquote
+
+from PIL import Image, ImageColor, ImageDraw
+
+from config import (
+    IMAGE_WIDTH, IMAGE_HEIGHT, BRAND, TEXT_RUN_CACHE_SIZE,
+    IMAGE_FORMAT, PNG_COMPRESS_LEVEL, PNG_OPTIMIZE, PALETTE_COLORS, JPEG_QUALITY, WEBP_QUALITY
+)
+from fonts import get_font
+
+
+# Стили разметки — подмножество templates/styles.css, которое исполняет быстрый рендерер
+# Ключи — тег или .класс; font — роль из config.FONTS, size — кегль (px), color — цвет из BRAND['colors'],
+# line_height — множитель кегля, margin — отступ сверху и снизу, bottom — блок прижат к низу карточки,
+# border — цвет рамки слева. font, size, color и line_height наследуются вложенными элементами;
+# у body они заданы всегда, поэтому шаблону без .container тоже хватает стилей
+LAYOUT_STYLES = {
+    'body': {'font': 'body', 'size': 16, 'color': 'text', 'line_height': 1.2,
+             'padding': 20, 'gradient': ('bg', 'warm')},
+    '.container': {'font': 'body', 'size': 18, 'color': 'text', 'line_height': 1.6,
+                   'padding': 40, 'radius': 20, 'opacity': 0.9, 'border_width': 5},
+    'h1': {'font': 'heading', 'size': 36, 'color': 'accent', 'margin': 10},
+    'h2': {'font': 'heading', 'size': 28, 'color': 'highlight', 'margin': 15},
+    'p': {'color': 'text', 'size': 18, 'margin': 15},
+    '.accent': {'color': 'accent'},
+    '.highlight': {'color': 'highlight'},
+    '.company-name': {'color': 'accent'},
+    '.role-name': {'color': 'highlight'},
+    '.footer': {'size': 14, 'color': 'highlight', 'bottom': 20},
+    '.interest-stage': {'border': 'accent'},
+    '.solution-stage': {'border': 'highlight'},
+    '.deadline-stage': {'border': 'accent'},
+}
+
+INHERITED = ('font', 'size', 'color', 'line_height')
+BLOCK_TAGS = ('h1', 'h2', 'h3', 'p', 'div')
+SKIPPED_TAGS = ('head', 'script', 'style', 'title')
+VOID_TAGS = ('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'wbr')
+
+# Геометрия карточки: отступ страницы, затем внутренний отступ контейнера
+PAGE_PADDING = LAYOUT_STYLES['body']['padding']
+CARD_BOX = (PAGE_PADDING, PAGE_PADDING, IMAGE_WIDTH - PAGE_PADDING, IMAGE_HEIGHT - PAGE_PADDING)
+CONTENT_LEFT = CARD_BOX[0] + LAYOUT_STYLES['.container']['padding']
+CONTENT_TOP = CARD_BOX[1] + LAYOUT_STYLES['.container']['padding']
+CONTENT_WIDTH = CARD_BOX[2] - CARD_BOX[0] - 2 * LAYOUT_STYLES['.container']['padding']
+CONTENT_HEIGHT = CARD_BOX[3] - CARD_BOX[1] - 2 * LAYOUT_STYLES['.container']['padding']
+
+# Если блоки с полями не помещаются в карточку, их кегль уменьшается по этим множителям,
+# а если и этого мало — лишние строки заменяются многоточием
+FIT_SCALES = (0.9, 0.8, 0.7)
+ELLIPSIS = '…'
+
+# Значения по умолчанию для пустых полей пользователя
+USER_DEFAULTS = {'name': 'User', 'company': 'Company', 'role': 'Role'}
+
+# Поля подставляются в шаблон маркерами из области частного использования Unicode,
+# чтобы после рендеринга Jinja найти их в тексте: {{ name }} -> '\ue000name\ue001'
+FIELD_MARKERS = {field: f"\ue000{field}\ue001" for field in USER_DEFAULTS}
+FIELD_PATTERN = re.compile('\ue000(\\w+)\ue001')
+
+# Кусок текста блока: слово (или имя поля, если field) и цвет (RGB); None вместо куска — пробел
+Token = namedtuple('Token', 'text fill field')
+
+# Блок разметки: куски, шрифт (роль, кегль), высота строки, отступ текста в строке, ширина пробела,
+# отступ сверху и снизу, bottom (None — блок в общем потоке).
+# У статического блока masks — готовые маски по цветам [(цвет, маска)] и height — высота,
+# у блока с полями smaller — он же уменьшенным кеглем по FIT_SCALES
+Block = namedtuple('Block', 'tokens font line_height text_top space margin bottom masks height smaller')
+
+# Скомпилированный шаблон: блоки в порядке документа и цвет рамки карточки
+LayoutSpec = namedtuple('LayoutSpec', 'blocks border')
+
+
+def _color(name: str) -> tuple:
+    return ImageColor.getrgb(BRAND['colors'][name])
+
+
+def _tokens(runs: list) -> list:
+    """
+    Текст блока [(текст, цвет)] -> куски: пробелы схлопываются как в HTML,
+    маркеры полей становятся отдельными кусками, переносить можно только по пробелам
+    """
+    tokens = []
+    for text, fill in runs:
+        for index, part in enumerate(FIELD_PATTERN.split(re.sub(r'\s+', ' ', text))):
+            if index % 2:
+                tokens.append(Token(part, fill, True))
+                continue
+            for word in re.findall(r' |[^ ]+', part):
+                if word != ' ':
+                    tokens.append(Token(word, fill, False))
+                elif tokens and tokens[-1] is not None:
+                    tokens.append(None)
+    while tokens and tokens[-1] is None:
+        tokens.pop()
+    return tokens
+
+
+class TemplateParser(HTMLParser):
+    """
+    Разбирает HTML шаблона в блоки: [(стиль, куски)]
+    Блоки — элементы BLOCK_TAGS; стиль складывается из LAYOUT_STYLES тега и классов
+    поверх наследуемых свойств родителя, как каскад CSS
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.blocks = []
+        self.border = None
+        self._stack = []
+        self._skip = 0
+        self._block = None
+
+    def _style(self, tag: str, classes: list) -> dict:
+        parent = self._stack[-1][1] if self._stack else LAYOUT_STYLES['body']
+        style = {key: parent[key] for key in INHERITED if key in parent}
+        style.update(LAYOUT_STYLES.get(tag, {}))
+        for name in classes:
+            style.update(LAYOUT_STYLES.get(f".{name}", {}))
+        return style
+
+    def _close_block(self):
+        if self._block is not None:
+            style, runs = self._block
+            tokens = _tokens(runs)
+            if tokens:
+                self.blocks.append((style, tokens))
+            self._block = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        style = self._style(tag, (dict(attrs).get('class') or '').split())
+        self._stack.append((tag, style))
+        if tag in SKIPPED_TAGS:
+            self._skip += 1
+        elif 'border' in style:
+            self.border = style['border']
+        if tag in BLOCK_TAGS:
+            # Вложенный блок закрывает внешний (текст контейнера вокруг блоков — только пробелы)
+            self._close_block()
+            self._block = (style, [])
+
+    def handle_endtag(self, tag):
+        if not any(open_tag == tag for open_tag, _ in self._stack):
+            return
+        while self._stack:
+            open_tag, _ = self._stack.pop()
+            if open_tag in SKIPPED_TAGS:
+                self._skip -= 1
+            if open_tag in BLOCK_TAGS:
+                self._close_block()
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self._block is not None and not self._skip:
+            self._block[1].append((data, _color(self._stack[-1][1]['color'])))
+
+    def close(self):
+        super().close()
+        self._close_block()
+
+
+def _wrap(items: list, space: float, max_width: float) -> list:
+    """
+    Перенос по словам: items — [(кусок из TextRunCache, цвет)] или None (пробел)
+    Возвращает строки [(ширина, [(x, кусок, цвет)])]; куски без пробела между ними не разрываются
+    """
+    lines = []
+    line, width, gap = [], 0.0, False
+    for item in items:
+        if item is None:
+            gap = bool(line)
+            continue
+        run, fill = item
+        x_pos = width + space if gap else width
+        if gap and x_pos + run[2] > max_width:
+            lines.append((width, line))
+            line, x_pos = [], 0.0
+        line.append((x_pos, run, fill))
+        width, gap = x_pos + run[2], False
+    if line:
+        lines.append((width, line))
+    return lines
+
+
+class TextRunCache:
+    """
+    Растрированные куски текста: маска с антиалиасингом (режим L), смещение от точки вывода и ширина
+    Маска не зависит от цвета — цвет подставляется при вставке, поэтому один кусок служит всем цветам.
+    Слова шаблонов хранятся всегда, слова значений полей — в LRU на max_size записей:
+    у многих пользователей одна компания или роль, и их текст растрируется один раз
+    """
+
+    def __init__(self, fonts: dict = None, max_size: int = TEXT_RUN_CACHE_SIZE):
+        self.fonts = {} if fonts is None else fonts
+        self.max_size = max_size
+        self._static = {}
+        self._values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def font(self, key: tuple):
+        """Шрифт по ключу (роль, кегль), загружается при первом обращении"""
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = get_font(*key)
+        return font
+
+    def _rasterize(self, text: str, font_key: tuple):
+        font = self.font(font_key)
+        left, top, right, bottom = font.getbbox(text)
+        mask = Image.new('L', (max(right - left, 1), max(bottom - top, 1)))
+        ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=font)
+        return mask, (left, top), font.getlength(text)
+
+    def get(self, text: str, font_key: tuple, static: bool = False):
+        """(маска, (dx, dy), ширина) для текста text шрифтом font_key"""
+        key = (text, font_key)
+        if static:
+            run = self._static.get(key)
+            if run is None:
+                run = self._static[key] = self._rasterize(text, font_key)
+            return run
+        run = self._values.get(key)
+        if run is not None:
+            self.hits += 1
+            self._values.move_to_end(key)
+            return run
+        self.misses += 1
+        run = self._values[key] = self._rasterize(text, font_key)
+        if len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+        return run
+
+
+class LayeredRenderer:
+    """
+    Исполняет LayoutSpec шаблонов: фон карточки и прижатые к низу статические блоки рисуются
+    один раз на (stage, variant), статические блоки потока вставляются готовыми масками,
+    а блоки с полями переносятся по словам и собираются из масок TextRunCache.
+    Шаблон перекомпилируется, только если реестр перечитал измененный файл
+    """
+
+    def __init__(self, text_cache_size: int = TEXT_RUN_CACHE_SIZE, registry=None):
+        self.text_runs = TextRunCache(max_size=text_cache_size)
+        self._registry = registry
+        self._specs = {}
+        self._bases = {}
+
+    @property
+    def registry(self):
+        if self._registry is None:
+            # utils импортирует этот модуль, поэтому реестр берется при первом обращении
+            from utils import get_template_registry
+            self._registry = get_template_registry()
+        return self._registry
+
+    def _block(self, tokens: list, style: dict, scale: float = 1.0) -> Block:
+        size = max(round(style['size'] * scale), 1)
+        font_key = (style['font'], size)
+        font = self.text_runs.font(font_key)
+        ascent, descent = font.getmetrics()
+        line_height = size * style['line_height']
+        return Block(tokens, font_key, line_height, (line_height - ascent - descent) / 2, font.getlength(' '),
+                     style.get('margin', 0), style.get('bottom'), None, None, ())
+
+    def compile(self, html_str: str) -> LayoutSpec:
+        """HTML шаблона с маркерами полей -> LayoutSpec; статические блоки растрируются сразу"""
+        parser = TemplateParser()
+        parser.feed(html_str)
+        parser.close()
+        blocks = []
+        for style, tokens in parser.blocks:
+            block = self._block(tokens, style)
+            if any(token.field for token in tokens if token is not None):
+                block = block._replace(smaller=tuple(self._block(tokens, style, scale) for scale in FIT_SCALES))
+            else:
+                lines = self._lines(block, {})
+                height = len(lines) * block.line_height
+                masks = {}
+                for fill, mask, x_pos, y_pos in self._glyphs(block, lines, 0, 0):
+                    canvas = masks.get(fill)
+                    if canvas is None:
+                        canvas = masks[fill] = Image.new('L', (CONTENT_WIDTH, math.ceil(height)))
+                    canvas.paste(255, (x_pos, y_pos, x_pos + mask.width, y_pos + mask.height), mask)
+                block = block._replace(masks=list(masks.items()), height=height)
+            blocks.append(block)
+        return LayoutSpec(blocks, parser.border)
+
+    def spec(self, stage: str, variant: str) -> LayoutSpec:
+        """Скомпилированный шаблон этапа и варианта (компилируется один раз на версию файла)"""
+        key = (stage, variant)
+        template = self.registry.get(stage, variant)
+        source = self.registry.source(stage, variant)
+        entry = self._specs.get(key)
+        if entry is None or entry[0] is not source:
+            spec = self.compile(template.render(**FIELD_MARKERS))
+            entry = self._specs[key] = (source, spec)
+            self._bases.pop(key, None)
+        return entry[1]
+
+    def _lines(self, block: Block, fields: dict) -> list:
+        """Строки блока: значения полей делятся на слова, чтобы длинная компания тоже переносилась"""
+        items = []
+        for token in block.tokens:
+            if token is None:
+                items.append(None)
+            elif token.field:
+                for index, word in enumerate(str(fields[token.text]).split()):
+                    if index:
+                        items.append(None)
+                    run = self.text_runs.get(word, block.font)
+                    if run[2] > CONTENT_WIDTH:
+                        # Слово шире карточки не перенести — обрезаем его
+                        run = self.text_runs.get(self._truncate(word, block.font), block.font)
+                    items.append((run, token.fill))
+            else:
+                items.append((self.text_runs.get(token.text, block.font, static=True), token.fill))
+        return _wrap(items, block.space, CONTENT_WIDTH)
+
+    def _truncate(self, word: str, font_key: tuple) -> str:
+        """Самое длинное начало слова, которое вместе с многоточием помещается в ширину контента"""
+        font = self.text_runs.font(font_key)
+        low, high = 0, len(word)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if font.getlength(word[:middle] + ELLIPSIS) <= CONTENT_WIDTH:
+                low = middle
+            else:
+                high = middle - 1
+        return word[:low] + ELLIPSIS
+
+    def _ellipsize(self, block: Block, lines: list) -> list:
+        """Ставит многоточие в конец последней строки, убирая с нее куски, пока оно не поместится"""
+        ellipsis = self.text_runs.get(ELLIPSIS, block.font, static=True)
+        width, line = lines[-1]
+        line = list(line)
+        while line and line[-1][0] + line[-1][1][2] + ellipsis[2] > CONTENT_WIDTH:
+            line.pop()
+        end = line[-1][0] + line[-1][1][2] if line else 0.0
+        fill = line[-1][2] if line else block.tokens[0].fill
+        line.append((end, ellipsis, fill))
+        return lines[:-1] + [(end + ellipsis[2], line)]
+
+    @staticmethod
+    def _glyphs(block: Block, lines: list, left: int, top: int):
+        """Куда вставить маски кусков (строки по центру ширины контента): (цвет, маска, x, y)"""
+        for index, (width, line) in enumerate(lines):
+            line_left = left + (CONTENT_WIDTH - width) / 2
+            line_top = top + round(index * block.line_height + block.text_top)
+            for x_pos, (mask, (dx, dy), _), fill in line:
+                yield fill, mask, round(line_left + x_pos) + dx, line_top + dy
+
+    def _draw(self, img: Image.Image, block: Block, lines, top: int):
+        if lines is None:
+            for fill, mask in block.masks:
+                img.paste(fill, (CONTENT_LEFT, top, CONTENT_LEFT + mask.width, top + mask.height), mask)
+            return
+        for fill, mask, x_pos, y_pos in self._glyphs(block, lines, CONTENT_LEFT, top):
+            img.paste(fill, (x_pos, y_pos, x_pos + mask.width, y_pos + mask.height), mask)
+
+    @staticmethod
+    def _bottom_top(block: Block, height: float) -> int:
+        return round(CARD_BOX[3] - block.bottom - height)
+
+    def base_image(self, stage: str, variant: str) -> Image.Image:
+        """Фон этапа: градиент страницы, карточка с рамкой и прижатые к низу статические блоки"""
+        spec = self.spec(stage, variant)
+        key = (stage, variant)
+        base = self._bases.get(key)
+        if base is None:
+            top_color, bottom_color = (_color(name) for name in LAYOUT_STYLES['body']['gradient'])
+            gradient = Image.linear_gradient('L').resize((IMAGE_WIDTH, IMAGE_HEIGHT))
+            base = Image.composite(Image.new('RGBA', (IMAGE_WIDTH, IMAGE_HEIGHT), bottom_color),
+                                   Image.new('RGBA', (IMAGE_WIDTH, IMAGE_HEIGHT), top_color), gradient)
+
+            container = LAYOUT_STYLES['.container']
+            card = Image.new('RGBA', base.size, (0, 0, 0, 0))
+            draw = ImageDraw.Draw(card)
+            inner = CARD_BOX
+            if spec.border:
+                draw.rounded_rectangle(CARD_BOX, container['radius'], fill=_color(spec.border))
+                inner = (CARD_BOX[0] + container['border_width'], *CARD_BOX[1:])
+            draw.rounded_rectangle(inner, container['radius'],
+                                   fill=(255, 255, 255, round(255 * container['opacity'])))
+            base = Image.alpha_composite(base, card).convert('RGB')
+
+            for block in spec.blocks:
+                if block.masks is not None and block.bottom is not None:
+                    self._draw(base, block, None, self._bottom_top(block, block.height))
+            self._bases[key] = base
+        return base
+
+    def layout(self, spec: LayoutSpec, fields: dict) -> list:
+        """
+        Размещение блоков: [(блок, строки или None для статического, y верхнего края)]
+        Поток центрируется по вертикали между верхом контента и прижатыми к низу блоками (подвалом);
+        если он не помещается, блоки с полями уменьшаются по FIT_SCALES, затем обрезаются по строкам
+        """
+        placed = []
+        for block in spec.blocks:
+            if block.masks is not None:
+                placed.append([block, block, None, block.height])
+            else:
+                lines = self._lines(block, fields)
+                placed.append([block, block, lines, len(lines) * block.line_height])
+
+        area_bottom = CONTENT_TOP + CONTENT_HEIGHT
+        for _, block, _, height in placed:
+            if block.bottom is not None:
+                area_bottom = min(area_bottom, self._bottom_top(block, height))
+        available = area_bottom - CONTENT_TOP
+        flow = [item for item in placed if item[1].bottom is None]
+        personal = [item for item in flow if item[2] is not None]
+
+        def flow_height():
+            return sum(height + 2 * block.margin for _, block, _, height in flow)
+
+        for step in range(len(FIT_SCALES)):
+            if flow_height() <= available:
+                break
+            for item in personal:
+                item[1] = item[0].smaller[step]
+                item[2] = self._lines(item[1], fields)
+                item[3] = len(item[2]) * item[1].line_height
+        while flow_height() > available:
+            longest = max(personal, key=lambda item: len(item[2]), default=None)
+            if longest is None or len(longest[2]) < 2:
+                break
+            longest[2] = self._ellipsize(longest[1], longest[2][:-1])
+            longest[3] = len(longest[2]) * longest[1].line_height
+
+        result = []
+        y_pos = CONTENT_TOP + max(available - flow_height(), 0) / 2
+        for _, block, lines, height in placed:
+            if block.bottom is not None:
+                result.append((block, lines, self._bottom_top(block, height)))
+                continue
+            y_pos += block.margin
+            result.append((block, lines, round(y_pos)))
+            y_pos += height + block.margin
+        return result
+
+    def render(self, stage: str, variant: str, user_data: dict) -> Image.Image:
+        """Копия фона, на которую вставлены блоки по layout"""
+        spec = self.spec(stage, variant)
+        img = self.base_image(stage, variant).copy()
+        fields = {**USER_DEFAULTS, **{k: v for k, v in (user_data or {}).items() if v}}
+        for block, lines, top in self.layout(spec, fields):
+            # Статические блоки внизу уже нарисованы на фоне
+            if lines is None and block.bottom is not None:
+                continue
+            self._draw(img, block, lines, top)
+        return img
+
+
+_renderer = None
+
+
+def get_renderer() -> LayeredRenderer:
+    """Общий для процесса рендерер (кэш разметки и фонов живет столько же, сколько процесс)"""
+    global _renderer
+    if _renderer is None:
+        _renderer = LayeredRenderer()
+    return _renderer
+
+
+# Размер страницы WeasyPrint совпадает с размером картинки
+PAGE_CSS = f"@page {{ size: {IMAGE_WIDTH}px {IMAGE_HEIGHT}px; margin: 0 }}"
+
+# Таблицы стилей WeasyPrint по base_url: styles.css разбирается один раз на процесс
+_document_styles = {}
+
+
+def _local_fetcher(url: str):
+    """
+    Загрузчик ресурсов WeasyPrint только с диска: @import Google Fonts и другие сетевые ссылки
+    не загружаются на каждую картинку — шрифты берутся из системы (см. fonts.py и FONT_DIR)
+    """
+    from weasyprint import default_url_fetcher
+    if url.startswith('file:'):
+        return default_url_fetcher(url)
+    return {'string': '', 'mime_type': 'text/css'}
+
+
+def _document_stylesheets(base_url: str) -> tuple:
+    """(таблицы стилей, URL styles.css): styles.css и размер страницы, собранные один раз"""
+    entry = _document_styles.get(base_url)
+    if entry is None:
+        from weasyprint import CSS
+        path = Path(base_url, 'styles.css').resolve()
+        stylesheets = [CSS(string=PAGE_CSS)]
+        if path.is_file():
+            stylesheets.insert(0, CSS(filename=str(path), url_fetcher=_local_fetcher))
+        entry = _document_styles[base_url] = (stylesheets, unquote(path.as_uri()))
+    return entry
+
+
+def render_document(html_str: str, base_url: str = 'templates') -> Image.Image:
+    """
+    Настоящая верстка HTML: WeasyPrint строит документ (со styles.css из base_url),
+    pypdfium2 растеризует первую страницу
+    """
+    try:
+        from weasyprint import HTML
+        import pypdfium2
+    except (ImportError, OSError) as e:
+        raise RuntimeError(f"Бэкенд 'weasyprint' недоступен (нужны weasyprint и pypdfium2): {e}")
+    
+    stylesheets, styles_url = _document_stylesheets(base_url)
+
+    def fetch(url):
+        # <link> на styles.css уже учтен готовой таблицей стилей — второй раз его не разбираем
+        if unquote(url) == styles_url:
+            return {'string': '', 'mime_type': 'text/css'}
+        return _local_fetcher(url)
+
+    pdf_bytes = HTML(string=html_str, base_url=f"{base_url}/", url_fetcher=fetch).write_pdf(stylesheets=stylesheets)
+    pdf = pypdfium2.PdfDocument(pdf_bytes)
+    try:
+        # PDF измеряется в пунктах (1/72 дюйма), CSS-пиксели — 1/96 дюйма
+        img = pdf[0].render(scale=96 / 72).to_pil().convert('RGB')
+    finally:
+        pdf.close()
+    
+    if img.size != (IMAGE_WIDTH, IMAGE_HEIGHT):
+        img = img.resize((IMAGE_WIDTH, IMAGE_HEIGHT))
+    return img
+
+
+def render_image(stage: str, variant: str, user_data: dict) -> Image.Image:
+    """Рисует персонализированное изображение этапа"""
+    return get_renderer().render(stage, variant, user_data)
+
+
+# Форматы вывода: формат Pillow и расширение файла
+IMAGE_FORMATS = {
+    'png': ('PNG', '.png'),
+    'png-palette': ('PNG', '.png'),
+    'jpeg': ('JPEG', '.jpg'),
+    'webp': ('WEBP', '.webp'),
+}
+
+
+def encode_options(fmt: str = IMAGE_FORMAT) -> dict:
+    """Параметры кодирования формата fmt — от них зависит результат, поэтому они входят в ключ кэша"""
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Неизвестный формат изображения: {fmt}")
+    if fmt == 'png':
+        return {'format': fmt, 'compress_level': PNG_COMPRESS_LEVEL, 'optimize': PNG_OPTIMIZE}
+    if fmt == 'png-palette':
+        return {'format': fmt, 'compress_level': PNG_COMPRESS_LEVEL, 'optimize': PNG_OPTIMIZE,
+                'colors': PALETTE_COLORS}
+    if fmt == 'jpeg':
+        return {'format': fmt, 'quality': JPEG_QUALITY}
+    return {'format': fmt, 'quality': WEBP_QUALITY}
+
+
+def image_extension(fmt: str = IMAGE_FORMAT) -> str:
+    return IMAGE_FORMATS[fmt][1]
+
+
+def encode_image(img: Image.Image, fp, options: dict = None):
+    """
+    Сохраняет изображение в fp (путь или файловый объект) с параметрами encode_options
+    Картинки воронки — плоский фон и несколько цветов текста, поэтому палитра почти
+    не теряет качества, а файл и время загрузки в Telegram заметно меньше
+    """
+    options = dict(options or encode_options())
+    fmt = options.pop('format')
+    if fmt == 'png-palette':
+        # Без дизеринга: на плоском фоне он только добавляет шум и байты
+        img = img.quantize(colors=options.pop('colors'), method=Image.Quantize.FASTOCTREE,
+                           dither=Image.Dither.NONE)
+    elif fmt == 'jpeg':
+        options.update(optimize=True, subsampling='4:2:0')
+    elif fmt == 'webp':
+        options.update(method=4)
+    img.save(fp, format=IMAGE_FORMATS[fmt][0], **options)
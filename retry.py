@@ -0,0 +1,133 @@
+"""
+Повторные попытки отправки с учетом flood control Telegram
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError,
+    TelegramForbiddenError, TelegramBadRequest, TelegramNotFound
+)
+
+from config import (
+    SEND_MAX_ATTEMPTS, FLOOD_MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, DEAD_LETTER_PATH
+)
+from rate_limiter import RateLimiter
+
+# Временные ошибки: повторяем с экспоненциальной задержкой
+TRANSIENT_ERRORS = (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError)
+
+# Описания BadRequest, после которых писать этому пользователю бессмысленно
+PERMANENT_BAD_REQUESTS = ('chat not found', 'user not found', 'user is deactivated', 'peer_id_invalid')
+
+
+def is_permanent(error: Exception) -> bool:
+    """Пользователь недостижим навсегда: заблокировал бота, удален или чата не существует"""
+    if isinstance(error, (TelegramForbiddenError, TelegramNotFound)):
+        return True
+    if isinstance(error, TelegramBadRequest):
+        return any(reason in str(error).lower() for reason in PERMANENT_BAD_REQUESTS)
+    return False
+
+
+class RetryScheduler:
+    """
+    Выполняет отправку через лимитер и повторяет ее при временных ошибках
+    TelegramRetryAfter ставит на паузу только чат, в котором случился флуд; если за время
+    этой паузы флуд пришел уже из другого чата — значит, уперлись в лимит бота, и на паузу
+    ставится глобальное ведро. Остальные воркеры при этом продолжают работать
+    """
+
+    def __init__(self, limiter: RateLimiter, max_attempts: int = SEND_MAX_ATTEMPTS,
+                 flood_retries: int = FLOOD_MAX_RETRIES, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY):
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+        self.flood_retries = flood_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.floods = 0
+        self._last_flood = None
+
+    def backoff(self, attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _on_flood(self, chat_id: int, retry_after: float):
+        self.floods += 1
+        now = time.monotonic()
+        if self._last_flood is not None and self._last_flood[0] != chat_id and now < self._last_flood[1]:
+            self.limiter.pause(retry_after)
+        else:
+            self.limiter.pause(retry_after, chat_id)
+        self._last_flood = (chat_id, now + retry_after)
+
+    async def send(self, chat_id: int, send):
+        """
+        Вызывает корутинную функцию send() (без аргументов), пока она не выполнится
+        Постоянные ошибки и исчерпанные попытки пробрасываются наружу
+        """
+        attempt = 0
+        floods = 0
+        while True:
+            await self.limiter.acquire(chat_id)
+            try:
+                return await send()
+            except TelegramRetryAfter as e:
+                floods += 1
+                if floods > self.flood_retries:
+                    raise
+                self._on_flood(chat_id, e.retry_after)
+            except TRANSIENT_ERRORS:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
+            self.retries += 1
+
+
+class DeadLetters:
+    """
+    Файл (JSONL) с пользователями, доставка которым невозможна навсегда
+    При следующих запусках такие пользователи пропускаются без рендеринга и отправки
+    """
+
+    def __init__(self, path: str = DEAD_LETTER_PATH):
+        self.path = path
+        self.blocked = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self.blocked.add(json.loads(line)['telegram_id'])
+        self._file = None
+
+    def __contains__(self, telegram_id: int) -> bool:
+        return telegram_id in self.blocked
+
+    def add(self, telegram_id: int, stage: str, variant: str, error: Exception):
+        if telegram_id in self.blocked:
+            return
+        self.blocked.add(telegram_id)
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        record = {
+            'telegram_id': telegram_id, 'stage': stage, 'variant': variant,
+            'error': f"{type(error).__name__}: {error}", 'at': time.time(),
+        }
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,180 @@
+"""
+Планировщик воронки: этапы уходят с заданными паузами, а не подряд
+"""
+
+import asyncio
+import heapq
+import time
+
+from config import STAGES, STAGE_DELAYS, SCHEDULE_PATH, SCHEDULE_RETRY_DELAY, MAX_CONCURRENT_SENDS
+from storage import connect
+
+# Что делать с пользователем после обработки этапа
+DELIVERED = 'delivered'  # перейти к следующему этапу
+RETRY = 'retry'          # повторить этот же этап через SCHEDULE_RETRY_DELAY
+DROP = 'drop'            # пользователь недоступен — убрать из воронки
+
+
+class FunnelScheduler:
+    """
+    Персистентная очередь с приоритетом по времени: у каждого пользователя в воронке
+    есть текущий этап и время, когда он должен уйти. Состояние хранится в SQLite,
+    в памяти — только куча (due_at, telegram_id), которая восстанавливается при старте.
+    Цикл run() спит до ближайшего срока и не тратит CPU, пока работы нет
+    """
+
+    COMMIT_EVERY = 200
+
+    def __init__(self, path: str = SCHEDULE_PATH, stage_delays: dict = None,
+                 retry_delay: float = SCHEDULE_RETRY_DELAY):
+        self.stage_delays = {**STAGE_DELAYS, **(stage_delays or {})}
+        self.retry_delay = retry_delay
+        self._db = connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS funnel ('
+            'telegram_id INTEGER PRIMARY KEY, name TEXT, role TEXT, company TEXT, variant TEXT NOT NULL, '
+            'stage_index INTEGER NOT NULL, due_at REAL NOT NULL)'
+        )
+        self._db.commit()
+        self._heap = [
+            (due_at, telegram_id)
+            for telegram_id, due_at in self._db.execute(
+                'SELECT telegram_id, due_at FROM funnel WHERE stage_index < ?', (len(STAGES),)
+            )
+        ]
+        heapq.heapify(self._heap)
+        self._wakeup = asyncio.Event()
+        self._uncommitted = 0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def _commit(self, force: bool = False):
+        self._uncommitted += 1
+        if force or self._uncommitted >= self.COMMIT_EVERY:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def enroll(self, telegram_id: int, user_data: dict, variant: str, now: float = None) -> bool:
+        """
+        Добавляет пользователя в воронку с первого этапа; уже известных пользователей не трогает
+        """
+        due_at = (now or time.time()) + self.stage_delays.get(STAGES[0], 0)
+        cursor = self._db.execute(
+            'INSERT OR IGNORE INTO funnel (telegram_id, name, role, company, variant, stage_index, due_at) '
+            'VALUES (?, ?, ?, ?, ?, 0, ?)',
+            (telegram_id, user_data.get('name'), user_data.get('role'), user_data.get('company'), variant, due_at)
+        )
+        if cursor.rowcount == 0:
+            return False
+        heapq.heappush(self._heap, (due_at, telegram_id))
+        self._commit()
+        self._wakeup.set()
+        return True
+
+    def flush(self):
+        self._db.commit()
+        self._uncommitted = 0
+
+    def next_due(self):
+        """Время ближайшего этапа или None, если воронка пуста"""
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float = None, limit: int = None) -> list:
+        """
+        Забирает из очереди пользователей, чей этап уже пора отправлять
+        Возвращает список (telegram_id, user_data, variant, stage)
+        """
+        now = now or time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+            _, telegram_id = heapq.heappop(self._heap)
+            row = self._db.execute(
+                'SELECT name, role, company, variant, stage_index FROM funnel WHERE telegram_id = ?',
+                (telegram_id,)
+            ).fetchone()
+            if row is None or row[4] >= len(STAGES):
+                continue
+            name, role, company, variant, stage_index = row
+            due.append((telegram_id, {'name': name, 'role': role, 'company': company}, variant, STAGES[stage_index]))
+        return due
+
+    def _reschedule(self, telegram_id: int, stage_index: int, due_at: float):
+        self._db.execute(
+            'UPDATE funnel SET stage_index = ?, due_at = ? WHERE telegram_id = ?',
+            (stage_index, due_at, telegram_id)
+        )
+        if stage_index < len(STAGES):
+            heapq.heappush(self._heap, (due_at, telegram_id))
+        self._commit()
+
+    def complete(self, telegram_id: int, stage: str, outcome: str = DELIVERED, now: float = None):
+        """Фиксирует результат этапа и планирует следующий"""
+        now = now or time.time()
+        stage_index = STAGES.index(stage)
+        if outcome == DELIVERED:
+            next_index = stage_index + 1
+            delay = self.stage_delays.get(STAGES[next_index], 0) if next_index < len(STAGES) else 0
+            self._reschedule(telegram_id, next_index, now + delay)
+        elif outcome == RETRY:
+            self._reschedule(telegram_id, stage_index, now + self.retry_delay)
+        else:
+            self._reschedule(telegram_id, len(STAGES), now)
+
+    async def run(self, handler, concurrency: int = MAX_CONCURRENT_SENDS, stop_when_empty: bool = True):
+        """
+        Основной цикл: спит до ближайшего срока, затем вызывает
+        await handler(telegram_id, user_data, variant, stage) для каждого созревшего этапа
+        handler возвращает DELIVERED, RETRY или DROP
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        in_flight = set()
+
+        async def process(telegram_id, user_data, variant, stage):
+            try:
+                try:
+                    outcome = await handler(telegram_id, user_data, variant, stage)
+                except Exception as e:
+                    print(f"❌ Ошибка этапа {stage} для {telegram_id}: {e}")
+                    outcome = RETRY
+                self.complete(telegram_id, stage, outcome)
+            finally:
+                semaphore.release()
+
+        def done(task):
+            in_flight.discard(task)
+            # Следующий этап может оказаться раньше текущего ожидания, а пустая очередь — означать конец
+            self._wakeup.set()
+
+        try:
+            while True:
+                due_at = self.next_due()
+                if due_at is None:
+                    if stop_when_empty and not in_flight:
+                        return
+                    timeout = None
+                else:
+                    timeout = due_at - time.time()
+
+                if timeout is None or timeout > 0:
+                    self._wakeup.clear()
+                    self.flush()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                for item in self.pop_due(limit=concurrency):
+                    await semaphore.acquire()
+                    task = asyncio.create_task(process(*item))
+                    in_flight.add(task)
+                    task.add_done_callback(done)
+        finally:
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self._db.close()
@@ -81,18 +81,18 @@ def create_directories():
 
 
 def check_weasyprint():
-    """Проверяет установку WeasyPrint"""
+    """Проверяет установку WeasyPrint (нужен только для RENDER_BACKEND=weasyprint)"""
     print("🖼️  Проверяем WeasyPrint...")
     try:
         import weasyprint
         print("✅ WeasyPrint установлен")
-        return True
-    except ImportError:
-        print("❌ WeasyPrint не установлен")
-        print("   Установите системные зависимости:")
+    except (ImportError, OSError):
+        print("⚠️  WeasyPrint недоступен — будет использоваться бэкенд pillow")
+        print("   Для RENDER_BACKEND=weasyprint установите системные зависимости и pypdfium2:")
         print("   macOS: brew install cairo pango gdk-pixbuf libffi")
         print("   Ubuntu: sudo apt-get install libcairo2-dev libpango1.0-dev libgdk-pixbuf2.0-dev libffi-dev")
-        return False
+        print("   pip install pypdfium2")
+    return True
 
 
 def main():
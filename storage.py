@@ -0,0 +1,25 @@
+"""
+Локальное хранилище состояния (SQLite)
+"""
+
+import os
+import sqlite3
+
+from config import SQLITE_JOURNAL_MODE
+
+
+def connect(path: str, journal_mode: str = SQLITE_JOURNAL_MODE) -> sqlite3.Connection:
+    """
+    Открывает SQLite базу в режиме WAL: читатели не блокируют писателя,
+    несколько процессов могут работать с одной базой
+    journal_mode='DELETE' — для базы на общем сетевом диске, где WAL недоступен
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute(f'PRAGMA journal_mode={journal_mode}')
+    # В WAL режиме NORMAL не теряет согласованность, только последние транзакции при сбое питания
+    conn.execute('PRAGMA synchronous=NORMAL' if journal_mode.upper() == 'WAL' else 'PRAGMA synchronous=FULL')
+    return conn
@@ -0,0 +1,1078 @@
+#!/usr/bin/env python3
+"""
+Тесты конвейера рассылки: лимиты, рендеринг, хранилища состояния
+"""
+
+import asyncio
+import os
+import shutil
+import sys
+import time
+import types
+
+# Добавляем текущую директорию в путь для импорта
+sys.path.append('.')
+
+from rate_limiter import TokenBucket, RateLimiter
+
+
+def test_token_bucket_rate():
+    """Token bucket не выпускает больше rate сообщений в секунду сверх запаса"""
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=5)
+        started = time.monotonic()
+        for _ in range(30):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(run())
+    # 5 токенов сразу, остальные 25 — по 1/50 с
+    assert elapsed >= 0.45, elapsed
+
+
+class FakeClock:
+    """Виртуальное время для rate_limiter: sleep сразу двигает часы, замеры не зависят от загрузки машины"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.real_sleep = asyncio.sleep
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += max(seconds, 0.0)
+        await self.real_sleep(0)
+
+
+def test_rate_limiter_per_chat():
+    """Лимит на чат не тормозит другие чаты"""
+    import rate_limiter
+
+    clock = FakeClock()
+    rate_limiter.time = types.SimpleNamespace(monotonic=clock.monotonic)
+    rate_limiter.asyncio = types.SimpleNamespace(sleep=clock.sleep, Lock=asyncio.Lock)
+
+    async def run():
+        limiter = RateLimiter(global_rate=1000, per_chat_rate=10)
+        started = clock.monotonic()
+        await asyncio.gather(*(limiter.acquire(chat_id) for chat_id in range(100)))
+        parallel = clock.monotonic() - started
+
+        started = clock.monotonic()
+        for _ in range(3):
+            await limiter.acquire(42)
+        same_chat = clock.monotonic() - started
+        return parallel, same_chat
+
+    try:
+        parallel, same_chat = asyncio.run(run())
+    finally:
+        rate_limiter.time, rate_limiter.asyncio = time, asyncio
+    # 100 разных чатов укладываются в запас глобального ведра; чат 42 свой токен уже потратил,
+    # поэтому еще три сообщения в него — это три интервала по 1/10 с
+    assert parallel == 0.0, parallel
+    assert abs(same_chat - 0.3) < 1e-9, same_chat
+
+
+def test_template_registry_reload_and_missing(tmp_path):
+    """Реестр шаблонов перекомпилирует измененный файл и падает сразу на отсутствующем"""
+    from utils import TemplateRegistry
+
+    template_dir = str(tmp_path / 'templates')
+    shutil.copytree('templates', template_dir)
+    registry = TemplateRegistry(template_dir, check_interval=0)
+    assert 'Alice' in registry.get('interest', 'a').render(name='Alice', role='HR', company='X')
+
+    path = os.path.join(template_dir, 'interest_a.html')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{{ brand.logo }}: {{ name }}')
+    os.utime(path, ns=(1, 1))
+    assert registry.get('interest', 'a').render(name='Bob') == 'POZNAY SEBYA / KNOW YOURSELF: Bob'
+
+    # Удаленный во время работы файл не ломает реестр: остается последняя версия
+    os.remove(path)
+    assert registry.get('interest', 'a').render(name='Bob') == 'POZNAY SEBYA / KNOW YOURSELF: Bob'
+    assert 'Alice' in registry.get('interest', 'b').render(name='Alice', role='HR', company='X')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{{ name }}')
+    assert registry.get('interest', 'a').render(name='Carol') == 'Carol'
+
+    os.remove(os.path.join(template_dir, 'deadline_c.html'))
+    try:
+        TemplateRegistry(template_dir)
+    except FileNotFoundError as e:
+        assert 'deadline_c.html' in str(e)
+    else:
+        raise AssertionError("Отсутствующий шаблон не обнаружен")
+
+
+def test_layered_renderer_reuses_base():
+    """Фон этапа рисуется один раз, персональные строки — поверх копии"""
+    from renderer import LayeredRenderer
+
+    renderer = LayeredRenderer()
+    alice = renderer.render('interest', 'a', {'name': 'Alice', 'role': 'HR', 'company': 'X'})
+    bob = renderer.render('interest', 'a', {'name': 'Bob', 'role': 'HR', 'company': 'X'})
+    again = renderer.render('interest', 'a', {'name': 'Alice', 'role': 'HR', 'company': 'X'})
+
+    assert list(renderer._bases) == [('interest', 'a')]
+    assert alice.tobytes() == again.tobytes()
+    assert alice.tobytes() != bob.tobytes()
+    # Фон в кэше не испорчен персональными строками
+    assert renderer.base_image('interest', 'a').tobytes() != alice.tobytes()
+
+
+def test_text_run_cache_matches_draw_text_and_evicts():
+    """Маска из TextRunCache совпадает с draw.text, слова значений полей вытесняются по LRU"""
+    from PIL import Image, ImageDraw
+    from renderer import LayeredRenderer
+
+    renderer = LayeredRenderer(text_cache_size=3)
+    cache = renderer.text_runs
+    font_key = ('body', 18)
+    mask, (dx, dy), advance = cache.get('Анна', font_key)
+    expected = Image.new('L', (120, 40))
+    ImageDraw.Draw(expected).text((10, 10), 'Анна', fill=255, font=cache.font(font_key))
+    pasted = Image.new('L', (120, 40))
+    pasted.paste(255, (10 + dx, 10 + dy, 10 + dx + mask.width, 10 + dy + mask.height), mask)
+    assert pasted.tobytes() == expected.tobytes()
+    assert advance == cache.font(font_key).getlength('Анна')
+
+    # В solution_b три поля по одному слову: второй рендер целиком из кэша
+    user = {'name': 'Анна', 'role': 'HR', 'company': 'X'}
+    renderer.render('solution', 'b', user)
+    hits = cache.hits
+    renderer.render('solution', 'b', user)
+    assert cache.hits == hits + 3
+    # В LRU три слова: новые вытесняют самые давние
+    cache.get('Борис', font_key)
+    cache.get('Вера', font_key)
+    assert len(cache._values) == 3 and [text for text, _ in cache._values][-2:] == ['Борис', 'Вера']
+    # Слова шаблонов не вытесняются
+    assert ('безопасностью.', font_key) in cache._static
+
+
+def test_layout_spec_compiled_once_and_variants_differ(tmp_path):
+    """Шаблон компилируется в разметку один раз на версию файла, варианты A/B/C рисуются по-разному"""
+    from renderer import LayeredRenderer, CONTENT_WIDTH
+    from utils import TemplateRegistry
+
+    template_dir = str(tmp_path / 'templates')
+    shutil.copytree('templates', template_dir)
+    renderer = LayeredRenderer(registry=TemplateRegistry(template_dir, check_interval=0))
+    user = {'name': 'Анна', 'role': 'HR', 'company': 'Общество с очень длинным названием компании ' * 3}
+
+    images = {variant: renderer.render('solution', variant, user).tobytes() for variant in 'abc'}
+    assert len(set(images.values())) == 3
+    spec = renderer.spec('solution', 'a')
+    assert renderer.spec('solution', 'a') is spec
+    # Заголовок, три абзаца и подвал; статические блоки растрированы заранее
+    assert [block.masks is None for block in spec.blocks] == [False, True, True, False, False, False]
+    assert spec.blocks[-1].bottom == 20 and spec.border == 'highlight'
+    # Длинная компания переносится по словам и не выходит за ширину контента
+    lines = renderer._lines(spec.blocks[1], {'company': user['company']})
+    assert len(lines) > 1 and all(width <= CONTENT_WIDTH for width, _ in lines)
+
+    path = os.path.join(template_dir, 'solution_a.html')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<div class="container solution-stage"><h2>Привет, {{ name }}</h2></div>')
+    os.utime(path, ns=(1, 1))
+    changed = renderer.spec('solution', 'a')
+    assert changed is not spec and len(changed.blocks) == 1
+    assert renderer.render('solution', 'a', user).tobytes() != images['a']
+
+
+def test_layout_fits_long_fields_above_footer():
+    """Длинные поля не наезжают на подвал и не выходят за карточку; шаблону без .container хватает стилей"""
+    from renderer import LayeredRenderer, USER_DEFAULTS, FIELD_MARKERS, CONTENT_TOP, CONTENT_WIDTH, ELLIPSIS
+    from config import STAGES, VARIANTS
+
+    renderer = LayeredRenderer()
+    realistic = {'name': 'Александра Константинопольская', 'role': 'Руководитель отдела маркетинга',
+                 'company': 'ООО «Северо-Западная Инвестиционная Группа»'}
+    absurd = {field: ' '.join([value] * 8) + ' ' + 'Ы' * 200 for field, value in realistic.items()}
+    for user in (realistic, absurd):
+        for stage in STAGES:
+            for variant in VARIANTS:
+                placed = renderer.layout(renderer.spec(stage, variant), {**USER_DEFAULTS, **user})
+                footer_top = min(top for block, _, top in placed if block.bottom is not None)
+                for block, lines, top in placed:
+                    if block.bottom is not None:
+                        continue
+                    height = block.height if lines is None else len(lines) * block.line_height
+                    assert CONTENT_TOP <= top and top + height <= footer_top, (stage, variant)
+                    assert all(width <= CONTENT_WIDTH for width, _ in lines or ()), (stage, variant)
+    # Слово шире карточки обрезается многоточием
+    placed = renderer.layout(renderer.spec('interest', 'b'), {**USER_DEFAULTS, **absurd})
+    assert any(run is renderer.text_runs.get(ELLIPSIS, block.font, static=True)
+               for block, lines, _ in placed for _, line in lines or () for _, run, _ in line)
+
+    spec = renderer.compile('<p>Привет, <b>{}</b>!</p>'.format(FIELD_MARKERS['name']))
+    assert [block.font for block in spec.blocks] == [('body', 18)] and spec.border is None
+
+
+def test_font_manager_resolves_family_once(tmp_path):
+    """Менеджер шрифтов выбирает обычное начертание и запоминает результат"""
+    from fonts import FontManager
+
+    font_dir = str(tmp_path)
+    for file_name in ('Inter-Bold.ttf', 'Inter-Regular.ttf', 'CormorantGaramond-Italic.ttf', 'DejaVuSerif.ttf'):
+        open(os.path.join(font_dir, file_name), 'wb').close()
+
+    manager = FontManager([font_dir])
+    assert manager.resolve('Inter, sans-serif').endswith('Inter-Regular.ttf')
+    assert manager.resolve('Cormorant Garamond, serif').endswith('CormorantGaramond-Italic.ttf')
+    assert manager.resolve('Missing Font, serif').endswith('DejaVuSerif.ttf')
+
+    # Повторный поиск не сканирует каталог заново
+    os.remove(os.path.join(font_dir, 'Inter-Regular.ttf'))
+    assert manager.resolve('Inter, sans-serif').endswith('Inter-Regular.ttf')
+
+
+def test_render_cache_hit_and_eviction(tmp_path):
+    """Кэш рендеринга отдает сохраненный файл и вытесняет давно не использованные записи"""
+    from render_cache import RenderCache, make_key
+
+    work_dir = str(tmp_path)
+    cache = RenderCache(os.path.join(work_dir, 'cache'), max_bytes=150)
+
+    user = {'name': 'Alice', 'role': 'HR', 'company': 'X'}
+    key = make_key('interest', 'a', user, '<h1>{{ name }}</h1>', 'pillow')
+    assert key == make_key('interest', 'a', dict(user), '<h1>{{ name }}</h1>', 'pillow')
+    assert key != make_key('interest', 'a', {**user, 'company': 'Y'}, '<h1>{{ name }}</h1>', 'pillow')
+
+    src = os.path.join(work_dir, 'src.png')
+    with open(src, 'wb') as f:
+        f.write(b'x' * 100)
+    dest = os.path.join(work_dir, 'dest.png')
+
+    assert not cache.fetch(key, dest)
+    cache.store(key, src)
+    assert cache.fetch(key, dest)
+    with open(dest, 'rb') as f:
+        assert f.read() == b'x' * 100
+
+    other = make_key('solution', 'a', user, '', 'pillow')
+    cache.store(other, src)
+    cache.evict()
+    assert cache.size() == 100
+    assert not cache.fetch(key, dest)
+
+
+
+def test_render_cache_batches_last_used(tmp_path):
+    """Попадание не пишет в индекс сразу, но вытеснение учитывает накопленное время использования"""
+    import sqlite3
+    from render_cache import RenderCache
+    from renderer import image_extension
+
+    cache = RenderCache(str(tmp_path / 'cache'), max_bytes=150)
+    src = str(tmp_path / 'src')
+    with open(src, 'wb') as f:
+        f.write(b'x' * 100)
+    cache.store('aa-old', src)
+    cache.store('bb-new', src)
+    assert cache._path('aa-old').endswith(image_extension())
+
+    index = sqlite3.connect(str(tmp_path / 'cache' / 'index.sqlite'))
+    before = index.execute("SELECT last_used FROM entries WHERE key = 'aa-old'").fetchone()
+    assert cache.read('aa-old') == b'x' * 100
+    assert index.execute("SELECT last_used FROM entries WHERE key = 'aa-old'").fetchone() == before
+
+    cache.evict()
+    assert cache.read('aa-old') is not None and cache.read('bb-new') is None
+    cache.close()
+
+def test_encode_image_formats_and_cache_key():
+    """Каждый формат кодируется в свою сигнатуру, палитра уменьшает PNG, формат входит в ключ кэша"""
+    import io
+    from PIL import Image
+    from renderer import render_image, encode_image, encode_options, IMAGE_FORMATS
+    from render_cache import make_key
+    from image_archive import sniff_extension
+
+    img = render_image('interest', 'a', {'name': 'Иван', 'role': 'CTO', 'company': 'ACME'})
+    sizes = {}
+    for fmt, (_, extension) in IMAGE_FORMATS.items():
+        buffer = io.BytesIO()
+        encode_image(img, buffer, encode_options(fmt))
+        assert sniff_extension(buffer.getvalue()) == extension, fmt
+        sizes[fmt] = buffer.tell()
+        buffer.seek(0)
+        assert Image.open(buffer).size == img.size
+
+    assert sizes['png-palette'] < sizes['png']
+    keys = {make_key('interest', 'a', {}, 'source', 'pillow', None, encode_options(fmt)) for fmt in IMAGE_FORMATS}
+    assert len(keys) == len(IMAGE_FORMATS)
+
+
+def test_keyboard_factory_matches_validated_markup():
+    """Клавиатура из KeyboardFactory совпадает с собранной через валидацию pydantic"""
+    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    from utils import KeyboardFactory
+
+    factory = KeyboardFactory(base_url='https://example.com', tracking_url=None)
+    first = factory.build('interest', 1, 'Иван', 'a')
+    second = factory.build('interest', 2, None, 'a')
+    expected = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(
+        text='Interest — Узнай больше для Иван', url='https://example.com/interest?user=1'
+    )]])
+    assert first.model_dump() == expected.model_dump()
+    assert second.inline_keyboard[0][0].text == 'Interest — Узнай больше'
+    # Шаблон этапа не портится от персональных копий
+    assert first.inline_keyboard[0][0].url == 'https://example.com/interest?user=1'
+
+    from click_tracker import click_signature
+    tracked = KeyboardFactory(base_url='https://example.com', tracking_url='https://t.example.com', tracking_secret='s')
+    signature = click_signature('deadline', 'c', 7, 's')
+    assert tracked.build('deadline', 7, 'Ира', 'c').inline_keyboard[0][0].url == f'https://t.example.com/c/deadline/c/7/{signature}'
+    assert tracked.build('deadline', 8, 'Ира', 'c').inline_keyboard[0][0].url.rsplit('/', 1)[1] != signature
+    # Без секрета ссылки на сервис кликов не выдаются
+    unsigned = KeyboardFactory(base_url='https://example.com', tracking_url='https://t.example.com', tracking_secret='')
+    assert unsigned.build('deadline', 7, None, 'c').inline_keyboard[0][0].url == 'https://example.com/deadline?user=7'
+
+
+def write_users_csv(directory, rows: int, variants: str = 'abcz') -> str:
+    """Синтетический CSV пользователей в directory"""
+    path = os.path.join(str(directory), f'users_{rows}.csv')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('name,role,company,telegram_id,variant\n')
+        for i in range(rows):
+            f.write(f"User{i},Role{i % 3},Company{i % 7},{1000 + i},{variants[i % len(variants)]}\n")
+    return path
+
+
+def test_iter_users_streams_normalized_chunks(tmp_path):
+    """Потоковый загрузчик отдает куски с компактными типами и исправленными вариантами"""
+    from utils import iter_users
+
+    chunks = list(iter_users(write_users_csv(tmp_path, 25), chunksize=10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    for chunk in chunks:
+        assert str(chunk['telegram_id'].dtype) == 'int64'
+        assert list(chunk['variant'].cat.categories) == ['a', 'b', 'c']
+    # Некорректный вариант 'z' заменен на 'a'
+    assert chunks[0]['variant'].tolist()[:4] == ['a', 'b', 'c', 'a']
+
+    path = str(tmp_path / 'broken.csv')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('name,telegram_id\nAlice,1\n')
+    try:
+        list(iter_users(path))
+    except Exception as e:
+        assert 'role' in str(e)
+    else:
+        raise AssertionError("Отсутствующие поля не обнаружены")
+
+
+def test_records_from_frame(tmp_path):
+    """UserRecord хранит компактный код варианта и отдает поля для шаблонов"""
+    from utils import iter_users, records_from_frame, load_users
+
+    records = [record for chunk in iter_users(write_users_csv(tmp_path, 6)) for record in records_from_frame(chunk)]
+    assert [record.variant for record in records] == ['a', 'b', 'c', 'a', 'a', 'b']
+    assert records[1].variant_code == 1
+    assert records[1].telegram_id == 1001 and type(records[1].telegram_id) is int
+    assert records[1].as_dict() == {'name': 'User1', 'role': 'Role1', 'company': 'Company1'}
+    assert not hasattr(records[0], '__dict__')
+
+    assert load_users(write_users_csv(tmp_path, 3), as_records=True)[2].variant == 'c'
+
+
+def test_assign_variants_stable_and_weighted():
+    """Варианты по хэшу воспроизводимы, зависят от соли и соблюдают доли трафика"""
+    import numpy as np
+    import pandas as pd
+    from utils import assign_variants, with_hashed_variants, records_from_frame
+
+    telegram_ids = np.arange(1, 200001, dtype=np.int64)
+    codes = assign_variants(telegram_ids, 'campaign-1', {'a': 1, 'b': 1, 'c': 2})
+    assert (codes == assign_variants(telegram_ids, 'campaign-1', {'a': 1, 'b': 1, 'c': 2})).all()
+    shares = np.bincount(codes, minlength=3) / len(codes)
+    assert np.allclose(shares, [0.25, 0.25, 0.5], atol=0.01), shares
+    # Другая соль — другое разбиение
+    assert (codes != assign_variants(telegram_ids, 'campaign-2', {'a': 1, 'b': 1, 'c': 2})).mean() > 0.5
+    # Вариант с нулевым весом не выдается
+    assert 1 not in assign_variants(telegram_ids[:1000], 'campaign-1', {'a': 1, 'b': 0, 'c': 1})
+
+    try:
+        assign_variants(telegram_ids, 'campaign-1', {'z': 1})
+        assert False, "неизвестный вариант должен быть ошибкой"
+    except ValueError:
+        pass
+
+    # Кусок пользователей: тот же вариант независимо от того, в каком куске оказался пользователь
+    df = pd.DataFrame({'telegram_id': [5, 6, 7], 'name': ['A', 'B', 'C'], 'role': ['r'] * 3,
+                       'company': ['c'] * 3, 'variant': ['a'] * 3})
+    whole = [record.variant for record in records_from_frame(with_hashed_variants(df, 's'))]
+    alone = [record.variant for record in records_from_frame(with_hashed_variants(df.iloc[2:], 's'))]
+    assert whole[2:] == alone
+    assert list(df['variant']) == ['a'] * 3
+
+
+def test_assign_shards_consistent():
+    """Бот пользователя стабилен, нагрузка ровная, новый бот забирает пользователей только себе"""
+    import numpy as np
+    import pandas as pd
+    from utils import assign_shards
+    from bot_funnel import ShardRouter
+
+    telegram_ids = np.arange(1, 200001, dtype=np.int64)
+    four = assign_shards(telegram_ids, 4)
+    assert (four == assign_shards(telegram_ids, 4)).all()
+    assert np.allclose(np.bincount(four, minlength=4) / len(four), 0.25, atol=0.01)
+    assert (assign_shards(telegram_ids, 1) == 0).all()
+
+    # При добавлении пятого бота переезжает около пятой части пользователей, и только на него
+    five = assign_shards(telegram_ids, 5)
+    moved = four != five
+    assert abs(moved.mean() - 0.2) < 0.01
+    assert (five[moved] == 4).all()
+
+    try:
+        assign_shards(telegram_ids, 0)
+        assert False, "нулевое число ботов должно быть ошибкой"
+    except ValueError:
+        pass
+
+    # Поток читается один раз на все шарды, каждый пользователь попадает ровно в один шард
+    reads = []
+
+    def chunks():
+        for start in range(100, 400, 100):
+            reads.append(start)
+            yield pd.DataFrame({'telegram_id': np.arange(start, start + 100), 'name': 'A'})
+
+    router = ShardRouter(chunks(), 3, [0, 1, 2])
+    first = next(router.chunks(0))
+    parts = [list(first['telegram_id'])]
+    parts += [list(part['telegram_id']) for shard in range(3) for part in router.chunks(shard)]
+    assert reads == [100, 200, 300]
+    assert sorted(sum(parts, [])) == list(range(100, 400))
+    assert all((assign_shards(np.array(part), 3) == assign_shards(np.array(part[:1]), 3)[0]).all() for part in parts)
+
+
+def test_metrics_histogram_and_prometheus_export(tmp_path):
+    """Квантили гистограммы в пределах корзины, ошибки считаются, экспорт — кумулятивные корзины"""
+    from metrics import Metrics, ProgressReporter, BUCKETS
+
+    metrics = Metrics()
+    for i in range(1, 101):
+        metrics.observe('send_photo', i / 1000, 'interest', 'a')
+    histogram = metrics.series[('send_photo', 'interest', 'a')]
+    assert histogram.count == 100 and abs(histogram.sum - 5.05) < 1e-9
+    for q, exact in ((0.5, 0.050), (0.95, 0.095), (0.99, 0.099)):
+        index = next(i for i, bound in enumerate(BUCKETS) if bound >= exact)
+        assert BUCKETS[index - 1] <= histogram.quantile(q) <= BUCKETS[index], (q, histogram.quantile(q))
+
+    try:
+        with metrics.timer('get_keyboard', 'interest', 'b'):
+            raise RuntimeError('шаблон')
+    except RuntimeError:
+        pass
+    assert metrics.series[('get_keyboard', 'interest', 'b')].errors == 1
+    assert list(metrics.timed_iter([1, 2, 3], 'load_users')) == [1, 2, 3]
+    assert metrics.series[('load_users', '', '')].count == 3
+
+    path = str(tmp_path / 'metrics.prom')
+    reporter = ProgressReporter(metrics, path, interval=3600, export_interval=3600)
+    reporter.update(1, 10)
+    assert not os.path.exists(path)
+    reporter.close()
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    labels = 'operation="send_photo",stage="interest",variant="a"'
+    assert f'funnel_operation_seconds_bucket{{{labels},le="+Inf"}} 100' in text
+    assert f'funnel_operation_seconds_count{{{labels}}} 100' in text
+    assert 'funnel_operation_errors_total{operation="get_keyboard",stage="interest",variant="b"} 1' in text
+    buckets = [int(line.rsplit(' ', 1)[1]) for line in text.splitlines()
+               if line.startswith(f'funnel_operation_seconds_bucket{{{labels}')]
+    assert buckets == sorted(buckets) and len(buckets) == len(BUCKETS) + 1
+
+
+def test_send_journal_survives_restart(tmp_path):
+    """Журнал отправок переживает перезапуск и отдает маску доставленных этапов"""
+    from journal import SendJournal, ALL_STAGES_MASK, stage_bit
+
+    path = str(tmp_path / 'journal.sqlite')
+    journal = SendJournal(path, commit_every=1000, commit_interval=3600)
+    journal.record(1, 'interest', 'a')
+    journal.record(1, 'solution', 'a')
+    journal.record(1, 'deadline', 'a')
+    journal.record(2, 'interest', 'b')
+    # Пачка еще не зафиксирована, но close() ее сбрасывает
+    journal.close()
+
+    completed = SendJournal(path).completed()
+    assert completed[1] == ALL_STAGES_MASK
+    assert completed[2] == stage_bit('interest')
+    assert 3 not in completed
+    assert SendJournal(path).completed([2, 3]) == {2: stage_bit('interest')}
+
+
+def test_work_queue_leases_and_requeue(tmp_path):
+    """Аренды выдаются по одной, аренда пропавшего воркера возвращается и отбирается у него"""
+    from work_queue import WorkQueue, PENDING, LEASED, DONE
+    from utils import iter_users
+
+    state = str(tmp_path)
+    csv_path = os.path.join(state, 'users.csv')
+    with open(csv_path, 'w', encoding='utf-8') as f:
+        f.write('telegram_id,name,role,company,variant\n')
+        f.writelines(f'{100 + i},U{i},r,c,a\n' for i in range(25))
+
+    queue = WorkQueue(os.path.join(state, 'queue.sqlite'))
+    assert queue.create(csv_path, 25, lease_size=10) == 3
+    # Повторный запуск координатора не создает аренды заново
+    assert queue.create(csv_path, 25, lease_size=10) == 0
+
+    first = queue.claim('w1', now=100.0)
+    second = WorkQueue(queue.path).claim('w2', now=100.0)
+    assert (first.start, first.stop, second.start, second.stop) == (0, 10, 10, 20)
+    rows = [chunk['telegram_id'].tolist() for chunk in iter_users(csv_path, chunksize=4, start=20, stop=25)]
+    assert sum(rows, []) == [120, 121, 122, 123, 124]
+
+    assert queue.heartbeat(second.lease_id, 'w2', now=150.0)
+    # w1 не продлевал аренду дольше таймаута — она снова свободна, а w1 о ней больше не может отчитаться
+    assert queue.requeue_expired(timeout=30.0, now=170.0) == [(first.lease_id, 'w1')]
+    assert not queue.heartbeat(first.lease_id, 'w1')
+    assert not queue.complete(first.lease_id, 'w1')
+    again = queue.claim('w3')
+    assert again.lease_id == first.lease_id and again.attempts == 2
+
+    assert queue.complete(again.lease_id, 'w3') and queue.complete(second.lease_id, 'w2')
+    assert queue.progress() == {PENDING: 1, LEASED: 0, DONE: 2}
+    assert not queue.finished()
+    last = queue.claim('w3')
+    assert (last.start, last.stop) == (20, 25)
+    assert queue.claim('w3') is None
+    assert queue.complete(last.lease_id, 'w3') and queue.finished()
+    queue.close()
+
+
+def test_ab_stats_counters_and_significance(tmp_path):
+    """Счетчики A/B суммируются из нескольких писателей, значимость считается по готовым суммам"""
+    from analytics import ABStats, compare_variants, two_proportion_test
+
+    path = str(tmp_path / 'ab_stats.sqlite')
+    sender = ABStats(path, flush_interval=3600)
+    clicks = ABStats(path, flush_interval=3600)
+    for _ in range(1000):
+        sender.record('interest', 'a', 'sent')
+        sender.record('interest', 'b', 'sent')
+    sender.record('interest', 'c', 'blocked', 3)
+    clicks.record('interest', 'a', 'click', 200)
+    clicks.record('interest', 'b', 'click', 250)
+
+    # Несброшенные приращения видны в снимке своего процесса
+    assert sender.snapshot()[('interest', 'a')]['sent'] == 1000
+    assert sender.snapshot()[('interest', 'a')]['click'] == 0
+    sender.close()
+    clicks.close()
+
+    snapshot = ABStats(path).snapshot()
+    assert snapshot[('interest', 'b')] == {'sent': 1000, 'failed': 0, 'blocked': 0, 'click': 250}
+    assert snapshot[('interest', 'c')]['blocked'] == 3
+    assert snapshot[('deadline', 'c')]['sent'] == 0
+
+    z, p_value = two_proportion_test(200, 1000, 250, 1000)
+    assert abs(z - 2.68) < 0.01 and abs(p_value - 0.0073) < 0.0005
+    comparison = next(c for c in compare_variants(snapshot) if c.stage == 'interest' and c.variant == 'b')
+    assert comparison.control_rate == 0.2 and comparison.variant_rate == 0.25
+    assert abs(comparison.lift - 0.25) < 1e-9 and comparison.p_value < 0.05
+    # Пустой этап — не значимо, без деления на ноль
+    assert all(c.p_value == 1.0 for c in compare_variants(snapshot) if c.stage == 'deadline')
+
+
+def test_click_tracker_redirects_and_batches_unique_clicks(tmp_path):
+    """Сервис кликов отвечает редиректом сразу, а клики пишет пачкой; в A/B идут только уникальные"""
+    import sqlite3
+    from aiohttp.test_utils import TestClient, TestServer
+    from click_tracker import ClickTracker, click_signature
+    from analytics import ABStats
+
+    state = str(tmp_path)
+    tracker = ClickTracker(os.path.join(state, 'clicks.sqlite'), os.path.join(state, 'ab_stats.sqlite'),
+                           base_url='https://example.com', flush_interval=3600, buffer_size=50, secret='s')
+
+    def signed(stage, variant, user):
+        return f'/c/{stage}/{variant}/{user}/{click_signature(stage, variant, user, "s")}'
+
+    async def run():
+        async with TestClient(TestServer(tracker.make_app())) as client:
+            response = await client.get(signed('interest', 'b', 777), allow_redirects=False)
+            assert response.status == 302
+            assert response.headers['Location'] == 'https://example.com/interest?user=777'
+            signature = click_signature('interest', 'b', 777, 's')
+            for path in ('/c/unknown/a/1/0', '/c/interest/z/1/0', '/c/interest/a/abc/0', '/c/interest/b/777',
+                         f'/c/interest/a/777/{signature}', f'/c/interest/b/778/{signature}'):
+                assert (await client.get(path, allow_redirects=False)).status == 404
+            # Первый клик еще в памяти — на диск ничего не записано
+            assert tracker.unique == 0
+            await asyncio.gather(*(
+                client.get(signed('solution', 'a', i % 40), allow_redirects=False) for i in range(120)
+            ))
+        # Закрытие сервера сбрасывает остаток буфера
+
+    asyncio.run(run())
+    assert tracker.clicks == 121 and tracker.unique == 41
+
+    db = sqlite3.connect(os.path.join(state, 'clicks.sqlite'))
+    assert db.execute('SELECT SUM(count), COUNT(*) FROM clicks').fetchone() == (121, 41)
+    snapshot = ABStats(os.path.join(state, 'ab_stats.sqlite')).snapshot()
+    assert snapshot[('solution', 'a')]['click'] == 40
+    assert snapshot[('interest', 'b')]['click'] == 1
+
+
+def test_fake_telegram_api_uploads_floods_and_blocks():
+    """Локальный Bot API для бенчмарков: загрузка и file_id, 429 сверх лимита, 403 для заблокировавших"""
+    from aiohttp.test_utils import TestServer
+    from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+    from aiogram.types import BufferedInputFile
+    from bot_funnel import make_bot
+    from fake_telegram import FakeTelegramAPI, FAKE_TOKEN
+
+    api = FakeTelegramAPI(latency=0, jitter=0, rate_limit=4, blocked_rate=0.5)
+    blocked = next(chat_id for chat_id in range(1, 100) if api._is_blocked(chat_id))
+    reachable = next(chat_id for chat_id in range(1, 100) if not api._is_blocked(chat_id))
+
+    async def run():
+        async with TestServer(api.make_app()) as server:
+            bot = make_bot(FAKE_TOKEN, str(server.make_url('')).rstrip('/'))
+            try:
+                message = await bot.send_photo(reachable, BufferedInputFile(b'png', 'a.png'), caption='A')
+                file_id = message.photo[-1].file_id
+                assert (await bot.send_photo(reachable, file_id)).photo[-1].file_id == file_id
+                try:
+                    await bot.send_photo(blocked, file_id)
+                    assert False, "заблокировавший пользователь должен давать 403"
+                except TelegramForbiddenError:
+                    pass
+                # Четвертое сообщение за секунду проходит, пятое — flood control
+                try:
+                    await bot.send_photo(reachable, file_id)
+                    await bot.send_photo(reachable, file_id)
+                    assert False, "сверх rate_limit должен быть 429"
+                except TelegramRetryAfter as e:
+                    assert e.retry_after == 1
+            finally:
+                await bot.session.close()
+
+    asyncio.run(run())
+    assert api.stats['uploads'] == 1 and api.stats['by_file_id'] == 2
+    assert api.stats['blocked'] == 1 and api.stats['flood'] == 1
+
+
+def test_retry_scheduler_flood_backoff_and_permanent(tmp_path):
+    """retry_after ставит на паузу чат, сетевые ошибки повторяются, блокировка — нет"""
+    from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramForbiddenError
+    from retry import RetryScheduler, DeadLetters, is_permanent
+
+    method = types.SimpleNamespace(chat_id=7)
+    errors = [
+        TelegramRetryAfter(method=method, message='flood', retry_after=0.2),
+        TelegramNetworkError(method=method, message='reset'),
+    ]
+
+    async def flaky():
+        if errors:
+            raise errors.pop(0)
+        return 'ok'
+
+    async def blocked():
+        raise TelegramForbiddenError(method=method, message='bot was blocked by the user')
+
+    async def run():
+        scheduler = RetryScheduler(RateLimiter(1000, 1000), base_delay=0.01)
+        started = time.monotonic()
+        result = await scheduler.send(7, flaky)
+        elapsed = time.monotonic() - started
+        try:
+            await scheduler.send(8, blocked)
+        except TelegramForbiddenError as e:
+            assert is_permanent(e)
+        else:
+            raise AssertionError("Постоянная ошибка не проброшена")
+        return scheduler, result, elapsed
+
+    scheduler, result, elapsed = asyncio.run(run())
+    assert result == 'ok'
+    assert scheduler.retries == 2 and scheduler.floods == 1
+    assert elapsed >= 0.2, elapsed
+
+    path = str(tmp_path / 'dead.jsonl')
+    dead_letters = DeadLetters(path)
+    dead_letters.add(8, 'interest', 'a', TelegramForbiddenError(method=method, message='blocked'))
+    dead_letters.close()
+    assert 8 in DeadLetters(path)
+
+
+class FakeBot:
+    """Минимальный бот: запоминает отправки, на загрузку файла отвечает новым file_id"""
+
+    id = 42
+
+    def __init__(self):
+        self.calls = []
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        from aiogram.types import FSInputFile
+
+        await asyncio.sleep(0.01)
+        self.calls.append((chat_id, photo))
+        file_id = f"file-{len(self.calls)}" if isinstance(photo, FSInputFile) else photo
+        return types.SimpleNamespace(photo=[types.SimpleNamespace(file_id=file_id)])
+
+
+def test_file_id_cache_uploads_identical_image_once(tmp_path):
+    """Одинаковая картинка загружается один раз, даже если отправки идут параллельно"""
+    from aiogram.types import FSInputFile
+    from file_id_cache import FileIdCache
+
+    path = str(tmp_path / 'file_ids.sqlite')
+    bot = FakeBot()
+
+    async def run():
+        cache = FileIdCache(path)
+        await asyncio.gather(*(cache.send_photo(bot, chat_id, 'same.png', 'digest-1') for chat_id in range(5)))
+        cache.close()
+
+    asyncio.run(run())
+    uploads = [photo for _, photo in bot.calls if isinstance(photo, FSInputFile)]
+    assert len(uploads) == 1
+    assert [photo for _, photo in bot.calls[1:]] == ['file-1'] * 4
+
+    # file_id переживает перезапуск
+    asyncio.run(run())
+    assert len([photo for _, photo in bot.calls if isinstance(photo, FSInputFile)]) == 1
+
+
+
+def test_file_id_cache_bounded_and_batched(tmp_path):
+    """Кэш file_id ограничен по размеру, пишет изменения пачкой и читает базу только при открытии"""
+    import sqlite3
+    from file_id_cache import FileIdCache
+
+    path = str(tmp_path / 'file_ids.sqlite')
+    cache = FileIdCache(path, max_entries=2, commit_every=10, commit_interval=float('inf'))
+    cache.put(42, 'd1', 'f1')
+    cache.put(42, 'd2', 'f2')
+    assert cache.get(42, 'd1') == 'f1'
+    cache.put(42, 'd3', 'f3')
+    # Вытеснена давно не использованная запись, а не первая добавленная
+    assert len(cache) == 2 and cache.get(42, 'd2') is None
+    assert sqlite3.connect(path).execute('SELECT COUNT(*) FROM file_ids').fetchone() == (0,)
+    cache.close()
+    assert sqlite3.connect(path).execute('SELECT digest FROM file_ids ORDER BY digest').fetchall() == [('d1',), ('d3',)]
+
+    # При открытии с меньшим лимитом остаются самые свежие записи
+    cache = FileIdCache(path, max_entries=1)
+    assert len(cache) == 1 and cache.get(42, 'd3') == 'f3'
+    cache.close()
+    assert sqlite3.connect(path).execute('SELECT COUNT(*) FROM file_ids').fetchone() == (1,)
+
+def test_file_id_cache_keeps_id_on_chat_errors(tmp_path):
+    """400 из-за чата пробрасывается и не стирает file_id, 400 из-за file_id — повторная загрузка"""
+    from aiogram.exceptions import TelegramBadRequest
+    from aiogram.methods import SendPhoto
+    from aiogram.types import FSInputFile
+    from file_id_cache import FileIdCache
+
+    class FailingBot(FakeBot):
+        async def send_photo(self, chat_id, photo, **kwargs):
+            if isinstance(photo, str) and chat_id in errors:
+                raise TelegramBadRequest(method=SendPhoto(chat_id=chat_id, photo=photo), message=errors[chat_id])
+            return await super().send_photo(chat_id, photo, **kwargs)
+
+    errors = {2: 'Bad Request: chat not found', 3: 'Bad Request: wrong file identifier/HTTP URL specified'}
+    bot = FailingBot()
+
+    async def run():
+        cache = FileIdCache(str(tmp_path / 'file_ids.sqlite'))
+        await cache.send_photo(bot, 1, 'same.png', 'digest-1')
+        try:
+            await cache.send_photo(bot, 2, 'same.png', 'digest-1')
+        except TelegramBadRequest:
+            pass
+        else:
+            raise AssertionError("Ошибка чата не проброшена")
+        assert cache.get(bot.id, 'digest-1') == 'file-1'
+        await cache.send_photo(bot, 3, 'same.png', 'digest-1')
+        file_id = cache.get(bot.id, 'digest-1')
+        cache.close()
+        return file_id
+
+    assert asyncio.run(run()) == 'file-2'
+    assert [isinstance(photo, FSInputFile) for _, photo in bot.calls] == [True, True]
+
+
+def test_lost_lease_stops_sends_immediately():
+    """После потери аренды не уходит ни следующий этап, ни уже поставленный в очередь пользователь"""
+    from bot_funnel import DeliveryContext, deliver_user
+    from metrics import Metrics, ProgressReporter
+    from render_pool import RenderResult
+    from retry import RetryScheduler
+    from config import STAGES, VARIANTS
+
+    lost = asyncio.Event()
+
+    class LosingBot(FakeBot):
+        async def send_photo(self, chat_id, photo, **kwargs):
+            result = await super().send_photo(chat_id, photo, **kwargs)
+            lost.set()
+            return result
+
+    async def run():
+        limiter = RateLimiter(1000, 1000)
+        stats = {'total': None, 'processed': 0, 'sent': 0, 'cached': 0, 'skipped': 0, 'failed': 0,
+                 'blocked': 0, 'variants': {variant: 0 for variant in VARIANTS}}
+        ctx = DeliveryContext(bot, limiter, True, stats, RetryScheduler(limiter), lost=lost)
+        ctx.metrics = Metrics()
+        ctx.progress = ProgressReporter(ctx.metrics, path=None)
+        rendered = [RenderResult(stage, None, None, False, f'digest-{stage}', b'png', {}) for stage in STAGES]
+        user = {'name': 'Анна', 'role': 'HR', 'company': 'X'}
+        assert await deliver_user(ctx, user, 1, 'a', rendered) == 1
+        assert await deliver_user(ctx, user, 2, 'a', rendered) == 0
+        return stats
+
+    bot = LosingBot()
+    stats = asyncio.run(run())
+    assert [chat_id for chat_id, _ in bot.calls] == [1] and stats['sent'] == 1
+
+
+
+
+def test_send_funnel_end_to_end_with_render_pool(tmp_path, monkeypatch):
+    """Пул рендеринга опережает отправку не больше чем на очередь, отправка идет параллельно, итоги сходятся"""
+    import pandas as pd
+    import bot_funnel
+    import render_pool
+    from analytics import ABStats
+    from file_id_cache import FileIdCache
+    from journal import SendJournal
+    from render_pool import RenderPool
+    from retry import DeadLetters
+    from config import STAGES
+
+    monkeypatch.setattr(bot_funnel, 'RENDER_QUEUE_SIZE', 2)
+    monkeypatch.setattr(bot_funnel, 'ABStats', lambda: ABStats(str(tmp_path / 'ab_stats.sqlite')))
+    monkeypatch.setattr(bot_funnel, 'DeadLetters', lambda: DeadLetters(str(tmp_path / 'dead_letters.jsonl')))
+    monkeypatch.setattr(render_pool, 'RENDER_CACHE_ENABLED', False)
+
+    progress = {'submitted': 0, 'delivered': set(), 'ahead': 0, 'sending': 0, 'parallel': 0}
+
+    class CountingPool(RenderPool):
+        def submit(self, *args, **kwargs):
+            progress['submitted'] += 1
+            return super().submit(*args, **kwargs)
+
+    class SlowBot(FakeBot):
+        async def send_photo(self, chat_id, photo, **kwargs):
+            progress['delivered'].add(chat_id)
+            progress['ahead'] = max(progress['ahead'], progress['submitted'] - len(progress['delivered']))
+            progress['sending'] += 1
+            progress['parallel'] = max(progress['parallel'], progress['sending'])
+            try:
+                return await super().send_photo(chat_id, photo, **kwargs)
+            finally:
+                progress['sending'] -= 1
+
+    users = pd.DataFrame({'telegram_id': range(1000, 1012), 'name': 'A', 'role': 'r', 'company': 'c',
+                          'variant': ['a', 'b', 'c'] * 4})
+    bot = SlowBot()
+
+    async def run():
+        with CountingPool(2) as pool:
+            return await bot_funnel.send_funnel(
+                bot, users, str(tmp_path / 'out'), send_real=True, limiter=RateLimiter(1000, 1000),
+                concurrency=2, render_pool=pool, file_ids=FileIdCache(str(tmp_path / 'file_ids.sqlite')),
+                journal=SendJournal(str(tmp_path / 'journal.sqlite'))
+            )
+
+    stats = asyncio.run(run())
+    total = len(users) * len(STAGES)
+    assert stats['processed'] == stats['sent'] == total and stats['failed'] == 0
+    assert stats['variants'] == {'a': 4 * len(STAGES), 'b': 4 * len(STAGES), 'c': 4 * len(STAGES)}
+    assert len(bot.calls) == total and progress['submitted'] == len(users)
+    # Рендеры впереди отправки: очередь, по одному у каждого из concurrency отправителей и один у производителя
+    assert progress['ahead'] <= 2 + 2 + 1
+    assert progress['parallel'] == 2
+    assert len(SendJournal(str(tmp_path / 'journal.sqlite')).completed()) == len(users)
+
+def test_send_sharded_shares_state_between_bots(tmp_path, monkeypatch):
+    """Шарды пишут в одни и те же журнал, счетчики A/B и список недоступных, открытые один раз"""
+    import pandas as pd
+    import bot_funnel
+    import render_pool
+    from analytics import ABStats
+    from file_id_cache import FileIdCache
+    from journal import SendJournal
+    from render_pool import RenderPool
+    from retry import DeadLetters
+    from config import STAGES
+
+    opened = []
+
+    def opener(cls, name):
+        def open_resource():
+            resource = cls(str(tmp_path / name))
+            opened.append(cls.__name__)
+            return resource
+        return open_resource
+
+    monkeypatch.setattr(bot_funnel, 'SendJournal', opener(SendJournal, 'journal.sqlite'))
+    monkeypatch.setattr(bot_funnel, 'FileIdCache', opener(FileIdCache, 'file_ids.sqlite'))
+    monkeypatch.setattr(bot_funnel, 'ABStats', opener(ABStats, 'ab_stats.sqlite'))
+    monkeypatch.setattr(bot_funnel, 'DeadLetters', opener(DeadLetters, 'dead_letters.jsonl'))
+    monkeypatch.setattr(render_pool, 'RENDER_CACHE_ENABLED', False)
+    monkeypatch.setattr(bot_funnel, 'MESSAGES_PER_CHAT_PER_SECOND', 1000)
+
+    bots = [FakeBot(), FakeBot()]
+    bots[1].id = 43
+    users = pd.DataFrame({'telegram_id': range(1000, 1006), 'name': 'A', 'role': 'r', 'company': 'c', 'variant': 'a'})
+
+    async def run():
+        with RenderPool(1) as pool:
+            return await bot_funnel.send_sharded(bots, iter([users]), str(tmp_path / 'out'), render_pool=pool)
+
+    results = asyncio.run(run())
+    assert sorted(opened) == ['ABStats', 'DeadLetters', 'FileIdCache', 'SendJournal']
+    assert sum(result['sent'] for result in results) == len(users) * len(STAGES)
+    snapshot = ABStats(str(tmp_path / 'ab_stats.sqlite')).snapshot()
+    assert sum(snapshot[(stage, 'a')]['sent'] for stage in STAGES) == len(users) * len(STAGES)
+
+def test_funnel_scheduler_delays_and_restart(tmp_path):
+    """Планировщик выдает этапы по сроку, повторяет неудачные и переживает перезапуск"""
+    from scheduler import FunnelScheduler, DELIVERED, RETRY, DROP
+
+    path = str(tmp_path / 'schedule.sqlite')
+    delays = {'interest': 0, 'solution': 100, 'deadline': 200}
+    scheduler = FunnelScheduler(path, stage_delays=delays, retry_delay=10)
+    user = {'name': 'Иван', 'role': 'CTO', 'company': 'ACME'}
+    assert scheduler.enroll(1, user, 'a', now=1000)
+    assert scheduler.enroll(2, user, 'b', now=1000)
+    assert not scheduler.enroll(1, user, 'c', now=1000)
+
+    due = scheduler.pop_due(now=1000)
+    assert [(chat_id, variant, stage) for chat_id, _, variant, stage in due] == [(1, 'a', 'interest'), (2, 'b', 'interest')]
+    assert due[0][1] == user
+    scheduler.complete(1, 'interest', DELIVERED, now=1000)
+    scheduler.complete(2, 'interest', RETRY, now=1000)
+    assert scheduler.next_due() == 1010
+    assert scheduler.pop_due(now=1009) == []
+    scheduler.close()
+
+    # После перезапуска очередь восстанавливается из SQLite
+    scheduler = FunnelScheduler(path, stage_delays=delays, retry_delay=10)
+    assert len(scheduler) == 2
+    due = scheduler.pop_due(now=1100)
+    assert [(chat_id, stage) for chat_id, _, _, stage in due] == [(2, 'interest'), (1, 'solution')]
+    scheduler.complete(2, 'interest', DROP, now=1100)
+    scheduler.complete(1, 'solution', DELIVERED, now=1100)
+    assert len(scheduler) == 1 and scheduler.next_due() == 1300
+
+    # run() проводит пользователя по всем этапам, засыпая между ними
+    fast = FunnelScheduler(str(tmp_path / 'fast' / 'schedule.sqlite'),
+                           stage_delays={'interest': 0, 'solution': 0.05, 'deadline': 0.05}, retry_delay=0.01)
+    fast.enroll(7, user, 'a')
+    sent = []
+    failed = []
+
+    async def handler(chat_id, user_data, variant, stage):
+        if stage == 'solution' and not failed:
+            failed.append(stage)
+            raise RuntimeError('сеть недоступна')
+        sent.append((stage, time.monotonic()))
+        return DELIVERED
+
+    asyncio.run(fast.run(handler))
+    assert [stage for stage, _ in sent] == ['interest', 'solution', 'deadline']
+    assert sent[2][1] - sent[1][1] >= 0.04
+    assert len(fast) == 0
+    fast.close()
+    scheduler.close()
+
+
+
+def test_scheduled_test_mode_keeps_send_schedule(tmp_path, monkeypatch):
+    """--test --schedule проходит воронку в своей очереди и не трогает боевое расписание"""
+    import bot_funnel
+    import render_pool
+    import scheduler
+    from render_pool import RenderPool
+    from scheduler import FunnelScheduler
+    from utils import iter_users
+
+    send_path = str(tmp_path / 'schedule.sqlite')
+    test_path = str(tmp_path / 'schedule_test.sqlite')
+    monkeypatch.setattr(bot_funnel, 'SCHEDULE_PATH', send_path)
+    monkeypatch.setattr(bot_funnel, 'SCHEDULE_TEST_PATH', test_path)
+    monkeypatch.setattr(scheduler, 'STAGE_DELAYS', {stage: 0 for stage in scheduler.STAGES})
+    monkeypatch.setattr(render_pool, 'RENDER_CACHE_ENABLED', False)
+
+    # В боевой очереди пользователь ждет второго этапа
+    live = FunnelScheduler(send_path, stage_delays={'solution': 3600})
+    user = {'name': 'Иван', 'role': 'CTO', 'company': 'ACME'}
+    live.enroll(1000, user, 'a', now=1000)
+    live.complete(1000, 'interest', scheduler.DELIVERED, now=1000)
+    live.close()
+
+    pool = RenderPool(1)
+    try:
+        stats = asyncio.run(bot_funnel.run_scheduled(None, iter_users(write_users_csv(tmp_path, 2)), str(tmp_path / 'out'),
+                                                     render_pool=pool))
+    finally:
+        pool.close()
+    assert stats['processed'] == 2 * len(scheduler.STAGES) and stats['sent'] == 0
+
+    live = FunnelScheduler(send_path, stage_delays={'solution': 3600})
+    assert len(live) == 1 and live.next_due() == 4600
+    live.close()
+    dry = FunnelScheduler(test_path)
+    assert len(dry) == 0
+    dry.close()
+
+def test_image_archive_roundtrip_and_crash_tail(tmp_path):
+    """Архив кампании хранит одинаковые картинки один раз, отдает их через mmap и обрезает хвост без индекса"""
+    from image_archive import ImageArchive, ImageArchiveWriter, ArchiveInputFile
+
+    path = str(tmp_path / 'campaign.bin')
+    writer = ImageArchiveWriter(path)
+    writer.append(1, 'interest', 'a', b'png-one')
+    writer.append(1, 'solution', 'a', b'png-two')
+    writer.append(2, 'interest', 'b', b'png-one')
+    writer.close()
+    assert (writer.written, writer.deduplicated) == (2, 1)
+    assert os.path.getsize(path) == len(b'png-one') + len(b'png-two')
+
+    # Данные, до которых не дошел индекс (сбой посреди пачки), отбрасываются при следующем открытии
+    with open(path, 'ab') as f:
+        f.write(b'garbage')
+    writer = ImageArchiveWriter(path)
+    writer.append(2, 'solution', 'b', b'png-three')
+    writer.close()
+
+    with ImageArchive(path) as archive:
+        assert len(archive) == 4
+        found = archive.lookup(2)
+        assert {stage: (variant, bytes(view)) for stage, (variant, _, view) in found.items()} == {
+            'interest': ('b', b'png-one'), 'solution': ('b', b'png-three')
+        }
+        assert archive.read(3, 'interest') is None
+
+        photo = ArchiveInputFile(archive.read(1, 'solution'), 'solution.png')
+        photo.chunk_size = 3
+
+        async def read_all():
+            return b''.join([bytes(chunk) async for chunk in photo.read(None)])
+
+        assert asyncio.run(read_all()) == b'png-two'
+        del photo, found
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f"✅ {name}")
@@ -1,52 +1,315 @@
+import numpy as np
 import pandas as pd
+import hashlib
+import io
 import os
-import tempfile
 import random
+import time
+from dataclasses import dataclass
 from pathlib import Path
 from jinja2 import Environment, FileSystemLoader
-from weasyprint import HTML, CSS
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from config import STAGES, BASE_URL, IMAGE_WIDTH, IMAGE_HEIGHT, VARIANTS, BRAND, FONTS
+from renderer import render_image, render_document, encode_image, encode_options, image_extension
+from config import (
+    STAGES, BASE_URL, VARIANTS, BRAND, FONTS, TEMPLATE_CHECK_INTERVAL, RENDER_BACKEND,
+    USERS_CHUNK_SIZE, IMAGE_FORMAT, VARIANT_WEIGHTS, CAMPAIGN_SALT, SHARD_SALT, TRACKING_URL,
+    TRACKING_SECRET
+)
+from click_tracker import click_signature
 
 
-def load_users(csv_path: str) -> pd.DataFrame:
+# Компактные типы колонок: повторяющиеся роли и компании хранятся категориями
+USER_DTYPES = {
+    'name': 'str',
+    'role': 'category',
+    'company': 'category',
+    'telegram_id': 'int64',
+    'variant': 'str',
+}
+
+REQUIRED_FIELDS = ['name', 'role', 'company', 'telegram_id']
+
+
+def _normalize_users(df: pd.DataFrame, warn_missing_variant: bool = True) -> pd.DataFrame:
+    """
+    Проверяет обязательные поля, приводит telegram_id к int64
+    и заменяет отсутствующие или некорректные варианты на 'a'
+    """
+    missing_fields = [field for field in REQUIRED_FIELDS if field not in df.columns]
+    if missing_fields:
+        raise ValueError(f"Отсутствуют обязательные поля: {missing_fields}")
+    
+    # Добавляем поле variant если отсутствует
+    if 'variant' not in df.columns:
+        df['variant'] = 'a'  # значение по умолчанию
+        if warn_missing_variant:
+            print("⚠️  Поле 'variant' отсутствует, установлено значение 'a' по умолчанию")
+    
+    # Конвертируем telegram_id в int
+    df['telegram_id'] = df['telegram_id'].astype('int64')
+    
+    # Проверяем корректность вариантов
+    invalid = ~df['variant'].isin(VARIANTS)
+    if invalid.any():
+        invalid_values = df.loc[invalid, 'variant'].tolist()
+        sample = invalid_values[:10] + (['...'] if len(invalid_values) > 10 else [])
+        print(f"⚠️  Найдены некорректные варианты ({len(invalid_values)}): {sample}")
+        df.loc[invalid, 'variant'] = 'a'
+    df['variant'] = df['variant'].astype(pd.CategoricalDtype(VARIANTS))
+    
+    return df
+
+
+def iter_users(csv_path: str, chunksize: int = USERS_CHUNK_SIZE, start: int = 0, stop: int = None):
+    """
+    Потоково читает пользователей из CSV кусками по chunksize строк
+    Каждый кусок проверяется и нормализуется так же, как в load_users,
+    поэтому расход памяти не зависит от размера файла
+    start/stop — читать только строки пользователей с start по stop - 1 (аренда воркера)
+    """
+    try:
+        options = {}
+        if start:
+            # Целое skiprows пропускает строки без множества их номеров (range превращается в set
+            # и на дальних арендах стоит секунды и сотни МБ); заголовок читается отдельно
+            header = list(pd.read_csv(csv_path, nrows=0).columns)
+            options = {'skiprows': start + 1, 'header': None, 'names': header}
+        reader = pd.read_csv(csv_path, chunksize=chunksize, dtype=USER_DTYPES,
+                             nrows=None if stop is None else max(stop - start, 0), **options)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Файл {csv_path} не найден")
+    except Exception as e:
+        raise Exception(f"Ошибка при загрузке CSV: {e}")
+    
+    with reader:
+        first = True
+        while True:
+            try:
+                chunk = next(reader)
+            except StopIteration:
+                return
+            except Exception as e:
+                raise Exception(f"Ошибка при загрузке CSV: {e}")
+            
+            try:
+                yield _normalize_users(chunk, warn_missing_variant=first)
+            except Exception as e:
+                raise Exception(f"Ошибка при загрузке CSV: {e}")
+            first = False
+
+
+@dataclass
+class UserRecord:
+    """
+    Компактная запись пользователя: без Series и словаря на каждую строку
+    variant_code — индекс варианта в VARIANTS
+    """
+    __slots__ = ('telegram_id', 'name', 'role', 'company', 'variant_code')
+    
+    telegram_id: int
+    name: str
+    role: str
+    company: str
+    variant_code: int
+    
+    @property
+    def variant(self) -> str:
+        return VARIANTS[self.variant_code]
+    
+    def as_dict(self) -> dict:
+        """Поля для шаблонов (как user_data)"""
+        return {'name': self.name, 'role': self.role, 'company': self.company}
+
+
+def records_from_frame(df: pd.DataFrame):
+    """
+    Превращает кусок из iter_users в поток UserRecord
+    Колонки достаются целиком как массивы (telegram_id — int64, variant — коды категорий),
+    а не построчно через iterrows
+    """
+    telegram_ids = df['telegram_id'].to_numpy(dtype=np.int64)
+    variant_codes = df['variant'].astype(pd.CategoricalDtype(VARIANTS)).cat.codes.to_numpy(dtype=np.int8)
+    columns = zip(
+        telegram_ids.tolist(),
+        df['name'].tolist(),
+        df['role'].tolist(),
+        df['company'].tolist(),
+        variant_codes.tolist(),
+    )
+    for telegram_id, name, role, company, variant_code in columns:
+        yield UserRecord(telegram_id, name, role, company, variant_code)
+
+
+def hash64(telegram_ids, salt: str) -> np.ndarray:
+    """
+    Детерминированный 64-битный хэш каждого telegram_id: splitmix64(id ^ хэш соли)
+    Считается одним проходом NumPy по всему массиву, без цикла Python
+    """
+    salt_hash = np.uint64(int.from_bytes(hashlib.sha256(salt.encode('utf-8')).digest()[:8], 'little'))
+    x = np.asarray(telegram_ids, dtype=np.int64).view(np.uint64) ^ salt_hash
+    # Умножение по модулю 2^64 — переполнение здесь и есть перемешивание
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    return x
+
+
+def hash_unit(telegram_ids, salt: str = CAMPAIGN_SALT) -> np.ndarray:
+    """Детерминированное число из [0, 1) для каждого telegram_id"""
+    # Старшие 53 бита — ровно столько помещается в мантиссу float64
+    return (hash64(telegram_ids, salt) >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def assign_shards(telegram_ids, shards: int, salt: str = SHARD_SALT) -> np.ndarray:
+    """
+    Номер бота (шарда) для каждого telegram_id — jump consistent hash (Lamping, Veach):
+    пользователь всегда попадает к тому же боту, а при добавлении бота в пул
+    переезжает только 1/shards пользователей, а не почти все, как при остатке от деления
+    """
+    if shards < 1:
+        raise ValueError(f"Число шардов должно быть положительным: {shards}")
+    key = hash64(telegram_ids, salt)
+    bucket = np.zeros(key.shape, dtype=np.int64)
+    jump = np.zeros(key.shape, dtype=np.int64)
+    active = jump < shards
+    # Каждый ключ делает в среднем ln(shards) + 1 прыжков; считаем их для всех ключей сразу
+    with np.errstate(over='ignore'):
+        while active.any():
+            bucket[active] = jump[active]
+            key[active] = key[active] * np.uint64(2862933555777618013) + np.uint64(1)
+            jump[active] = ((bucket[active] + 1) * (float(1 << 31) / ((key[active] >> np.uint64(33)) + 1))).astype(np.int64)
+            active = jump < shards
+    return bucket.astype(np.int32)
+
+
+def assign_variants(telegram_ids, salt: str = CAMPAIGN_SALT, weights: dict = None) -> np.ndarray:
+    """
+    Коды вариантов (индексы в VARIANTS) по хэшу telegram_id и соли кампании
+    weights — доля трафика каждого варианта (по умолчанию VARIANT_WEIGHTS)
+    """
+    weights = VARIANT_WEIGHTS if weights is None else weights
+    unknown = set(weights) - set(VARIANTS)
+    if unknown:
+        raise ValueError(f"Веса для неизвестных вариантов: {sorted(unknown)}")
+    w = np.array([weights.get(variant, 0) for variant in VARIANTS], dtype=np.float64)
+    if (w < 0).any() or w.sum() <= 0:
+        raise ValueError(f"Веса вариантов должны быть неотрицательными и не все нулевые: {weights}")
+    
+    edges = np.cumsum(w) / w.sum()
+    codes = np.searchsorted(edges, hash_unit(telegram_ids, salt), side='right')
+    # Защита от округления последней границы чуть ниже 1.0
+    return np.minimum(codes, len(VARIANTS) - 1).astype(np.int8)
+
+
+def with_hashed_variants(df: pd.DataFrame, salt: str = CAMPAIGN_SALT, weights: dict = None) -> pd.DataFrame:
+    """Копия куска пользователей, где variant назначен assign_variants (вместо значения из CSV)"""
+    codes = assign_variants(df['telegram_id'].to_numpy(dtype=np.int64), salt, weights)
+    df = df.copy(deep=False)
+    df['variant'] = pd.Categorical.from_codes(codes, categories=VARIANTS)
+    return df
+
+
+def load_users(csv_path: str, as_records: bool = False):
     """
     Загружает пользователей из CSV файла
     Проверяет наличие необходимых полей и конвертирует telegram_id в int
     Добавляет поле variant если отсутствует
+    as_records=True — вернуть список UserRecord вместо DataFrame
+    Для больших файлов используйте iter_users — он не держит весь файл в памяти
     """
-    try:
-        df = pd.read_csv(csv_path)
-        
-        # Проверяем наличие необходимых полей
-        required_fields = ['name', 'role', 'company', 'telegram_id']
-        missing_fields = [field for field in required_fields if field not in df.columns]
-        
-        if missing_fields:
-            raise ValueError(f"Отсутствуют обязательные поля: {missing_fields}")
-        
-        # Добавляем поле variant если отсутствует
-        if 'variant' not in df.columns:
-            df['variant'] = 'a'  # значение по умолчанию
-            print("⚠️  Поле 'variant' отсутствует, установлено значение 'a' по умолчанию")
-        
-        # Конвертируем telegram_id в int
-        df['telegram_id'] = df['telegram_id'].astype(int)
+    chunks = list(iter_users(csv_path))
+    if chunks:
+        df = pd.concat(chunks, ignore_index=True)
+        df['variant'] = df['variant'].astype(pd.CategoricalDtype(VARIANTS))
+    else:
+        df = pd.DataFrame(columns=REQUIRED_FIELDS + ['variant'])
+    
+    print(f"Загружено {len(df)} пользователей из {csv_path}")
+    print(f"Варианты: {df['variant'].value_counts().to_dict()}")
+    if as_records:
+        return list(records_from_frame(df))
+    return df
+
+
+class TemplateRegistry:
+    """
+    Реестр скомпилированных шаблонов STAGES × VARIANTS
+    Все шаблоны компилируются один раз при создании; отсутствующий шаблон — ошибка сразу,
+    а не на середине рассылки. Перекомпиляция — только если изменился mtime файла,
+    причем mtime проверяется не чаще раза в check_interval секунд
+    """
+
+    def __init__(self, template_dir: str = 'templates', check_interval: float = TEMPLATE_CHECK_INTERVAL):
+        self.template_dir = Path(template_dir)
+        self.check_interval = check_interval
+        self.env = Environment(loader=FileSystemLoader(str(self.template_dir)), auto_reload=False)
+        self.env.globals.update(brand=BRAND, fonts=FONTS)
+        self._templates = {}
+        self._last_check = time.monotonic()
         
-        # Проверяем корректность вариантов
-        invalid_variants = df[~df['variant'].isin(VARIANTS)]
-        if not invalid_variants.empty:
-            print(f"⚠️  Найдены некорректные варианты: {invalid_variants['variant'].tolist()}")
-            df.loc[~df['variant'].isin(VARIANTS), 'variant'] = 'a'
+        missing = [
+            f"{stage}_{variant}.html"
+            for stage in STAGES for variant in VARIANTS
+            if not (self.template_dir / f"{stage}_{variant}.html").is_file()
+        ]
+        if missing:
+            raise FileNotFoundError(f"Шаблоны не найдены: {missing}")
         
-        print(f"Загружено {len(df)} пользователей из {csv_path}")
-        print(f"Варианты: {df['variant'].value_counts().to_dict()}")
-        return df
+        for stage in STAGES:
+            for variant in VARIANTS:
+                self._compile(stage, variant)
+
+    def _compile(self, stage: str, variant: str):
+        path = self.template_dir / f"{stage}_{variant}.html"
+        mtime = path.stat().st_mtime_ns
+        source = path.read_text(encoding='utf-8')
+        template = self.env.from_string(source)
+        self._templates[(stage, variant)] = (template, mtime, path, source)
+
+    def _reload_changed(self):
+        for (stage, variant), (template, mtime, path, source) in list(self._templates.items()):
+            try:
+                if path.stat().st_mtime_ns != mtime:
+                    self._compile(stage, variant)
+            except OSError as e:
+                # Файл удален или переименован (например, редактор сохраняет через временный файл):
+                # остается последняя скомпилированная версия, остальные шаблоны не затронуты.
+                # mtime=None — предупреждение один раз; когда файл вернется, он перекомпилируется
+                if mtime is not None:
+                    print(f"⚠️  Шаблон {path} недоступен, используется прежняя версия: {e}")
+                    self._templates[(stage, variant)] = (template, None, path, source)
+
+    def get(self, stage: str, variant: str):
+        """Возвращает скомпилированный шаблон этапа и варианта"""
+        if self.check_interval is not None:
+            now = time.monotonic()
+            if now - self._last_check >= self.check_interval:
+                self._last_check = now
+                self._reload_changed()
         
-    except FileNotFoundError:
-        raise FileNotFoundError(f"Файл {csv_path} не найден")
-    except Exception as e:
-        raise Exception(f"Ошибка при загрузке CSV: {e}")
+        entry = self._templates.get((stage, variant))
+        if entry is None:
+            raise FileNotFoundError(f"Шаблон {stage}_{variant}.html не найден")
+        return entry[0]
+
+    def source(self, stage: str, variant: str) -> str:
+        """Исходный текст шаблона (для хэшей и разбора разметки)"""
+        return self._templates[(stage, variant)][3]
+
+
+_template_registry = None
+
+
+def get_template_registry() -> TemplateRegistry:
+    """
+    Возвращает общий для процесса реестр шаблонов, компилируя его при первом обращении
+    """
+    global _template_registry
+    if _template_registry is None:
+        _template_registry = TemplateRegistry()
+    return _template_registry
 
 
 def render_html(stage: str, variant: str, user_data: dict) -> str:
@@ -54,179 +317,141 @@ def render_html(stage: str, variant: str, user_data: dict) -> str:
     Рендерит HTML шаблон с данными пользователя и брендингом
     """
     try:
-        # Создаем Jinja2 окружение
-        template_dir = Path('templates')
-        env = Environment(loader=FileSystemLoader(template_dir))
-        
-        # Формируем имя шаблона
-        template_name = f"{stage}_{variant}.html"
-        template_path = template_dir / template_name
-        
-        if not template_path.exists():
-            raise FileNotFoundError(f"Шаблон {template_name} не найден")
-        
-        # Загружаем шаблон
-        template = env.get_template(template_name)
-        
-        # Подготавливаем данные для рендеринга
-        render_data = {
-            **user_data,
-            'brand': BRAND,
-            'fonts': FONTS
-        }
-        
-        # Рендерим с данными пользователя и брендингом
-        html_content = template.render(**render_data)
+        template = get_template_registry().get(stage, variant)
         
-        return html_content
+        # Брендинг и шрифты уже лежат в глобальных переменных окружения Jinja2
+        return template.render(**user_data)
         
     except Exception as e:
         raise Exception(f"Ошибка при рендеринге HTML {stage}_{variant}: {e}")
 
 
-def html_to_png(html_str: str, stage: str, user_id: int, output_dir: str, user_data: dict = None) -> str:
+def render_many(users, stages: list = STAGES):
     """
-    Конвертирует HTML в PNG изображение с улучшенным качеством
+    Пакетный рендеринг: для каждого пользователя (словарь с name, role, company
+    и необязательным variant) возвращает словарь {stage: html}
+    Работает как генератор, поэтому не держит всю пачку в памяти
+    """
+    registry = get_template_registry()
+    for user_data in users:
+        variant = user_data.get('variant', 'a')
+        yield {stage: registry.get(stage, variant).render(**user_data) for stage in stages}
+
+
+def _render_image(html_str: str, stage: str, user_data: dict, backend: str):
+    if backend == 'pillow':
+        # Статический фон этапа кэшируется, дорисовываются только персональные строки
+        stage_name, _, variant = stage.partition('_')
+        return render_image(stage_name, variant or 'a', user_data)
+    if backend == 'weasyprint':
+        return render_document(html_str)
+    raise ValueError(f"Неизвестный бэкенд рендеринга: {backend}")
+
+
+def html_to_png(html_str: str, stage: str, user_id: int, output_dir: str, user_data: dict = None,
+                backend: str = RENDER_BACKEND, image_format: str = IMAGE_FORMAT) -> str:
+    """
+    Конвертирует HTML в PNG изображение
+    backend='pillow' — быстрый рендер по разметке этапа без разбора HTML (html_str не используется),
+    backend='weasyprint' — настоящая верстка html_str через WeasyPrint
+    image_format — формат файла (см. renderer.IMAGE_FORMATS): PNG с палитрой, JPEG или WebP меньше по размеру
     """
     try:
         # Создаем директорию для вывода если её нет
         os.makedirs(output_dir, exist_ok=True)
         
-        # Создаем временный HTML файл
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.html', delete=False, encoding='utf-8') as temp_file:
-            temp_file.write(html_str)
-            temp_html_path = temp_file.name
+        # Путь для сохранения PNG
+        png_filename = f"{stage}_{user_id}{image_extension(image_format)}"
+        png_path = os.path.join(output_dir, png_filename)
         
-        try:
-            # Путь к CSS файлу
-            css_path = Path('templates/styles.css')
-            
-            # Создаем HTML объект с base_url для загрузки Google Fonts
-            html_doc = HTML(
-                string=html_str, 
-                base_url='https://fonts.googleapis.com/'
-            )
-            
-            # Путь для сохранения PNG
-            png_filename = f"{stage}_{user_id}.png"
-            png_path = os.path.join(output_dir, png_filename)
-            
-            # Создаем изображение с HTML контентом используя Pillow
-            from PIL import Image, ImageDraw, ImageFont
-            
-            img = Image.new('RGB', (IMAGE_WIDTH, IMAGE_HEIGHT), color=BRAND['colors']['bg'])
-            draw = ImageDraw.Draw(img)
-            
-            try:
-                font_large = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", 32)
-                font_medium = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", 24)
-                font_small = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", 18)
-            except:
-                font_large = ImageFont.load_default()
-                font_medium = ImageFont.load_default()
-                font_small = ImageFont.load_default()
-            
-            # Определяем контент в зависимости от этапа
-            if stage.startswith('interest'):
-                # Контент для этапа Interest
-                y_pos = 50
-                draw.text((50, y_pos), f"POZNAY SEBYA / KNOW YOURSELF", fill=BRAND['colors']['text'], font=font_large)
-                y_pos += 60
-                
-                draw.text((50, y_pos), f"{user_data.get('name', 'User')} из {user_data.get('company', 'Company')}!", fill=BRAND['colors']['text'], font=font_medium)
-                y_pos += 40
-                
-                draw.text((50, y_pos), f"Ваша роль {user_data.get('role', 'Role')} — это начало пути к себе.", fill=BRAND['colors']['text'], font=font_small)
-                y_pos += 30
-                
-                draw.text((50, y_pos), "Poznay Sebya предлагает tangible insights для mindful self-discovery", fill=BRAND['colors']['accent'], font=font_small)
-                y_pos += 30
-                
-                draw.text((50, y_pos), "с echoing natural tones.", fill=BRAND['colors']['accent'], font=font_small)
-                y_pos += 40
-                
-                draw.text((50, y_pos), "Откройте глубину в себе — присоединяйтесь к transformation!", fill=BRAND['colors']['highlight'], font=font_medium)
-                y_pos += 60
-                
-                draw.text((50, y_pos), "Poznay Sebya — Know Yourself", fill=BRAND['colors']['text'], font=font_small)
-                
-            elif stage.startswith('solution'):
-                # Контент для этапа Solution
-                y_pos = 50
-                draw.text((50, y_pos), f"POZNAY SEBYA / KNOW YOURSELF", fill=BRAND['colors']['text'], font=font_large)
-                y_pos += 60
-                
-                draw.text((50, y_pos), f"Решение для {user_data.get('name', 'User')}", fill=BRAND['colors']['text'], font=font_medium)
-                y_pos += 40
-                
-                draw.text((50, y_pos), "Персональные сессии самопознания", fill=BRAND['colors']['text'], font=font_small)
-                y_pos += 30
-                
-                draw.text((50, y_pos), "5-10 индивидуальных встреч", fill=BRAND['colors']['accent'], font=font_small)
-                y_pos += 30
-                
-                draw.text((50, y_pos), "PDF-отчёты с insights", fill=BRAND['colors']['accent'], font=font_small)
-                y_pos += 40
-                
-                draw.text((50, y_pos), "Начните путь к себе уже сегодня!", fill=BRAND['colors']['highlight'], font=font_medium)
-                y_pos += 60
-                
-                draw.text((50, y_pos), "Poznay Sebya — Know Yourself", fill=BRAND['colors']['text'], font=font_small)
-                
-            elif stage.startswith('deadline'):
-                # Контент для этапа Deadline
-                y_pos = 50
-                draw.text((50, y_pos), f"POZNAY SEBYA / KNOW YOURSELF", fill=BRAND['colors']['text'], font=font_large)
-                y_pos += 60
-                
-                draw.text((50, y_pos), f"Для {user_data.get('name', 'User')} в {user_data.get('company', 'Company')}", fill=BRAND['colors']['text'], font=font_medium)
-                y_pos += 40
-                
-                draw.text((50, y_pos), "— шанс на гармонию", fill=BRAND['colors']['text'], font=font_medium)
-                y_pos += 40
-                
-                draw.text((50, y_pos), "Ограниченное предложение:", fill=BRAND['colors']['accent'], font=font_small)
-                y_pos += 30
-                
-                draw.text((50, y_pos), "25,000 - 75,000 рублей", fill=BRAND['colors']['accent'], font=font_small)
-                y_pos += 30
-                
-                draw.text((50, y_pos), "Только 10 мест доступно!", fill=BRAND['colors']['highlight'], font=font_medium)
-                y_pos += 60
-                
-                draw.text((50, y_pos), "Poznay Sebya — Know Yourself", fill=BRAND['colors']['text'], font=font_small)
-            
-            img.save(png_path)
-            
-            return png_path
-            
-        finally:
-            # Удаляем временный файл
-            os.unlink(temp_html_path)
+        img = _render_image(html_str, stage, user_data, backend)
+        
+        # Пишем во временный файл и подменяем атомарно: старый PNG может быть
+        # жесткой ссылкой на запись кэша, перезапись на месте испортила бы кэш
+        tmp_path = f"{png_path}.{os.getpid()}.tmp"
+        encode_image(img, tmp_path, encode_options(image_format))
+        os.replace(tmp_path, png_path)
+        
+        return png_path
             
     except Exception as e:
         raise Exception(f"Ошибка при конвертации HTML в PNG: {e}")
 
 
-def get_keyboard(stage: str, user_id: int, user_name: str = None) -> InlineKeyboardMarkup:
+def html_to_png_bytes(html_str: str, stage: str, user_data: dict = None, backend: str = RENDER_BACKEND,
+                      image_format: str = IMAGE_FORMAT) -> bytes:
+    """
+    То же, что html_to_png, но картинка возвращается в памяти, без файла (для архива кампании)
+    """
+    try:
+        buffer = io.BytesIO()
+        encode_image(_render_image(html_str, stage, user_data, backend), buffer, encode_options(image_format))
+        return buffer.getvalue()
+    except Exception as e:
+        raise Exception(f"Ошибка при конвертации HTML в PNG: {e}")
+
+
+class KeyboardFactory:
+    """
+    Клавиатуры этапов без валидации pydantic на каждое сообщение:
+    готовая (проверенная один раз) клавиатура и начало ссылки строятся на (stage, variant),
+    для пользователя она копируется через model_copy с подстановкой только текста и ссылки
+    (входные данные — наши же строки, проверять их заново незачем).
+    Ссылки через сервис кликов подписываются click_signature для каждого пользователя
+    """
+
+    def __init__(self, base_url: str = BASE_URL, tracking_url: str = TRACKING_URL,
+                 tracking_secret: str = TRACKING_SECRET):
+        if tracking_url and not tracking_secret:
+            print("⚠️  TRACKING_URL задан без TRACKING_SECRET: кнопки ведут напрямую на BASE_URL")
+            tracking_url = None
+        self.base_url = base_url
+        self.tracking_url = tracking_url
+        self.tracking_secret = tracking_secret
+        self._templates = {}
+
+    def _template(self, stage: str, variant: str):
+        template = self._templates.get((stage, variant))
+        if template is None:
+            title = f"{stage.capitalize()} — Узнай больше"
+            signed = bool(self.tracking_url and variant)
+            if signed:
+                url_prefix = f"{self.tracking_url}/c/{stage}/{variant}/"
+            else:
+                url_prefix = f"{self.base_url}/{stage}?user="
+            markup = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=title, url=f"{url_prefix}0")]
+            ])
+            template = self._templates[(stage, variant)] = (markup, title, f"{title} для ", url_prefix, signed)
+        return template
+
+    def build(self, stage: str, user_id: int, user_name: str = None, variant: str = None) -> InlineKeyboardMarkup:
+        markup, title, personal_title, url_prefix, signed = self._template(stage, variant)
+        url = f"{url_prefix}{user_id}"
+        if signed:
+            url = f"{url}/{click_signature(stage, variant, user_id, self.tracking_secret)}"
+        button = markup.inline_keyboard[0][0].model_copy(update={
+            'text': f"{personal_title}{user_name}" if user_name else title,
+            'url': url,
+        })
+        return markup.model_copy(update={'inline_keyboard': [[button]]})
+
+
+_keyboard_factory = KeyboardFactory()
+
+
+def get_keyboard(stage: str, user_id: int, user_name: str = None, variant: str = None) -> InlineKeyboardMarkup:
     """
     Создает inline клавиатуру для этапа воронки с персонализацией
+    Если заданы TRACKING_URL, TRACKING_SECRET и известен вариант, кнопка ведет через сервис кликов
+    (click_tracker.py) по подписанной ссылке
     """
-    button_text = f"{stage.capitalize()} — Узнай больше"
-    if user_name:
-        button_text = f"{stage.capitalize()} — Узнай больше для {user_name}"
-    
-    button_url = f"{BASE_URL}/{stage}?user={user_id}"
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=button_text, url=button_url)]
-    ])
-    
-    return keyboard
+    return _keyboard_factory.build(stage, user_id, user_name, variant)
 
 
 def get_random_variant() -> str:
     """
     Возвращает случайный вариант для A/B-тестирования
+    Для рассылки используйте assign_variants: он воспроизводим между запусками
     """
     return random.choice(VARIANTS)
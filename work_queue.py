@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Очередь работы распределенной рассылки: координатор делит CSV пользователей на аренды
+(диапазоны строк), воркеры забирают их, продлевают и отмечают выполненными
+"""
+
+import argparse
+import os
+import socket
+import sys
+import time
+from collections import namedtuple
+
+import pandas as pd
+
+# Добавляем текущую директорию в путь для импорта
+sys.path.append('.')
+
+from config import WORK_QUEUE_PATH, LEASE_SIZE, LEASE_HEARTBEAT_INTERVAL, LEASE_TIMEOUT, USERS_CHUNK_SIZE
+from storage import connect
+
+# Состояния аренды
+PENDING = 'pending'  # ждет воркера
+LEASED = 'leased'    # у воркера, который ее продлевает
+DONE = 'done'        # все пользователи диапазона обработаны
+
+
+class LeaseLost(Exception):
+    """Аренда отдана другому воркеру: отправлять ее пользователям больше нельзя"""
+
+
+# Аренда: строки CSV с start по stop - 1 (без заголовка), attempts — сколько раз ее выдавали
+Lease = namedtuple('Lease', 'lease_id start stop attempts')
+
+
+def worker_name() -> str:
+    """Имя воркера по умолчанию: машина и процесс"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def count_rows(csv_path: str, chunksize: int = USERS_CHUNK_SIZE) -> int:
+    """Число строк пользователей в CSV (читается только первая колонка)"""
+    with pd.read_csv(csv_path, usecols=[0], chunksize=chunksize) as reader:
+        return sum(len(chunk) for chunk in reader)
+
+
+class WorkQueue:
+    """
+    Аренды в SQLite, общей для координатора и воркеров (на одной машине или на общем диске)
+    Выдача аренды — один UPDATE ... RETURNING, поэтому два воркера не получат одну и ту же.
+    Воркер продлевает аренду (heartbeat); если он пропал, координатор возвращает ее в очередь,
+    а прежний владелец при следующем продлении узнает, что аренда уже не его
+    """
+
+    def __init__(self, path: str = WORK_QUEUE_PATH):
+        self.path = path
+        self._db = connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS campaign ('
+            'id INTEGER PRIMARY KEY CHECK (id = 1), csv_path TEXT NOT NULL, rows INTEGER NOT NULL, '
+            'created_at REAL NOT NULL)'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            'lease_id INTEGER PRIMARY KEY, start INTEGER NOT NULL, stop INTEGER NOT NULL, '
+            'status TEXT NOT NULL, worker TEXT, heartbeat_at REAL, attempts INTEGER NOT NULL DEFAULT 0)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS leases_status ON leases (status)')
+        self._db.commit()
+
+    @property
+    def csv_path(self):
+        """CSV кампании или None, если координатор еще не создал аренды"""
+        row = self._db.execute('SELECT csv_path FROM campaign').fetchone()
+        return row[0] if row else None
+
+    def create(self, csv_path: str, rows: int, lease_size: int = LEASE_SIZE) -> int:
+        """
+        Делит rows строк csv_path на аренды по lease_size строк, возвращает число новых аренд
+        Повторный вызов для той же кампании ничего не меняет (перезапуск координатора)
+        """
+        if lease_size < 1:
+            raise ValueError(f"Размер аренды должен быть положительным: {lease_size}")
+        current = self.csv_path
+        if current is not None:
+            if current != csv_path:
+                raise ValueError(f"Очередь {self.path} уже создана для {current}")
+            return 0
+        self._db.execute('INSERT INTO campaign (id, csv_path, rows, created_at) VALUES (1, ?, ?, ?)',
+                         (csv_path, rows, time.time()))
+        self._db.executemany(
+            'INSERT INTO leases (start, stop, status) VALUES (?, ?, ?)',
+            [(start, min(start + lease_size, rows), PENDING) for start in range(0, rows, lease_size)]
+        )
+        self._db.commit()
+        return -(-rows // lease_size)
+
+    def claim(self, worker: str, now: float = None):
+        """Забирает свободную аренду для worker; None — свободных нет"""
+        row = self._db.execute(
+            'UPDATE leases SET status = ?, worker = ?, heartbeat_at = ?, attempts = attempts + 1 '
+            'WHERE lease_id = (SELECT lease_id FROM leases WHERE status = ? ORDER BY lease_id LIMIT 1) '
+            'RETURNING lease_id, start, stop, attempts',
+            (LEASED, worker, now or time.time(), PENDING)
+        ).fetchone()
+        self._db.commit()
+        return Lease(*row) if row else None
+
+    def _update_owned(self, sql: str, params: tuple) -> bool:
+        cursor = self._db.execute(sql, params)
+        self._db.commit()
+        return cursor.rowcount > 0
+
+    def heartbeat(self, lease_id: int, worker: str, now: float = None) -> bool:
+        """Продлевает аренду; False — аренда отдана другому воркеру, работу по ней надо прекратить"""
+        return self._update_owned(
+            'UPDATE leases SET heartbeat_at = ? WHERE lease_id = ? AND worker = ? AND status = ?',
+            (now or time.time(), lease_id, worker, LEASED)
+        )
+
+    def complete(self, lease_id: int, worker: str) -> bool:
+        """Отмечает аренду выполненной, если она все еще принадлежит worker"""
+        return self._update_owned(
+            'UPDATE leases SET status = ?, heartbeat_at = ? WHERE lease_id = ? AND worker = ? AND status = ?',
+            (DONE, time.time(), lease_id, worker, LEASED)
+        )
+
+    def requeue_expired(self, timeout: float = LEASE_TIMEOUT, now: float = None) -> list:
+        """Возвращает в очередь аренды без продления дольше timeout секунд: [(lease_id, worker)]"""
+        # worker остается последним владельцем: продлить аренду он уже не сможет, ее статус не LEASED
+        rows = self._db.execute(
+            'UPDATE leases SET status = ? WHERE status = ? AND heartbeat_at < ? '
+            'RETURNING lease_id, worker',
+            (PENDING, LEASED, (now or time.time()) - timeout)
+        ).fetchall()
+        self._db.commit()
+        return rows
+
+    def progress(self) -> dict:
+        """Число аренд в каждом состоянии"""
+        counts = {PENDING: 0, LEASED: 0, DONE: 0}
+        counts.update(self._db.execute('SELECT status, COUNT(*) FROM leases GROUP BY status'))
+        return counts
+
+    def finished(self) -> bool:
+        counts = self.progress()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+    def close(self):
+        self._db.close()
+
+
+def coordinate(work_queue: WorkQueue, timeout: float = LEASE_TIMEOUT,
+               poll_interval: float = LEASE_HEARTBEAT_INTERVAL):
+    """Следит за арендами до конца кампании: пропавших воркеров заменяют другие"""
+    last = None
+    while True:
+        for lease_id, worker in work_queue.requeue_expired(timeout):
+            print(f"⚠️  Воркер {worker} не продлил аренду {lease_id} — она возвращена в очередь")
+        counts = work_queue.progress()
+        if counts != last:
+            print(f"📋 Аренды: ждут {counts[PENDING]}, в работе {counts[LEASED]}, выполнено {counts[DONE]}")
+            last = counts
+        if work_queue.finished():
+            return
+        time.sleep(poll_interval)
+
+
+def main():
+    """Основная функция"""
+    parser = argparse.ArgumentParser(description='Координатор распределенной рассылки')
+    parser.add_argument('--csv', default='users.csv', help='CSV пользователей (по умолчанию users.csv)')
+    parser.add_argument('--queue', default=WORK_QUEUE_PATH, help=f'База очереди (по умолчанию {WORK_QUEUE_PATH})')
+    parser.add_argument('--lease-size', type=int, default=LEASE_SIZE,
+                        help=f'Строк в одной аренде (по умолчанию {LEASE_SIZE})')
+    args = parser.parse_args()
+
+    work_queue = WorkQueue(args.queue)
+    try:
+        # Воркеры читают CSV по этому пути, поэтому он должен быть одинаковым на всех машинах
+        csv_path = os.path.abspath(args.csv)
+        if work_queue.csv_path is None:
+            rows = count_rows(csv_path)
+            created = work_queue.create(csv_path, rows, args.lease_size)
+            print(f"🗂️  {rows} пользователей разделено на {created} аренд по {args.lease_size} строк")
+        elif work_queue.csv_path != csv_path:
+            print(f"❌ Очередь {args.queue} уже создана для {work_queue.csv_path}")
+            sys.exit(1)
+        else:
+            print(f"🗂️  Продолжаем кампанию {csv_path}")
+        print("👷 Запустите воркеры: python3 bot_funnel.py --send --worker")
+        coordinate(work_queue)
+        print("🎉 Все аренды выполнены")
+    except KeyboardInterrupt:
+        print("\n⏹️  Координатор остановлен; аренды сохранены, повторный запуск продолжит кампанию")
+    finally:
+        work_queue.close()
+
+
+if __name__ == "__main__":
+    main()